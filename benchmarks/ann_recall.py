@@ -0,0 +1,90 @@
+'''
+Recall and latency of the approximate nearest-neighbor index (scopeutils/index.py) against exact search.
+
+Builds an index over firm-year vectors, then, for a sample of firm-years, asks for their k nearest peers with
+AnnIndex.neighbors for a range of nprobe (clusters probed), and with exact=True (brute force over the year).
+Recall@k is the share of the exact neighbors that the approximate search returns; latency is per query, in
+milliseconds, with the partitions already memory-mapped.
+
+Runs on synthetic clustered vectors (firms drawn around industry centers), or on the embedded shards:
+
+    python benchmarks/ann_recall.py --source scopeProject/data/processed/embedded/items1_a_7 --column embfull
+'''
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scopeutils as su
+
+def synthetic_vectors(path, firms=5000, years=(2000, 2001), dim=1024, industries=300, spread=0.7, drift=0.2, seed=0):
+    '''
+    Parquet file of firm-year vectors stored like embed_parquet does (float16): each firm sits near the center
+    of one of industries industries (at distance about spread), and moves by about drift from year to year.
+    '''
+    rng = np.random.default_rng(seed)
+    noise = lambda n, size: size * su.normalize_rows(rng.standard_normal((n, dim)))
+    centers = su.normalize_rows(rng.standard_normal((industries, dim)))
+    firm = su.normalize_rows(centers[rng.integers(industries, size=firms)] + noise(firms, spread))
+    tables = []
+    for year in years:
+        vectors = su.normalize_rows(firm + noise(firms, drift))
+        columns = {'gvkey': pa.array([f'{i:06d}' for i in range(firms)]), 'fyear': pa.array(np.full(firms, year))}
+        columns.update(su.vector_columns('embfull', vectors, 'float16'))
+        tables.append(pa.table(columns))
+    pq.write_table(pa.concat_tables(tables), path)
+    return path
+
+def benchmark(index, queries=200, k=10, nprobes=(1, 2, 4, 8, 16, 32), seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    sample = []
+    for year in index.years:
+        keys = index._part(year)['keys']
+        sample += [(keys[i], year) for i in rng.choice(len(keys), min(queries, len(keys)), replace=False)]
+
+    def run(**kwargs):
+        found, times = [], []
+        for key, year in sample:
+            start = time.perf_counter()
+            peers = index.neighbors(key, year, k=k, **kwargs)
+            times.append(time.perf_counter() - start)
+            found.append(set(peers[index.key]))
+        return found, 1000 * np.array(times)
+
+    exact, times = run(exact=True)
+    results.append({'nprobe': 'exact', 'recall': 1.0, 'median_ms': np.median(times), 'p95_ms': np.percentile(times, 95)})
+    for nprobe in nprobes:
+        found, times = run(nprobe=nprobe)
+        recall = np.mean([len(a & e) / max(len(e), 1) for a, e in zip(found, exact)])
+        results.append({'nprobe': nprobe, 'recall': recall, 'median_ms': np.median(times), 'p95_ms': np.percentile(times, 95)})
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', help='embedded Parquet shards (default: synthetic vectors)')
+    parser.add_argument('--column', default='embfull')
+    parser.add_argument('--firms', type=int, default=5000, help='synthetic firms per year')
+    parser.add_argument('--method', default='ivf', choices=['ivf', 'hnsw'])
+    parser.add_argument('--queries', type=int, default=200, help='queries per year')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--out', default='ann_recall.json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = args.source or synthetic_vectors(Path(tmp) / 'vectors.parquet', firms=args.firms)
+        start = time.perf_counter()
+        path = su.build_index(source, Path(tmp) / 'index', column=args.column, method=args.method)
+        build_seconds = time.perf_counter() - start
+        index = su.AnnIndex(path)
+        result = {'method': args.method, 'k': args.k, 'vectors': index.meta['counts'], 'build_seconds': build_seconds,
+                  'results': benchmark(index, args.queries, args.k,
+                                       nprobes=(10, 20, 50, 100, 200) if args.method == 'hnsw' else (1, 2, 4, 8, 16, 32))}
+
+    print(pd.DataFrame(result['results']).to_string(index=False))
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2, default=float)
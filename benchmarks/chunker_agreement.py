@@ -0,0 +1,91 @@
+'''
+Benchmark of the Arrow chunker (scopeutils.Chunker) against the original chunk_text (nltk Punkt).
+
+Reports the run time of both, and how well their chunk boundaries agree: every chunk boundary is placed by the
+number of non-whitespace characters before it, so whitespace differences do not count. Precision is the share of
+the fast chunker's boundaries that chunk_text also has, recall the share of chunk_text's boundaries it finds.
+
+Needs the nltk 'punkt_tab' data (nltk.download('punkt_tab')). Runs on synthetic 10-K-like text, or on a column
+of a real Parquet shard:
+
+    python benchmarks/chunker_agreement.py --parquet scopeProject/data/raw/10k/items1_a_7/chunk0.parquet
+'''
+import argparse
+import json
+import random
+import re
+import time
+import pandas as pd
+import scopeutils as su
+
+WORDS = '''the Company Inc. Corp. sells products services customers U.S. e.g. revenue increased decreased million
+    fiscal year compared No. competition risk factors include demand supply Apple Inc. our we may could
+    operations results financial condition 2.5% 10-K Item'''.split()
+
+def synthetic_10k(n_docs, seed=0):
+    '''
+    10-K-like documents: paragraphs of 3 to 900 words, separated by newlines, with runs of spaces and
+    non-breaking spaces, abbreviations, and sentence ends.
+    '''
+    rng = random.Random(seed)
+    docs = []
+    for _ in range(n_docs):
+        paragraphs = []
+        for _ in range(rng.randint(1, 60)):
+            words = [rng.choice(WORDS) for _ in range(rng.choice([3, 12, 40, 150, 400, 900]))]
+            for i in range(rng.randint(0, len(words) // 12), 0, -1):
+                words.insert(rng.randrange(len(words)), rng.choice(['.', '!', '?', 'end.', 'Risk.']))
+            paragraphs.append(rng.choice([' ', '  ', ' \xa0 ']).join(words))
+        docs.append('\n'.join(paragraphs))
+    return docs
+
+def boundaries(chunks):
+    cuts, n = set(), 0
+    for chunk in chunks:
+        n += len(''.join(chunk.split()))
+        cuts.add(n)
+    return cuts
+
+def compare(docs, max_len, tokenizer=None, max_tokens=510, processes=1):
+    start = time.perf_counter()
+    reference = [[c for c in su.chunk_text(doc, max_len) if re.search(r'\S', c)] if doc is not None else [] for doc in docs]
+    reference_time = time.perf_counter() - start
+
+    kwargs = {'max_tokens': max_tokens, 'tokenizer': tokenizer} if tokenizer else {'max_chars': 2 * max_len}
+    with su.Chunker(processes=processes, **kwargs) as chunker:
+        start = time.perf_counter()
+        chunks, offsets = chunker(docs)
+        fast_time = time.perf_counter() - start
+    chunks = chunks.to_pylist()
+    fast = [chunks[offsets[i]:offsets[i + 1]] for i in range(len(docs))]
+
+    hits = found = expected = same = 0
+    for a, b in zip(reference, fast):
+        ca, cb = boundaries(a), boundaries(b)
+        hits += len(ca & cb)
+        found += len(cb)
+        expected += len(ca)
+        same += a == b
+    return {'documents': len(docs), 'reference_chunks': sum(map(len, reference)), 'fast_chunks': len(chunks),
+            'reference_seconds': reference_time, 'fast_seconds': fast_time, 'speedup': reference_time / fast_time,
+            'boundary_precision': hits / found if found else 1.0,
+            'boundary_recall': hits / expected if expected else 1.0, 'identical_documents': same / len(docs)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--parquet', help='Parquet file with the documents (default: synthetic text)')
+    parser.add_argument('--column', default='text')
+    parser.add_argument('--docs', type=int, default=500, help='number of synthetic documents')
+    parser.add_argument('--max', type=int, default=1024, help="chunk_text's max (character budget is 2*max)")
+    parser.add_argument('--tokenizer', help='model directory; budget the fast chunker in tokens instead')
+    parser.add_argument('--max-tokens', type=int, default=510, help='token budget used with --tokenizer')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--out', default='chunker_agreement.json')
+    args = parser.parse_args()
+
+    docs = pd.read_parquet(args.parquet, columns=[args.column])[args.column].tolist() if args.parquet \
+        else synthetic_10k(args.docs)
+    result = compare(docs, args.max, args.tokenizer, args.max_tokens, args.processes)
+    print(json.dumps(result, indent=2))
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
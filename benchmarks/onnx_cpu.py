@@ -0,0 +1,56 @@
+'''
+CPU throughput and parity of the embedding backends: SentenceTransformer (torch, on CPU) against the ONNX
+Runtime exports of the same model (fp32 and int8), see scopeutils/backend.py.
+
+Encodes the same chunks of synthetic 10-K text with each backend and records chunks and tokens per second, and
+the cosine similarity of the ONNX embeddings to the torch ones (the int8 model should keep a minimum cosine of
+at least 0.999). The first run exports the model to scopeProject/UAE-Large-V1/onnx/.
+
+    python benchmarks/onnx_cpu.py --chunks 2000 --threads 8
+'''
+import argparse
+import json
+import time
+import numpy as np
+import scopeutils as su
+from chunker_agreement import synthetic_10k
+
+def throughput(encoder, texts, batch_size, tokens):
+    encoder.encode(texts[:batch_size], batch_size=batch_size) # warm-up
+    start = time.perf_counter()
+    encoder.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'chunks_per_second': len(texts) / seconds, 'tokens_per_second': tokens / seconds}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=str(su.get_data_path('model_dir')))
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--parity-chunks', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--out', default='onnx_cpu.json')
+    args = parser.parse_args()
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+    threads = args.threads or su.backend._cpu_threads()
+    torch.set_num_threads(threads)
+
+    chunks, _ = su.Chunker(max_chars=2048)(synthetic_10k(200))
+    texts = chunks.to_pylist()
+    texts = [texts[i] for i in np.random.default_rng(0).choice(len(texts), min(args.chunks, len(texts)), replace=False)]
+    tokens = int(np.minimum(su.TokenCounter(args.model)(texts) + 2, 512).sum())
+
+    reference = SentenceTransformer(args.model, device='cpu')
+    result = {'chunks': len(texts), 'tokens': tokens, 'threads': threads, 'batch_size': args.batch_size,
+              'torch': throughput(reference, texts, args.batch_size, tokens)}
+    for backend in ('onnx-fp32', 'onnx'):
+        encoder = su.load_encoder(args.model, backend, threads=threads)
+        result[backend] = throughput(encoder, texts, args.batch_size, tokens)
+        result[backend]['parity'] = su.parity_check(reference, encoder, texts[:args.parity_chunks])
+        result[backend]['speedup_vs_torch'] = result['torch']['seconds'] / result[backend]['seconds']
+
+    print(json.dumps(result, indent=2))
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
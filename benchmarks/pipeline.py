@@ -0,0 +1,234 @@
+'''
+Times every stage of scopeProject/0_get_data on seeded synthetic data (benchmarks/synthetic.py) and records the
+results as JSON, so that runs can be compared across commits.
+
+Stages: clean_linkfile and the CIK-gvkey interval join of 10-K filings (1_cik_gvkey_link.py), the CCM interval
+join of firm-years (0_clean_cs_crsp.py), clean_10ks (2_get_10k_text.py), annual return compounding (calendar and
+fiscal years), the intangible capital build (nearest-value interpolation of xsga, the log-growth backfill of xrd
+and the stock recurrence, as in 4_construct_intanStocks.py), chunk_text and the Arrow chunker, and embedding a
+shard with a tiny randomly initialised BERT (UAE-Large-V1's tokenizer, 2 layers of width 64) through
+embed_parquet. Functions defined in the scripts are loaded from their source, without running the scripts or
+importing their dependencies (saspy, sec_api).
+
+Each stage is run repeat times for the wall and CPU time (the best run is kept), and once more under
+tracemalloc for the peak memory allocated by Python and NumPy. A stage whose dependencies are missing (nltk
+punkt data for chunk_text; torch, transformers and sentence-transformers for the embedding) records the error
+instead.
+
+    python benchmarks/pipeline.py --firms 5000 --filings 300 --out pipeline.json
+    python benchmarks/pipeline.py --compare old.json new.json
+'''
+import argparse
+import ast
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import scopeutils as su
+import synthetic
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRIPTS = ROOT / 'scopeProject/0_get_data'
+
+def script_function(path, name):
+    '''
+    A function defined at the top level of a pipeline script, compiled from the script's source in a namespace
+    with pd, np and su, so that the script's own imports and main block are not run.
+    '''
+    tree = ast.parse(Path(path).read_text())
+    node = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == name)
+    namespace = {'pd': pd, 'np': np, 'su': su}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), str(path), 'exec'), namespace)
+    return namespace[name]
+
+def _rows(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+def measure(stage, repeat=3):
+    '''
+    Best wall and CPU time of repeat runs of stage(), then the peak traced memory of one more run.
+    '''
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = stage()
+        timing = (time.perf_counter() - wall, time.process_time() - cpu)
+        best = timing if best is None or timing[0] < best[0] else best
+    gc.collect()
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rows = _rows(result)
+    return {'seconds': best[0], 'cpu_seconds': best[1], 'peak_mb': peak / 2 ** 20, 'rows': rows,
+            'rows_per_second': rows / best[0] if rows else None}
+
+def tiny_encoder(path, dim=64):
+    '''
+    A 2-layer BERT of width dim with random weights and UAE-Large-V1's tokenizer, saved to path as a
+    sentence-transformers model (CLS pooling, 128 tokens), for timing the embedding code rather than the model.
+    '''
+    import shutil
+    from transformers import BertConfig, BertModel
+    from sentence_transformers import SentenceTransformer, models
+    model_dir = ROOT / 'scopeProject/UAE-Large-V1'
+    config = BertConfig(vocab_size=30522, hidden_size=dim, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=2 * dim, max_position_embeddings=512)
+    BertModel(config).save_pretrained(path)
+    for name in ('tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json', 'vocab.txt'):
+        shutil.copy(model_dir / name, Path(path) / name)
+    transformer = models.Transformer(str(path), max_seq_length=128)
+    pooling = models.Pooling(dim, pooling_mode='cls')
+    return SentenceTransformer(modules=[transformer, pooling], device='cpu')
+
+def stages(args, tmp):
+    '''
+    Stage name -> function running it on the synthetic inputs (built once, outside the timings).
+    '''
+    funda = synthetic.funda(args.firms, seed=args.seed)
+    crsp = synthetic.crsp_monthly(args.firms, seed=args.seed)
+    links = synthetic.cik_gvkey_links(funda, seed=args.seed)
+    items = synthetic.tenk_items(args.filings, seed=args.seed)
+    filings = synthetic.tenk_filings(funda, seed=args.seed)
+    ccm = synthetic.ccm_links(funda, seed=args.seed)
+    docs = items['item1'].tolist()
+
+    clean_linkfile = script_function(SCRIPTS / '1_cik_gvkey_link.py', 'clean_linkfile')
+    clean_10ks = script_function(SCRIPTS / '2_get_10k_text.py', 'clean_10ks')
+
+    def cik_gvkey_link():
+        # as in 1_cik_gvkey_link.py: links with an unknown start or end are never valid
+        cikgvkey = clean_linkfile(links.copy()).dropna(subset=['DATADATE1', 'DATADATE2'])
+        return su.interval_join(filings, cikgvkey, on='cik', date='rdate', start='DATADATE1', end='DATADATE2')
+
+    def ccm_link():
+        # as in 0_clean_cs_crsp.py: a link is used if it is valid on the fiscal year end; 'E' is open-ended
+        links = ccm[['GVKEY', 'permno', 'permco', 'LINKDT', 'LINKENDDT', 'datadate', 'fyear']].copy()
+        links.columns = ['gvkey', 'permno', 'permco', 'linkdt', 'linenddt', 'datadate', 'fyear']
+        links['linkdt'] = su.to_link_date(links['linkdt'])
+        links['linenddt'] = su.to_link_date(links['linenddt'])
+        comp = funda[['gvkey', 'datadate', 'fyear', 'at']]
+        return su.interval_join(comp.assign(link_date=su.to_link_date(comp['datadate']).values), links,
+                                on=['gvkey', 'datadate', 'fyear'], date='link_date', start='linkdt', end='linenddt',
+                                how='left')
+
+    # fiscal year ends linked to securities: firm i holds security PERMNO 10000 + i
+    fiscal_ends = funda[['gvkey', 'fyear', 'datadate']].assign(PERMNO=funda['gvkey'].astype(int) - 1000 + 10000)
+
+    capital = funda[['gvkey', 'fyear']].copy()
+    capital['xrd'] = funda['xrd'].fillna(0).to_numpy()
+    capital['xsga'] = funda['xsga'].fillna(0).to_numpy()
+    rng = np.random.default_rng(args.seed)
+    capital['theta_g2'] = rng.choice([0.33, 0.42, 0.46, 0.48], len(capital))
+    capital['gamma_o2'] = rng.choice([0.19, 0.22, 0.30, 0.33], len(capital))
+    # starting stocks of the first year, as in EPW: flow / (growth + depreciation), with 10% growth
+    first = ~capital['gvkey'].duplicated()
+    capital['kcap_v2'] = np.where(first, capital['xrd'] / (0.1 + capital['theta_g2']), np.nan)
+    capital['ocap_v2'] = np.where(first, capital['xsga'] * capital['gamma_o2'] / (0.1 + 0.2), np.nan)
+
+    # the imputation passes of 4_construct_intanStocks.py on the same panel (sorted by gvkey and fyear): xsga gaps
+    # filled from the nearest year of the firm, and log xrd backfilled with growth rates by age
+    gvkeys = funda['gvkey'].to_numpy()
+    logxrd = np.log(funda['xrd'].where(funda['xrd'] > 0)).to_numpy()
+    grate = rng.normal(0.08, 0.05, len(funda))
+
+    def embed():
+        encoder = tiny_encoder(Path(tmp) / 'tiny')
+        src = Path(tmp) / 'items.parquet'
+        clean_10ks(items.copy()).to_parquet(src, index=False)
+        dim = encoder.get_sentence_embedding_dimension()
+        with su.Chunker(max_tokens=126, tokenizer=Path(tmp) / 'tiny') as chunker:
+            bucketed = su.BucketedEncoder(lambda texts: encoder.encode(texts, batch_size=len(texts)),
+                                          chunker.count_tokens, max_length=128)
+            return su.embed_parquet(src, Path(tmp) / 'embedded.parquet', {'embfull': 'text', 'emb1': 'item1'},
+                                    bucketed, dim, chunker, required=['text', 'item1'])
+
+    return {
+        'clean_linkfile': lambda: clean_linkfile(links.copy()),
+        'clean_10ks': lambda: clean_10ks(items.copy()),
+        'annual_returns': lambda: su.annual_returns(crsp, keys=['PERMNO']),
+        'annual_returns_fiscal': lambda: su.annual_returns(crsp, keys=['PERMNO'], fiscal_ends=fiscal_ends),
+        'cik_gvkey_link': cik_gvkey_link,
+        'ccm_link': ccm_link,
+        'interpolate_nearest': lambda: su.interpolate_nearest(funda['xsga'], gvkeys, funda['xsga'].isna()),
+        'backfill_log_growth': lambda: su.backfill_log_growth(logxrd, grate, gvkeys),
+        'intangible_capital': lambda: su.calculate_intangible_capital(capital),
+        'chunk_text': lambda: [su.chunk_text(doc, 1024) for doc in docs],
+        'chunker': lambda: su.Chunker(max_chars=2048)(docs),
+        'embed': embed,
+    }
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except OSError:
+        return None, None
+
+def compare(old, new):
+    '''
+    Table of the seconds and peak memory of the stages two result files have in common, new relative to old.
+    '''
+    rows = []
+    for name in new['stages']:
+        a, b = old['stages'].get(name, {}), new['stages'][name]
+        if 'seconds' in a and 'seconds' in b:
+            rows.append({'stage': name, 'old_seconds': a['seconds'], 'new_seconds': b['seconds'],
+                         'speedup': a['seconds'] / b['seconds'], 'old_peak_mb': a['peak_mb'], 'new_peak_mb': b['peak_mb']})
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--firms', type=int, default=2000, help='Compustat firms (and CRSP securities)')
+    parser.add_argument('--filings', type=int, default=200, help='10-K filings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='*', help='stages to run (default: all)')
+    parser.add_argument('--out', help='result file (default: pipeline-<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            print(compare(json.load(f), json.load(g)).to_string(index=False))
+        sys.exit()
+
+    commit, dirty = git_commit()
+    result = {'commit': commit, 'dirty': dirty, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                          'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                          'pyarrow': pa.__version__},
+              'scale': {'firms': args.firms, 'filings': args.filings, 'seed': args.seed, 'repeat': args.repeat},
+              'stages': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, stage in stages(args, tmp).items():
+            if args.stages and name not in args.stages:
+                continue
+            try:
+                result['stages'][name] = measure(stage, 1 if name == 'embed' else args.repeat)
+            except Exception as e:
+                message = next((line.strip() for line in str(e).splitlines() if any(c.isalnum() for c in line)), '')
+                result['stages'][name] = {'error': f'{type(e).__name__}: {message}'}
+            print(name, json.dumps(result['stages'][name]))
+
+    out = args.out or f"pipeline-{(commit or 'unknown')[:10]}.json"
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
@@ -0,0 +1,147 @@
+'''
+Seeded synthetic stand-ins for the licensed inputs of scopeProject/0_get_data, shaped like the WRDS/SEC files the
+scripts read, so that every stage can be timed without the data (see benchmarks/pipeline.py).
+
+- funda: Compustat Fundamentals Annual panel (unbalanced, with the usual missingness of xrd, xsga, naicsh, cik)
+- company: Compustat company table
+- crsp_monthly: CRSP monthly returns over each security's listing spell
+- cik_gvkey_links: WRDS CIK-GVKEY link file as read from CSV (dates as strings with the '0', 'B', 'E' codes)
+- tenk_filings: the WRDS list of 10-K filings (cik, rdate) that the CIK-GVKEY links are joined to
+- ccm_links: CRSP/Compustat Merged links of each firm-year (LINKDT/LINKENDDT as YYYYMMDD, 'E' for open links)
+- tenk_items: 10-K items 1, 1A and 7 as returned by the extractor, with paragraph structure
+'''
+import numpy as np
+import pandas as pd
+from chunker_agreement import synthetic_10k
+
+def funda(n_firms=2000, years=(1980, 2023), seed=0):
+    '''
+    Unbalanced firm-year panel: each firm enters in a random year and stays for a random number of years.
+    About 45% of xrd, 15% of xsga, 20% of naicsh, 10% of cik and 2% of at are missing.
+    '''
+    rng = np.random.default_rng(seed)
+    first = rng.integers(years[0], years[1] + 1, n_firms)
+    length = np.minimum(rng.geometric(1 / 12, n_firms), years[1] - first + 1)
+    firm = np.repeat(np.arange(n_firms), length)
+    fyear = first[firm] + np.arange(len(firm)) - np.repeat(np.cumsum(length) - length, length)
+    n = len(firm)
+
+    fyr = np.where(rng.random(n_firms) < 0.7, 12, rng.integers(1, 12, n_firms))[firm]
+    datadate = pd.to_datetime(pd.DataFrame({'year': fyear, 'month': fyr, 'day': 1})) + pd.offsets.MonthEnd(0)
+    size = rng.lognormal(5, 2, n_firms)[firm] * rng.lognormal(0, 0.3, n)
+    missing = lambda share: rng.random(n) < share
+    sich = rng.choice(np.arange(100, 10000, 25), n_firms)[firm]
+    naicsh = rng.choice(np.arange(111110, 999999, 1117), n_firms)[firm].astype(np.float64)
+    cik = rng.choice(np.arange(1000, 2_000_000), n_firms, replace=False)[firm].astype(np.float64)
+
+    return pd.DataFrame({
+        'gvkey': np.char.zfill(np.arange(1000, 1000 + n_firms).astype(str), 6)[firm],
+        'fyear': fyear, 'datadate': datadate, 'fyr': fyr,
+        'indfmt': 'INDL', 'datafmt': 'STD', 'consol': 'C', 'popsrc': 'D',
+        'cik': np.where(missing(0.1), np.nan, cik), 'sich': sich, 'naicsh': np.where(missing(0.2), np.nan, naicsh),
+        'at': np.where(missing(0.02), np.nan, size),
+        'revt': size * rng.lognormal(-0.3, 0.5, n), 'sale': size * rng.lognormal(-0.3, 0.5, n),
+        'xrd': np.where(missing(0.45), np.nan, size * rng.lognormal(-3, 1, n)),
+        'xsga': np.where(missing(0.15), np.nan, size * rng.lognormal(-1.5, 0.6, n)),
+    })
+
+def company(funda, seed=0):
+    rng = np.random.default_rng(seed)
+    firms = funda.drop_duplicates('gvkey')
+    n = len(firms)
+    ipodate = pd.to_datetime(firms['fyear'].astype(str) + '-06-30') - pd.to_timedelta(rng.integers(0, 3650, n), 'D')
+    return pd.DataFrame({'gvkey': firms['gvkey'].to_numpy(), 'conm': [f'COMPANY {i} INC' for i in range(n)],
+                         'sic': firms['sich'].to_numpy(), 'naics': firms['naicsh'].to_numpy(),
+                         'cik': firms['cik'].to_numpy(),
+                         'ipodate': ipodate.where(rng.random(n) < 0.4).to_numpy()})
+
+def crsp_monthly(n_securities=2000, years=(1980, 2023), seed=0):
+    '''
+    Monthly returns of n_securities over their listing spells (month-end dates), about 1% missing.
+    '''
+    rng = np.random.default_rng(seed)
+    months = (years[1] - years[0] + 1) * 12
+    first = rng.integers(0, months, n_securities)
+    length = np.minimum(rng.geometric(1 / 150, n_securities), months - first)
+    security = np.repeat(np.arange(n_securities), length)
+    month = first[security] + np.arange(len(security)) - np.repeat(np.cumsum(length) - length, length)
+    date = pd.to_datetime(pd.DataFrame({'year': years[0] + month // 12, 'month': month % 12 + 1, 'day': 1})) \
+        + pd.offsets.MonthEnd(0)
+    ret = rng.normal(0.01, 0.12, len(security))
+    return pd.DataFrame({'PERMNO': 10000 + security, 'PERMCO': 20000 + security // 2, 'date': date,
+                         'ret': np.where(rng.random(len(security)) < 0.01, np.nan, ret)})
+
+def cik_gvkey_links(funda, seed=0):
+    '''
+    One to three links per firm with date ranges. Start dates are 'B' (before coverage) for 30% and end dates
+    'E' (after coverage) for half of the links; 3% of either are '0' (unknown), and 3% of gvkeys are missing.
+    '''
+    rng = np.random.default_rng(seed)
+    firms = funda.groupby('gvkey', sort=False).agg(cik=('cik', 'first'), first=('fyear', 'min'), last=('fyear', 'max'))
+    firms['cik'] = firms['cik'].fillna(pd.Series(rng.integers(1000, 2_000_000, len(firms)), index=firms.index))
+    links = firms.loc[firms.index.repeat(rng.integers(1, 4, len(firms)))].reset_index()
+    n = len(links)
+    start = links['first'].to_numpy() + rng.integers(-2, 3, n)
+    end = np.maximum(start, links['last'].to_numpy() + rng.integers(-2, 3, n))
+    start = np.char.add(start.astype(str), '0101').astype(object)
+    end = np.char.add(end.astype(str), '1231').astype(object)
+    draw = rng.random(n)
+    start[draw < 0.3] = 'B'
+    start[(draw >= 0.3) & (draw < 0.33)] = '0'
+    draw = rng.random(n)
+    end[draw < 0.5] = 'E'
+    end[(draw >= 0.5) & (draw < 0.53)] = '0'
+    gvkey = links['gvkey'].astype(int).astype(np.float64).where(rng.random(n) >= 0.03)
+    return pd.DataFrame({'cik': links['cik'].astype(int), 'gvkey': gvkey,
+                         'source': rng.choice(['CIKGVKEY', 'SEC', 'COMPUSTAT'], n),
+                         'link_desc': rng.choice(['Primary', 'Secondary', 'Name match'], n),
+                         'sec_company_name': [f'COMPANY {i} INC' for i in range(n)],
+                         'link_company_name': [f'COMPANY {i} INC ' for i in range(n)],
+                         'link_start_date': ' ' + pd.Series(start) + ' ', 'link_end_date': pd.Series(end) + ' ',
+                         'N10K': rng.integers(0, 30, n)})
+
+def tenk_filings(funda, seed=0):
+    '''
+    One 10-K per firm-year with a CIK, received 60 to 120 days after the fiscal year end; 5% of firm-years file
+    an amendment as well.
+    '''
+    rng = np.random.default_rng(seed)
+    filers = funda.dropna(subset=['cik'])
+    filers = filers.loc[filers.index.repeat(np.where(rng.random(len(filers)) < 0.05, 2, 1))]
+    rdate = filers['datadate'] + pd.to_timedelta(rng.integers(60, 121, len(filers)), 'D')
+    return pd.DataFrame({'cik': filers['cik'].astype(int).to_numpy(), 'rdate': rdate.to_numpy(),
+                         'form': '10-K', 'year': rdate.dt.year.to_numpy()})
+
+def ccm_links(funda, seed=0):
+    '''
+    CCM link table merged to the firm-years (as compustat_crsp_link.csv): each firm has one or two securities
+    with consecutive link spells. The last spell is open ('E') for 60% of firms; 2% of start dates are missing.
+    '''
+    rng = np.random.default_rng(seed)
+    firms = funda.groupby('gvkey', sort=False).agg(first=('fyear', 'min'), last=('fyear', 'max')).reset_index()
+    spells = firms.loc[firms.index.repeat(rng.integers(1, 3, len(firms)))].reset_index(drop=True)
+    second = spells['gvkey'].duplicated().to_numpy() # the firm's second security
+    last = ~np.append(second[1:], False) # the firm's last spell
+    middle = ((spells['first'] + spells['last']) // 2).to_numpy()
+    start = np.where(second, middle + 1, spells['first'].to_numpy() - 1)
+    end = np.where(last, spells['last'].to_numpy() + 1, middle)
+    linkdt = (start * 10000 + 101).astype(float)
+    linkdt[rng.random(len(spells)) < 0.02] = np.nan
+    linkenddt = np.where(last & (rng.random(len(spells)) < 0.6), 'E', (end * 10000 + 1231).astype(str))
+    links = pd.DataFrame({'GVKEY': spells['gvkey'], 'permno': 10000 + np.arange(len(spells)),
+                          'permco': 20000 + spells.index // 2, 'LINKDT': linkdt, 'LINKENDDT': linkenddt})
+    return funda[['gvkey', 'datadate', 'fyear']].merge(links, left_on='gvkey', right_on='GVKEY').drop(columns='gvkey')
+
+def tenk_items(n_filings=500, seed=0):
+    '''
+    Extracted items of n_filings 10-Ks (link, item1, item1a, item7). About 10% of items are short or empty,
+    as with filings the extractor could not parse, so that clean_10ks flags them.
+    '''
+    rng = np.random.default_rng(seed)
+    items = {}
+    for i, item in enumerate(['item1', 'item1a', 'item7']):
+        docs = synthetic_10k(n_filings, seed=seed * 3 + i)
+        short = rng.random(n_filings) < 0.1
+        items[item] = [doc[:int(rng.integers(0, 5000))] if s else doc for doc, s in zip(docs, short)]
+    return pd.DataFrame({'link': [f'edgar/data/{1000 + i}/0000{i:06d}-00-000001.txt' for i in range(n_filings)],
+                         **items})
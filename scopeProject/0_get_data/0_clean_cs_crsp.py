@@ -17,7 +17,7 @@ Input: 'scopeProject/data/raw/compustat/compa_for_crspmerge.csv'; not included h
     **To download the first three input files from WRDS, run these two files from scopeProject/0_constructsample/download_files:
     extract_comp_and_crsp.sas and filter_CCM_links.sas in SAS Studio on WRDS.** 
 
-Output: 'scopeProject/data/processed/compustat/compustat_with_returns.csv'. Not included here. Will be used in forming the 
+Output: 'scopeProject/data/processed/compustat/compustat_with_returns.parquet'. Not included here. Will be used in forming the 
 final sample for analysis.
 '''
 
@@ -29,42 +29,41 @@ import re
 if __name__ == 'main':
     raw_data = su.get_data_path('raw_data_dir') # define paths
     processed = su.get_data_path('processed_data') 
+    output = processed / 'compustat/compustat_with_returns.parquet'
 
-    comp = pd.read_csv(raw_data / 'compustat/compa_for_crspmerge.csv')
+    # time, CPU and peak memory of each step go to a manifest next to the output (SCOPE_PROFILE=cprofile to profile)
+    run = su.Telemetry('0_clean_cs_crsp', manifest=processed / 'compustat/0_clean_cs_crsp.run.json')
+    run.begin('read compustat and link to CRSP')
 
-    ccm = pd.read_csv(raw_data / 'compustat/compustat_crsp_link.csv')
-    ccm = ccm[['GVKEY', 'permno', 'permco', 'LINKDT', 'LINKENDDT', 'datadate', 'fyear']]
-    ccm.columns = ['gvkey', 'permno', 'permco', 'linkdt', 'linenddt', 'datadate', 'fyear']
-    cs_with_link = pd.merge(comp, ccm, on=['gvkey', 'datadate', 'fyear'], how='left')
-
-    crsp = pd.read_csv(raw_data / 'crsp/crsp_monthly.csv')
-    crsp_str = crsp.groupby('PERMCO')['date'].min()
-    crsp_str = crsp_str.rename('crsp_first_date').reset_index()
+    # raw CSVs are converted to Parquet on first use (see scopeutils/io.py)
+    comp = su.read_table(raw_data / 'compustat/compa_for_crspmerge.csv', column_types={'cusip': 'string'})
 
-    crsp = pd.merge(crsp, crsp_str, on=['PERMCO'])
+    ccm = su.read_table(raw_data / 'compustat/compustat_crsp_link.csv',
+                        columns=['GVKEY', 'permno', 'permco', 'LINKDT', 'LINKENDDT', 'datadate', 'fyear'])
+    ccm.columns = ['gvkey', 'permno', 'permco', 'linkdt', 'linenddt', 'datadate', 'fyear']
+    # only keep a link if it is valid on the fiscal year end; B/E link dates (no bound) stay open-ended
+    ccm['linkdt'] = su.to_link_date(ccm['linkdt'])
+    ccm['linenddt'] = su.to_link_date(ccm['linenddt'])
+    cs_with_link = su.interval_join(comp.assign(link_date=su.to_link_date(comp['datadate']).values), ccm,
+                                    on=['gvkey', 'datadate', 'fyear'], date='link_date',
+                                    start='linkdt', end='linenddt', how='left')
+    cs_with_link = cs_with_link.drop(columns=['link_date'])
+
+    run.begin('read CRSP and compound returns', rows_in=len(cs_with_link))
+    crsp = su.read_table(raw_data / 'crsp/crsp_monthly.csv', columns=['PERMNO', 'PERMCO', 'date', 'ret'])
+    crsp['crsp_first_date'] = crsp.groupby('PERMCO')['date'].transform('min')
     crsp['date'] = pd.to_datetime(crsp['date'])
     crsp['year'] = crsp['date'].dt.year
     crsp['ret'] = crsp['ret'].replace([-66.0, -77.0, -88.0, -99.0], np.nan)
 
-    def calculate_annual_return(group):
-        # If any 'ret' is NaN, return NaN for the entire year
-        if group['ret'].isna().any():
-            return np.nan
-        # Otherwise, compute the cumulative return
-        return np.prod(1 + group['ret']) - 1
-
-    # Apply the function to each group
-    annual_returns = (
-        crsp[['PERMNO', 'date', 'ret', 'year', 'crsp_first_date']].sort_values(['PERMNO', 'date'])
-        .groupby(['PERMNO', 'year', 'crsp_first_date'])
-        .apply(calculate_annual_return)
-        .reset_index(name='ret')
-    )
+    # compound monthly returns within each permno-year; if any 'ret' is NaN, the year's return is NaN
+    annual_returns = su.annual_returns(crsp, keys=['PERMNO', 'crsp_first_date'])
     
     annual_returns.columns = ['permno', 'fyear', 'crsp_first_date', 'ret']
     cs_and_ret = pd.merge(cs_with_link, annual_returns, how='left')
 
     # calculate firm founding date
+    run.begin('founding dates and age', rows_in=len(cs_and_ret))
     # step 1: earliest Compustat observation
     comp_str = comp.groupby('gvkey')['datadate'].min()
     comp_str = pd.DataFrame(comp_str.rename('comp_first_date'))
@@ -107,4 +106,7 @@ if __name__ == 'main':
 
     # remove rows with missing assets or sales
     t = t[(~t['at'].isna()) & (~t['sale'].isna())]
-    t.to_csv(processed / 'compustat/compustat_with_returns.csv', index=False)
\ No newline at end of file
+    run.begin('write', rows_in=len(t))
+    su.write_table(t, output)
+    run.output(output)
+    run.close()
\ No newline at end of file
@@ -5,7 +5,7 @@ and finally merges to Compustat.
 **To be run on WRDS JupyterHub. The file paths will still work if you upload the project with its data directories
 to WRDS Cloud.**
 
-Input: 'scopeProject/data/processed/compustat_with_returns.csv'; not included here. Created from 0_clean_cs_crsp.py.
+Input: 'scopeProject/data/processed/compustat_with_returns.parquet'; not included here. Created from 0_clean_cs_crsp.py.
     'scopeProject/data/raw/compustat/WCIKLINK_GVKEY.csv'; not included here. List of CIK-GVKEY links from WRDS. GVKEY is
     Compustat's unique firm identifier, while CIK is the SEC's firm identifier (10Ks). The links are labeled with 
     start/end dates. 
@@ -13,7 +13,7 @@ Input: 'scopeProject/data/processed/compustat_with_returns.csv'; not included he
     **To download the CIK-GVKEY link file from WRDS, run this files from scopeProject/0_constructsample/download_files:
     extract_cikgvkey.sas in SAS Studio on WRDS.** 
 
-Output: 'scopeProject/data/processed/pre_retrieval/full5mil.csv'. Not included here. Will be used to extract 10k text.
+Output: 'scopeProject/data/processed/pre_retrieval/full5mil.parquet'. Not included here. Will be used to extract 10k text.
 
 '''
 
@@ -48,10 +48,10 @@ def get_10k_companies():
     return companies
 
 def clean_linkfile(df):
-    df['link_start_date'] = df['link_start_date'].str.strip().replace(['0'], np.NaN)
+    df['link_start_date'] = df['link_start_date'].str.strip().replace(['0'], np.nan)
     # 'B' means that the link dates before the sample's coverage period
     df['link_start_date'] = df['link_start_date'].str.strip().replace(['B'], '17000101') # arbitrarily early date for link start
-    df['link_end_date'] = df['link_end_date'].str.strip().replace(['0'], np.NaN)
+    df['link_end_date'] = df['link_end_date'].str.strip().replace(['0'], np.nan)
     # 'E' means that the link dates after the sample's coverage period
     df['link_end_date'] = df['link_end_date'].str.strip().replace(['E'], '22600101') # arbitrarily late date for link end
         
@@ -80,10 +80,10 @@ if __name__ == 'main':
     companies = get_10k_companies()
     cikgvkey = pd.read_csv(raw_data / 'compustat/WCIKLINK_GVKEY.csv', encoding='utf-8', encoding_errors='replace')
     cikgvkey = clean_linkfile(cikgvkey)
-    temp = pd.merge(companies, cikgvkey, on='cik')
-
-    # filter for valid links: record's date falls between the gvkey link's start/end dates
-    temp_filtered = temp.loc[(temp['rdate'] >= temp['DATADATE1']) & (temp['rdate'] <= temp['DATADATE2'])]
+    # keep valid links only: record's date falls between the gvkey link's start/end dates
+    # (links with an unknown start/end date, coded '0', are never valid)
+    cikgvkey = cikgvkey.dropna(subset=['DATADATE1', 'DATADATE2'])
+    temp_filtered = su.interval_join(companies, cikgvkey, on='cik', date='rdate', start='DATADATE1', end='DATADATE2')
     # drop duplicates
     dropped_dups = temp_filtered.drop_duplicates(subset=['cik', 'gvkey', 'rdate'])
 
@@ -96,7 +96,7 @@ if __name__ == 'main':
     trimmed = trimmed.rename(columns = {'year':'fyear'})
     trimmed['fyear'] = trimmed['fyear'].astype(int)
 
-    compa = pd.read_csv(processed / 'compustat/compustat_with_returns.csv')
+    compa = su.read_table(processed / 'compustat/compustat_with_returns.parquet')
     compa = read_comp(compa)
 
     pre_filter = pd.merge(trimmed, compa, on=['gvkey', 'fyear'])
@@ -105,4 +105,4 @@ if __name__ == 'main':
 
     f5mil = pre_filter[pre_filter['revt'] > 5]
 
-    f5mil.to_csv(processed / 'pre_retrieval/full5mil.csv', index=False)
\ No newline at end of file
+    su.write_table(f5mil, processed / 'pre_retrieval/full5mil.parquet')
\ No newline at end of file
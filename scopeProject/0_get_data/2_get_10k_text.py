@@ -1,15 +1,17 @@
 '''
 This file uses the SEC-API to scrape items 1, 1A, and 7 from 10K filings. It requires a paid subscription. 
-The code takes ~12 hours to run.
+Filings are fetched concurrently; run time is bounded by the API's rate limit (set 'rate' in get_10k).
 
-Input: 'scopeProject/data/processed/pre_retrieval/full5mil.csv'; not included here. This is a subsample of 
+Input: 'scopeProject/data/processed/pre_retrieval/full5mil.parquet'; not included here. This is a subsample of 
     Compustat Fundamentals Annual + CRSP returns + CIK-GVKEY link containing firm-year observations 
     where the firm's revenue ('revt') exceeded 5 million USD. 
 
-Intermediate files: 'scopeProject/data/raw/10k/extracted_text.parquet'; not included here. Gives extracted 
-    10K items for the firm-years from full5mil.csv. 
+Intermediate files: 'scopeProject/data/raw/10k/extracted_text_shards/'; not included here. Append-only
+    checkpoint of the extraction (Parquet shards keyed by link); delete it to start over.
+    'scopeProject/data/raw/10k/extracted_text.parquet'; not included here. Gives extracted 
+    10K items for the firm-years from full5mil.parquet. 
     'scopeProject/data/raw/10k/errors.csv'; not included here. Lists 10K links that threw an error when the
-    function attempted to scrape.
+    function attempted to scrape; rerunning this file tries them again.
 
 Output:'scopeProject/data/raw/10k/extracted_text_linked.parquet'; not included here. Gives cleaned and 
     extracted 10K items, with gvkey, fiscal year, firm name (from Compustat and SEC). 
@@ -17,66 +19,20 @@ Output:'scopeProject/data/raw/10k/extracted_text_linked.parquet'; not included h
 
 import scopeutils as su
 import pandas as pd
-import os
-from sec_api import ExtractorApi
 
 def get_10k(key, links):
     '''
     Use ExtractorApi (from SEC-API) to get items 1, 1a, and 7 from a list of 10K filing links.
+    Filings are fetched concurrently under the API's rate limit (see scopeutils/sec.py). Each finished filing is
+    checkpointed right away, so a crashed run picks up exactly where it stopped.
+    The text is compacted into extracted_text.parquet; returns the links that threw an error.
     '''
     linklist = links['fname'].unique() # list of unique 10K URLs
 
     raw_data = su.get_data_path('raw_data_dir') # load path
 
-    # Load existing results if available
-    if os.path.exists(raw_data / '10k/extracted_text.parquet'):
-        df = pd.read_parquet(raw_data / '10k/extracted_text.parquet')
-        item1s = df['item1'].tolist()
-        item1as = df['item1a'].tolist()
-        item7s = df['item7'].tolist()
-        start_idx = len(df)
-    else:
-        item1s = []
-        item1as = []
-        item7s = []
-        start_idx = 0
-    
-    if os.path.exists(raw_data / '10k/errors.csv'):
-        dfe = pd.read_csv(raw_data / '10k/errors.csv')
-        errors = dfe['link'].tolist()
-    else:
-        errors = []
-
-    total_iterations = len(linklist)
-    n = 1000  # Save every n iterations
-
-    extractorApi = ExtractorApi(key)
-
-    # Long computation loop
-    for i in range(start_idx, total_iterations):  # Start from where we left off
-        filing_10_k_url = 'https://www.sec.gov/Archives/' + linklist[i]
-        try:
-            item1 = extractorApi.get_section(filing_10_k_url, '1', 'text')
-            item1s.append(item1)
-            item7 = extractorApi.get_section(filing_10_k_url, '7', 'text')
-            item7s.append(item7)
-            item1a = extractorApi.get_section(filing_10_k_url, '1A', 'text')
-            item1as.append(item1a)
-        except:
-            errors.append(linklist[i])
-            item1s.append('error')
-            item7s.append('error')
-            item1as.append('error')
-
-        # Save every n-th iteration
-        if (i + 1) % n == 0:
-            pd.DataFrame({'link': linklist[0:(i+1)], 'item1': item1s, 'item1a': item1as, 'item7': item7s}).to_parquet(raw_data / '10k/extracted_text.parquet', index=False)
-            print(f"Saved results at iteration {i + 1}.")
-            pd.DataFrame({'link': errors}).to_csv(raw_data / '10k/errors.csv', index=False)
-
-    text = pd.DataFrame({'link': linklist, 'item1': item1s, 'item1a': item1as, 'item7': item7s})
-    errors = pd.DataFrame({'link': errors})
-    return text, errors
+    return su.extract_sections(linklist, key, checkpoint_path=raw_data / '10k/extracted_text_shards',
+                               output_path=raw_data / '10k/extracted_text.parquet', concurrency=16, rate=10)
 
 def clean_10ks(df):
     '''
@@ -106,14 +62,15 @@ if __name__ == 'main':
     raw_data = su.get_data_path('raw_data_dir') # define paths
     processed = su.get_data_path('processed_data') 
 
-    links = pd.read_csv(processed / 'pre_retrieval/full5mil.csv')
+    links = su.read_table(processed / 'pre_retrieval/full5mil.parquet')
     
     key = 'string' # insert sec-API key here
-    extracted, errors = get_10k(key, links)
-    extracted.to_parquet(raw_data / '10k/extracted_text.parquet', index=False) # intermediate save 
+    errors = get_10k(key, links) # intermediate save in extracted_text.parquet
     errors.to_csv(raw_data / '10k/errors.csv', index=False)
     print("Intermediate save completed.")
 
+    extracted = pd.read_parquet(raw_data / '10k/extracted_text.parquet')
+
     filtered = clean_10ks(extracted)
 
     fintext = pd.merge(links, filtered, on='fname') # add back compustat vars (name, gvkey, fyear, dates)
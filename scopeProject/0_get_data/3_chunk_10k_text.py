@@ -1,33 +1,59 @@
 '''
-This file chunks the 10K entries from 2_get_10k_text.py into 73 subfiles to be processed in parallel.
+This file splits the 10K entries from 2_get_10k_text.py into work units to be embedded in parallel.
 
 Input: 'scopeProject/data/raw/10k/extracted_text_linked.parquet'; not included here. Cleaned and 
     extracted 10K items, with gvkey, fiscal year, firm name (from Compustat and SEC). 
 
-Output: 'scopeProject/data/raw/10k/items1_a_7/' chunk0.parquet - chunk72.parquet. This is just
-    the input file chunked into 73 parts.
+Output: 'scopeProject/data/raw/10k/items1_a_7/' chunk0.parquet, chunk1.parquet, ... The input file split
+    into consecutive parts of about tokens_per_unit estimated tokens each.
+    'scopeProject/data/raw/10k/items1_a_7/units.json'; rows and estimated tokens of each part, used by the
+    embedding workers to balance and order their work.
 
-Note: I chose to allocate 1516 rows per file through experimenting on the Princeton della cluster
-and finding that this led to an acceptable trade-off. Too many rows per job -> lon[pg wait for
-sufficiently large individual node. Too few rows -> will hit constraint on maximum # of
-requested nodes.
+Note: parts used to hold a fixed 1516 rows each, tuned by hand on the Princeton della cluster. Embedding time
+follows the number of tokens, not rows (10-Ks vary in length by orders of magnitude), so parts are now cut by
+estimated tokens (about 4 characters per token for the items that get embedded). Since the embedding workers
+load the model once and pull parts from a shared queue, stealing from each other when they run out, parts can
+be small: the unit size only bounds the work lost when a worker is stopped mid-part.
 '''
 import scopeutils as su
 import pandas as pd 
 import numpy as np
 import pyarrow as pa
+import json
+
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(file, items=('item1', 'item1a', 'item7')):
+    '''
+    Rough token count per row of the items that get embedded, from their length in characters.
+    '''
+    chars = sum(file[item].fillna('').str.len().to_numpy() for item in items)
+    return np.ceil(chars / CHARS_PER_TOKEN).astype(np.int64)
 
 if __name__ == "main":
     raw_data = su.get_data_path('raw_data_dir') # load path
+    out = raw_data / '10k/items1_a_7'
+    out.mkdir(parents=True, exist_ok=True)
+    # time and memory of each step go to _units.json.manifest.json (SCOPE_PROFILE=cprofile to profile)
+    run = su.Telemetry('3_chunk_10k_text')
+    run.begin('read')
     file = pd.read_parquet(raw_data / '10k/extracted_text_linked.parquet')
 
-    rows_per_chunk = 1516
-    n_chunks = np.ceil(len(file)/rows_per_chunk)
+    tokens_per_unit = 5_000_000
+    run.begin('estimate tokens and split', rows_in=len(file))
+    tokens = estimate_tokens(file)
+    bounds = su.split_by_tokens(tokens, tokens_per_unit)
 
-    for i in range(n_chunks):
-        start = i * rows_per_chunk
-        end = min((i + 1) * rows_per_chunk, len(file))
-        if start >= len(file):
-            break  # no more rows to write
-        chunk = file.iloc[start:end]
-        chunk.to_parquet(raw_data / f'10k/items1_a_7/chunk{i}.parquet', index=False)
\ No newline at end of file
+    # parts of an earlier split would otherwise be embedded too
+    for old in out.glob('chunk*.parquet'):
+        old.unlink()
+    run.begin('write parts', rows_in=len(file))
+    units = {}
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        file.iloc[start:end].to_parquet(out / f'chunk{i}.parquet', index=False)
+        units[f'chunk{i}'] = {'rows': int(end - start), 'tokens': int(tokens[start:end].sum())}
+    with open(out / 'units.json', 'w') as f:
+        json.dump(units, f, indent=1)
+    run.output(out / 'units.json')
+    run.close()
+    print(f"{len(units)} parts, {tokens.sum() / len(units):,.0f} estimated tokens per part on average.")
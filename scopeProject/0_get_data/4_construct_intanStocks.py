@@ -12,8 +12,17 @@ Input: 'scopeProject/data/raw/compustat/funda.csv'; not included here. This is a
     founding dates from 1975 - 2024 (updated 2025 as of this writing).
     Download here: https://site.warrington.ufl.edu/ritter/files/founding-dates.pdf 
 
-Output: 'scopeProject/data/raw/epwIntans/intan_updated_2024.csv'. Contains columns 'gvkey', 'fyear' (fiscal 
+Output: 'scopeProject/data/raw/epwIntans/intan_updated_2024.parquet'. Contains columns 'gvkey', 'fyear' (fiscal 
 year), 'kcap_v2' (knowledge capital; cumulated R&D), and 'ocap_v2' (organizational capital; cumulated SG&A)
+    'scopeProject/data/raw/epwIntans/intan_state/'; the state of the last run (per-firm history hashes and the
+    growth rate tables), used by incremental runs.
+
+By default every run rebuilds all firms from scratch. With INTAN_INCREMENTAL=1 (and the state of an earlier run),
+a run reuses the earlier run's growth rates and only continues the stock recurrence: firms whose history is
+unchanged keep their stocks and only their new fiscal years are cumulated. Only that last step is incremental;
+cleaning, interpolation and the backfill of missing R&D and SG&A still run over the whole panel. Because the
+growth rates are not re-estimated, the output differs from a full rebuild; rebuild (e.g. once a year) to update
+them. The mode of each run is printed and recorded in the run manifest.
 '''
 
 import scopeUtils as su
@@ -35,13 +44,39 @@ gc.collect()  #release the space
 
 if __name__ == 'main':
     raw_data = su.get_data_path('raw_data_dir') # load path
-
-    funda = pd.read_csv(raw_data / 'compustat/funda.csv')
-    company = pd.read_csv( raw_data/ 'compustat/company.csv')
+    output = raw_data / 'epwIntans/intan_updated_2024.parquet'
+
+    # time, CPU and peak memory of each step below go to a manifest next to the output (and, while running, to
+    # 4_construct_intanStocks.run.json); set SCOPE_PROFILE=cprofile,tracemalloc to profile the steps as well
+    # Incremental mode (INTAN_INCREMENTAL=1, see above): reuse the growth rates saved by the last run and only
+    # cumulate new fiscal years (firms with restated history are recomputed in full)
+    state_path = raw_data / 'epwIntans/intan_state'
+    incremental = os.environ.get('INTAN_INCREMENTAL', '0') == '1'
+    if incremental and not (state_path.exists() and output.exists()):
+        print("INTAN_INCREMENTAL=1, but there is no earlier run to continue: rebuilding from scratch.")
+        incremental = False
+    mode = 'incremental' if incremental else 'full'
+    print(f"Intangible capital: {mode} run.")
+
+    run = su.Telemetry('4_construct_intanStocks', manifest=raw_data / 'epwIntans/4_construct_intanStocks.run.json',
+                       info={'mode': mode})
+    run.begin('read funda and company')
+    if incremental:
+        firms_state, growth = su.load_intangible_state(state_path)
+
+    # raw CSVs are converted to Parquet on first use (see scopeutils/io.py); only the columns used below are read.
+    # The Parquet copy is partitioned by fyear and does not keep the CSV's row order: funda is sorted below.
+    funda = su.read_table(raw_data / 'compustat/funda.csv',
+                          columns=['gvkey', 'datadate', 'fyear', 'indfmt', 'datafmt', 'sich', 'cusip', 'at', 'seq',
+                                   'xsga', 'xrd', 'rdip', 'cogs'],
+                          filters=[('indfmt', '==', 'INDL'), ('datafmt', '==', 'STD')],
+                          column_types={'cusip': 'string'})
+    company = su.read_table(raw_data / 'compustat/company.csv', columns=['gvkey', 'sic', 'ipodate'])
 
     funda=pd.merge(funda,company, how="left",on=["gvkey"]) 
 
     # cleaning
+    run.begin('clean', rows_in=len(funda))
     funda['sich']=np.where(np.isnan(funda.sich),funda.sic, funda.sich)
     funda['gvkey']=funda.gvkey.astype(int)
     funda=funda[funda.gvkey!=175650] # this firm has data issues
@@ -56,87 +91,30 @@ if __name__ == 'main':
     funda['atnan']=np.where(np.isnan(funda['at']),1,0)
 
     # Address missing SG&A
+    run.begin('interpolate xsga and xrd', rows_in=len(funda))
     # We set xsga, xrd, and rdip to zero when missing. 
     # For R&D and SG&A, we make exceptions in years when the firm’s assets are also missing. 
     # For these years, we interpolate these two variables using their nearest non-missing values. 
     # We use these interpolated values to compute capital stocks but not regressions’ dependent variables
     # for xsga, interpolate over all periods.
 
-    fxsga=[]
     funda=funda.reset_index(drop=True)
-    funda['indexl']=funda.index.values
-    for i in funda.gvkey.unique():
-        #gvkey==1065,1072, especially 1072 is a good example to check this for loop.
-        a=funda[funda.gvkey==i].copy()
-        a['xsgaf']=a.xsga
-        if a.atnan.sum()>=1:
-            for idx in a[(a.atnan==1)&np.isnan(a.xsga)].indexl:
-                idx2=a[a.indexl<=idx].xsga.last_valid_index()
-                if idx2 is None:
-                    b=np.nan
-                else:
-                    b=a[a.indexl==idx2].xsga.values
-                    distb=idx-idx2 ##need to make sure the index is continuous
-                    
-                idx3=a[a.indexl>idx].xsga.first_valid_index()
-                if idx3 is None:
-                    c=np.nan
-                else:
-                    c=a[a.indexl==idx3].xsga.values
-                    distc=idx3-idx
-                try:
-                    a['xsgaf']=np.where((a.indexl==idx)&(distb<=distc),b,a.xsgaf)
-                    a['xsgaf']=np.where((a.indexl==idx)&(np.isnan(a.xsgaf)),c,a.xsgaf)
-                except NameError:
-                    a['xsgaf']=np.where(a.indexl==idx,b,a.xsgaf)
-                    a['xsgaf']=np.where((a.indexl==idx)&(np.isnan(a.xsgaf)),c,a.xsgaf)                
-        else:
-            a=a
-        fxsga.extend(a.xsgaf)
-    funda['xsga']=fxsga  
+    #gvkey==1065,1072, especially 1072 is a good example to check this interpolation.
+    funda['xsga']=su.interpolate_nearest(funda.xsga, funda.gvkey, (funda.atnan==1)&np.isnan(funda.xsga))
 
     # Address missing R&D
     ##for xrd, interpolate after 1977
-    fxrd=[] 
     fundalater=funda[funda.fyear>=1977]
     funda=funda.drop(funda[funda.fyear>=1977].index)
     fundalater=fundalater.reset_index(drop=True)
-    fundalater['indexl']=fundalater.index.values
-    for i in fundalater.gvkey.unique():
-        
-        a=fundalater[fundalater.gvkey==i].copy()
-        a['xrdf']=a.xrd
-        if a.atnan.sum()>=1:
-            #idx=a[a.atnan==1].indexl.tail(1)
-            for idx in a[(a.atnan==1)&np.isnan(a.xrd)].indexl:
-                idx2=a[a.indexl<=idx].xrd.last_valid_index()
-                if idx2 is None:
-                    b=np.nan
-                else:
-                    b=a[a.indexl==idx2].xrd.values
-                    distb=idx-idx2
-                idx3=a[a.indexl>idx].xrd.first_valid_index()
-                if idx3 is None:
-                    c=np.nan
-                else:
-                    c=a[a.indexl==idx3].xrd.values
-                    distc=idx3-idx
-                try:
-                    a['xrdf']=np.where((a.indexl==idx)&(distb<=distc),b,a.xrdf)
-                    a['xrdf']=np.where((a.indexl==idx)&(np.isnan(a.xrdf)),c,a.xrdf)
-                except NameError:
-                    a['xrdf']=np.where(a.indexl==idx,b,a.xrdf)
-                    a['xrdf']=np.where((a.indexl==idx)&(np.isnan(a.xrdf)),c,a.xrdf)
-        else:
-            a=a
-        fxrd.extend(a.xrdf)
-    fundalater['xrd']=fxrd 
+    fundalater['xrd']=su.interpolate_nearest(fundalater.xrd, fundalater.gvkey, (fundalater.atnan==1)&np.isnan(fundalater.xrd))
     funda=pd.concat([funda,fundalater],ignore_index=True)
 
     funda=funda.sort_values(by=['gvkey','fyear'])
     funda=funda.reset_index(drop=True)
     funda['indexl']=funda.index.values
     ###We start in 1977 to give firms two years to comply with FASB’s 1975 R&D reporting requirement. If we see a firm with R&D equal to zero or missing in 1977, we assume the firm was typically not an R&D spender before 1977, so we set any missing R&D values before 1977 to zero. Otherwise, before 1977, we either interpolate between the most recent nonmissing R&D values (if such observations exist) or we use the method in Appendix A (if those observations do not exist). Starting in 1977, we make exceptions in cases in which the firm’s assets are also missing. These are likely years when the firm was privately owned. In such cases, we interpolate R&D values using the nearest non-missing values.
+    run.begin('xrd before 1977', rows_in=len(funda))
     def xrd1977(g):
         ##if 1977 xrd is 0, all previous is 0 or missing, make values before 1977 is also 0. 
         a=g[g.fyear==1977].xrd
@@ -173,67 +151,51 @@ if __name__ == 'main':
     funda['ageipo']=funda.fyear-funda.ipodate.dt.year
 
     # Calculate growth rates
+    run.begin('growth rates', rows_in=len(funda))
     #negative values exist, say gvkey=23978, year=1999
-    def step1(variablen):
-        growthrates=pd.DataFrame(columns=['grate'])
-        for i in range(1,int(funda.ageipo.max())+1):
-            a=funda[funda.ageipo==i]
-            b=funda[funda.ageipo==(i-1)]
-            c=pd.merge(a,b[['gvkey',variablen,'ageipo']],on=['gvkey'],how='left')
-            d=c[(c[variablen+'_x']>0)&(c[variablen+'_y']>0)]
-            growthrates.loc[i,'grate']=(np.log(d[variablen+'_x'])-np.log(d[variablen+'_y'])).mean()
-        return growthrates        
-    step1g_xsga=step1('xsga')
-    step1g_xrd=step1('xrd')
-    def step2(variablen):
-        growthrates=pd.DataFrame(columns=['grate'])
-        for i in range(1,3):
-            a=funda[funda.ageipo==(i-2)]
-            b=funda[funda.ageipo==(i-3)]
-            c=pd.merge(a,b[['gvkey',variablen,'ageipo']],on=['gvkey'],how='left')
-            d=c[(c[variablen+'_x']>0)&(c[variablen+'_y']>0)]
-            growthrates.loc[i,'grate']=(np.log(d[variablen+'_x'])-np.log(d[variablen+'_y'])).mean()
-        return growthrates   
-    step2g_xsga=step2('xsga').mean()
-    step2g_xrd=step2('xrd').mean()
+    if incremental:
+        # keep last run's growth rates so that unchanged firms keep the same imputed history (they are saved
+        # again as they are, so they are only re-estimated by a full run)
+        step1g_xsga=growth['step1g_xsga'].to_frame('grate')
+        step1g_xrd=growth['step1g_xrd'].to_frame('grate')
+        step2g_xsga=growth['step2g_xsga']
+        step2g_xrd=growth['step2g_xrd']
+    else:
+        def step1(variablen):
+            growthrates=pd.DataFrame(columns=['grate'])
+            for i in range(1,int(funda.ageipo.max())+1):
+                a=funda[funda.ageipo==i]
+                b=funda[funda.ageipo==(i-1)]
+                c=pd.merge(a,b[['gvkey',variablen,'ageipo']],on=['gvkey'],how='left')
+                d=c[(c[variablen+'_x']>0)&(c[variablen+'_y']>0)]
+                growthrates.loc[i,'grate']=(np.log(d[variablen+'_x'])-np.log(d[variablen+'_y'])).mean()
+            return growthrates        
+        step1g_xsga=step1('xsga')
+        step1g_xrd=step1('xrd')
+        def step2(variablen):
+            growthrates=pd.DataFrame(columns=['grate'])
+            for i in range(1,3):
+                a=funda[funda.ageipo==(i-2)]
+                b=funda[funda.ageipo==(i-3)]
+                c=pd.merge(a,b[['gvkey',variablen,'ageipo']],on=['gvkey'],how='left')
+                d=c[(c[variablen+'_x']>0)&(c[variablen+'_y']>0)]
+                growthrates.loc[i,'grate']=(np.log(d[variablen+'_x'])-np.log(d[variablen+'_y'])).mean()
+            return growthrates   
+        step2g_xsga=step2('xsga').grate.astype(float)
+        step2g_xrd=step2('xrd').grate.astype(float)
 
     # interpolating or filling missing R&D observations.
+    run.begin('fill and backfill xrd and xsga', rows_in=len(funda))
     funda=funda.sort_values(by=['gvkey','fyear'])
     funda=funda.reset_index(drop=True)
     funda['indexl']=funda.index.values
-    fxrd=[] 
-    fundabefore=funda[funda.fyear<=1977]
+    fundabefore=funda[funda.fyear<=1977].copy()
     funda=funda.drop(funda[funda.fyear<=1977].index)
 
-    for i in fundabefore.gvkey.unique():
-        g=fundabefore[fundabefore.gvkey==i].copy()
-        g['xrdf']=g.xrd
-        a=g[g.fyear==1977].xrd
-        if a.shape[0]!=0:
-            if a.values[0]>0:
-                for idx in g[np.isnan(g.xrd)].indexl:
-                    idx2=g[g.indexl<=idx].xrd.last_valid_index()
-                    if idx2 is None:
-                        b=np.nan
-                    else:
-                        b=g[g.indexl==idx2].xrd.values
-                        distb=idx-idx2
-                    idx3=g[g.indexl>idx].xrd.first_valid_index()
-                    if idx3 is None:
-                        c=np.nan
-                    else:
-                        c=g[g.indexl==idx3].xrd.values
-                    distc=idx3-idx
-                    try:
-                        g['xrdf']=np.where((g.indexl==idx)&(distb<=distc),b,g.xrdf)
-                        g['xrdf']=np.where((g.indexl==idx)&(np.isnan(g.xrdf)),c,g.xrdf)
-                    except NameError:
-                        g['xrdf']=np.where(g.indexl==idx,b,g.xrdf)
-                        g['xrdf']=np.where((g.indexl==idx)&(np.isnan(g.xrdf)),c,g.xrdf)          
-        else:
-            g=g
-        fxrd.extend(g.xrdf.values)
-    fundabefore['xrd']=fxrd 
+    # only firms with positive R&D in 1977 are interpolated; the rest are backfilled with growth rates below
+    xrd77=fundabefore[fundabefore.fyear==1977].drop_duplicates(subset=['gvkey']).set_index('gvkey').xrd
+    spender=fundabefore.gvkey.isin(xrd77[xrd77>0].index)
+    fundabefore['xrd']=su.interpolate_nearest(fundabefore.xrd, fundabefore.gvkey, spender&np.isnan(fundabefore.xrd))
     funda=pd.concat([funda,fundabefore],ignore_index=True)
 
     # Cumulate R&D
@@ -268,37 +230,12 @@ if __name__ == 'main':
     funda['logxsga']=np.where(funda.xsga>0,np.log(funda.xsga),funda.xsga)
     funda['logxrd']=np.where(funda.xrd>0,np.log(funda.xrd),funda.xrd)
 
-    c=[]
-    for i in funda.gvkey.unique():
-        #for negative xrd values, they are not transformed to log, but still use grate to add or subtract as grate is not that large.
-        g=funda[funda.gvkey==i]
-        a=g[np.isnan(g.xrd)].indexl
-        if a.shape[0]!=0:
-            for idx in sorted(a,reverse=True):#reverse makes idx start form the newest missing value
-                idx2=g[g.indexl>idx].xrd.first_valid_index()
-                b=g[g.indexl==idx2].logxrd.values-g[(g.indexl<=idx2) & (g.indexl>idx)].grate_x.sum()
-                g['logxrd']=np.where(g.indexl==idx,b,g.logxrd)
-        else:
-            g=g
-        c.extend(g.logxrd)
-    funda['logxrd']=c
-
-    c=[]
-    for i in funda.gvkey.unique():
-        #for negative xrd values, they are not transformed to log, but still use grate to add or subtract as grate is not that latge.
-        g=funda[funda.gvkey==i]
-        a=g[np.isnan(g.xsga)].indexl
-        if a.shape[0]!=0:
-            for idx in sorted(a,reverse=True):#reverse makes idx start form the newest missing value
-                idx2=g[g.indexl>idx].xsga.first_valid_index()
-                b=g[g.indexl==idx2].logxsga.values-g[(g.indexl<=idx2) & (g.indexl>idx)].grate_y.sum()
-                g['logxsga']=np.where(g.indexl==idx,b,g.logxsga)
-        else:
-            g=g
-        c.extend(g.logxsga)
-    funda['logxsga']=c
+    #for negative xrd values, they are not transformed to log, but still use grate to add or subtract as grate is not that large.
+    funda['logxrd']=su.backfill_log_growth(funda.logxrd, funda.grate_x, funda.gvkey)
+    funda['logxsga']=su.backfill_log_growth(funda.logxsga, funda.grate_y, funda.gvkey)
 
     # combine founding information
+    run.begin('founding dates', rows_in=len(funda))
     ftable = pd.read_excel('scopeProject/data/raw/ritterIPO/IPO-age.xlsx',usecols=['CUSIP', 'offer date','Founding'],dtype={'offer date':str,'CUSIP':str})
     ftable['Founding']=np.where(ftable.Founding==-99, np.nan, ftable.Founding)
     ftable['Founding']=np.where(ftable.Founding==-9, np.nan, ftable.Founding)
@@ -335,41 +272,13 @@ if __name__ == 'main':
     funda=funda.reset_index(drop=True)
     funda['indexl']=funda.index.values
 
-    funda['step2g_xrd']=step2g_xrd[0]
-    funda['step2g_xsga']=step2g_xsga[0]
+    funda['step2g_xrd']=step2g_xrd.mean()
+    funda['step2g_xsga']=step2g_xsga.mean()
     funda['firstcomp']=funda.groupby('gvkey',as_index=False).firstcomp.bfill()
     funda['ipodate']=funda.groupby('gvkey',as_index=False).ipodate.bfill()
 
-    c=[]
-    for i in funda.gvkey.unique():
-        g=funda[funda.gvkey==i]
-        a=g[np.isnan(g.logxrd)].indexl
-        if a.shape[0]!=0:
-            for idx in sorted(a,reverse=True):#reverse makes idx start form the newest missing value
-                idx2=g[g.indexl>idx].logxrd.first_valid_index()
-                if idx2 is not None:
-                    b=g[g.indexl==idx2].logxrd.values-g[(g.indexl<=idx2) & (g.indexl>idx)].step2g_xrd.sum()
-                    g['logxrd']=np.where(g.indexl==idx,b,g.logxrd)
-        else:
-            g=g
-        c.extend(g.logxrd)
-    funda['logxrd']=c
-
-    c=[]
-    for i in funda.gvkey.unique():
-        #for negative xrd values, they are not transformed to log, but still use grate to add or subtract as grate is not that latge.
-        g=funda[funda.gvkey==i]
-        a=g[np.isnan(g.logxsga)].indexl
-        if a.shape[0]!=0:
-            for idx in sorted(a,reverse=True):#reverse makes idx start form the newest missing value
-                idx2=g[g.indexl>idx].logxsga.first_valid_index()
-                if idx2 is not None:
-                    b=g[g.indexl==idx2].logxsga.values-g[(g.indexl<=idx2) & (g.indexl>idx)].step2g_xsga.sum()
-                    g['logxsga']=np.where(g.indexl==idx,b,g.logxsga)
-        else:
-            g=g
-        c.extend(g.logxsga)
-    funda['logxsga']=c
+    funda['logxrd']=su.backfill_log_growth(funda.logxrd, funda.step2g_xrd, funda.gvkey)
+    funda['logxsga']=su.backfill_log_growth(funda.logxsga, funda.step2g_xsga, funda.gvkey)
 
     funda['logxsga']=funda.logxsga.astype('float')
     funda['xsga']=np.where(~(funda.xsga<0),np.exp(funda.logxsga),funda.xsga)
@@ -378,6 +287,7 @@ if __name__ == 'main':
     funda=funda.sort_values(by=['gvkey','fyear','count'],ascending=True,na_position='first').drop_duplicates(subset=['fyear','gvkey'],keep='last')
 
     ##parameters for d_{XRD} from Ewens   
+    run.begin('cumulate capital', rows_in=len(funda))
     sicg1=[3714,3716,3750,3751,3792,4813,4812,4841,4833,4832]+list(range(100,1000))+list(range(2000,2400))+list(range(2700,2750))+list(range(2770,2800))+list(range(3100,3200))+list(range(3940,3990))+list(range(2500,2520))+list(range(2590,2600))+list(range(3630,3660))+list(range(3710,3712))+list(range(3900,3940))+list(range(3990,4000))+list(range(5000,6000))+list(range(7200,7300))+list(range(7600,7700))+list(range(8000,8100))
     sicg2=list(range(2520,2590))+list(range(2600,2700))+list(range(2750,2770))+list(range(2800,2830))+list(range(2840,2900))+list(range(3000,3100))+list(range(3200,3570))+list(range(3580,3622))+list(range(3623,3630))+list(range(3700,3710))+list(range(3712,3714))+list(range(3715,3716))+list(range(3717,3750))+list(range(3752,3792))+list(range(3793,3800))+list(range(3860,3900))+list(range(1200,1400))+list(range(2900,3000))+list(range(4900,4950))
     sicg3=[3622,7391]+list(range(3570,3580))+list(range(3660,3693))+list(range(3694,3700))+list(range(3810,3840))+list(range(7370,7380))+list(range(8730,8735))+list(range(4800,4900))
@@ -396,95 +306,19 @@ if __name__ == 'main':
     funda['kcap_v2']=0
     funda['ocap_v2']=0
 
-    def genkcap_single(group):
-        """Calculate knowledge capital for a single company group"""
-        result = group.copy()
-        n = len(result)
-        for i in range(1, n):
-            result.iloc[i, 0] = result.iloc[i-1, 0] * (1 - result.iloc[i, 1]) + result.iloc[i, 2]
-        return result
-
-    def genocap_single(group):
-        """Calculate organizational capital for a single company group"""
-        result = group.copy()
-        n = len(result)
-        for i in range(1, n):
-            result.iloc[i, 0] = result.iloc[i-1, 0] * 0.8 + result.iloc[i, 2] * result.iloc[i, 1]
-        return result
-
-    def process_batch(gvkeys_batch, funda):
-        """Process a batch of gvkeys to calculate kcap and ocap"""
-        result_df = pd.DataFrame()
-        
-        for gvkey in gvkeys_batch:
-            # Extract company data
-            company_data = funda[funda['gvkey'] == gvkey].copy()
-            
-            if len(company_data) > 0:
-                # Knowledge capital calculation
-                k_data = company_data[['kcap_v2', 'theta_g2', 'xrd']].copy()
-                k_result = genkcap_single(k_data)
-                company_data['kcap_v2'] = k_result['kcap_v2']
-                
-                # Organizational capital calculation
-                o_data = company_data[['ocap_v2', 'gamma_o2', 'xsga']].copy()
-                o_result = genocap_single(o_data)
-                company_data['ocap_v2'] = o_result['ocap_v2']
-                
-                # Keep only relevant columns for the final result
-                result_df = pd.concat([result_df, company_data[['gvkey', 'fyear', 'kcap_v2', 'ocap_v2']]])
-        
-        return result_df
-
-    def calculate_intangible_capital_batched(funda, batch_size=500, max_workers=4):
-        """
-        Calculate intangible capital using batched processing
-        
-        Parameters:
-        - funda: DataFrame with the required columns
-        - batch_size: Number of companies to process in each batch
-        - max_workers: Number of parallel workers (careful with memory usage)
-        
-        Returns:
-        - Updated DataFrame with calculated kcap_v2 and ocap_v2
-        """
-        # Ensure required columns exist
-        if not all(col in funda.columns for col in ['gvkey', 'kcap_v2', 'ocap_v2', 'theta_g2', 'gamma_o2', 'xrd', 'xsga']):
-            raise ValueError("Missing required columns in the input DataFrame")
-        
-        # Get unique companies
-        unique_gvkeys = funda['gvkey'].unique()
-        total_companies = len(unique_gvkeys)
-        print(f"Processing {total_companies} companies in batches of {batch_size}")
-        
-        # Split into batches
-        batches = [unique_gvkeys[i:i + batch_size] for i in range(0, total_companies, batch_size)]
-        
-        results = []
-
-        for batch_idx, gvkeys_batch in enumerate(tqdm(batches, desc="Processing company batches")):
-            batch_result = process_batch(gvkeys_batch, funda)
-            results.append(batch_result)
-        
-        # Combine results
-        result_df = pd.concat(results, ignore_index=True)
-        
-        # Merge results back to original dataframe
-        funda_result = funda.drop(['kcap_v2', 'ocap_v2'], axis=1)
-        funda_result = pd.merge(
-            funda_result, 
-            result_df[['gvkey', 'fyear', 'kcap_v2', 'ocap_v2']], 
-            on=['gvkey', 'fyear'],
-            how='left'
-        )
-        
-        return funda_result
-    
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore', category=FutureWarning)
-        funda = calculate_intangible_capital_batched(funda, batch_size=200)
-    
+    # cumulate R&D and SG&A within each firm (see scopeutils/intangibles.py)
+    if incremental:
+        previous = su.read_table(output)
+        funda = su.update_intangible_capital(funda, previous, firms_state, batch_size=2000, max_workers=os.cpu_count())
+    else:
+        funda = su.calculate_intangible_capital(funda, batch_size=2000, max_workers=os.cpu_count())
+    su.save_intangible_state(state_path, funda, {'step1g_xsga': step1g_xsga.grate, 'step1g_xrd': step1g_xrd.grate,
+                                                 'step2g_xsga': step2g_xsga, 'step2g_xrd': step2g_xrd})
+
     funda=funda[funda['count']>=0]
     tokeep=funda[['gvkey','fyear','kcap_v2','ocap_v2']]
 
-    tokeep.to_csv('scopeProject/data/raw/epwIntans/intan_updated_2024.csv', index=False)
\ No newline at end of file
+    run.begin('write', rows_in=len(tokeep))
+    su.write_table(tokeep, output)
+    run.output(output)
+    run.close()
\ No newline at end of file
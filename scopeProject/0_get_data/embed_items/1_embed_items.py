@@ -1,12 +1,28 @@
 '''
 This file embeds 10K text in parallel jobs.
 
-Input: 'scopeProject/data/raw/10k/items1_a_7/chunk0.parquet' to '.../chunk72.parquet'; not included here. 
-    Cleaned and extracted 10K items, with gvkey, fiscal year, firm name (from Compustat and SEC), divided 
-    into 73 parts.
+Input: 'scopeProject/data/raw/10k/items1_a_7/chunk0.parquet', 'chunk1.parquet', ...; not included here. 
+    Cleaned and extracted 10K items, with gvkey, fiscal year, firm name (from Compustat and SEC), split
+    by estimated tokens in 3_chunk_10k_text.py, and units.json with the estimated tokens of each part.
 
-Output: 'scopeProject/data/processed/embedded/items1_a_7/chunk0.parquet' to '.../chunk72.parquet'; embedded 
-    versions of the iput.
+Output: 'scopeProject/data/processed/embedded/items1_a_7/chunk0.parquet', 'chunk1.parquet', ...; embedded 
+    versions of the iput, with document vectors for the full text (embfull) and for items 1, 1A, and 7 (emb1, 
+    emb1a, emb7). The vectors are stored as float16; read them with su.load_vectors.
+    'scopeProject/data/processed/embedding_cache/'; chunk embeddings keyed by chunk text, shared by all jobs, so
+    boilerplate paragraphs and item1 (which is also part of text) are only embedded once; one cache per model
+    and backend (e.g. UAE-Large-V1-torch, UAE-Large-V1-onnx).
+    'scopeProject/data/processed/embedded/queue/'; job queue with one job per input file, and a completion
+    record (worker, run time, rows, tokens per second) for each finished file; under workers/, the time and
+    memory each worker spent loading the model and on each file.
+    '.../items1_a_7/_chunk0.parquet.manifest.json', ...; time, CPU, peak memory and bytes read/written of each file.
+
+Each run of this file is a worker: it adds any new input files to the queue, loads the model once per GPU (or
+once on CPU-only nodes), and keeps pulling files from the queue until none are left. Files are claimed through
+lock files in the queue. Each worker of a SLURM array starts with its own share of the files, balanced by
+estimated tokens, largest first, and steals unclaimed files from the others once it is through. Workers can be
+started or stopped at any time; a file left unfinished by a stopped worker is picked up again by another one.
+Reruns only embed files that are not done yet, or whose input was rewritten; jobs and outputs of files that
+3_chunk_10k_text.py no longer writes are removed (start new runs only once the workers of the last one stopped).
 
 Run this file on an HPC cluster using the other file in this folder, emb_items.slurm.
 '''
@@ -17,93 +33,109 @@ import scopeutils as su
 import pandas as pd
 import os
 import sys
+import json
 import re
 import time
 from itertools import islice
 import datetime
-import torch.multiprocessing as mp
-from functools import partial
-from sentence_transformers import SentenceTransformer, util, LoggingHandler
-
-if __name__ == "__main__": 
-    idx = int(os.environ["SLURM_ARRAY_TASK_ID"])
-    
-    # Specify the directory
-    raw_data = su.get_data_path('raw_data_dir') # load paths
-    processed_data = su.get_data_path('processed_data')
+import multiprocessing as mp
 
-    infiles = os.listdir(raw_data / '10k/items1_a_7')
-    # remove files if they're already in the list of processed files.
+# EMBED_BACKEND=onnx runs an int8-quantized ONNX export of the model on CPU-only nodes (onnx-fp32: not quantized);
+# torch is only imported by the torch backend
+backend = os.environ.get('EMBED_BACKEND', 'torch')
 
-    outfiles = os.listdir(processed_data / 'embedded/items1_a_7')
-    touse = [file for file in infiles if file not in outfiles]
-    
-    files = [os.path.join(raw_data / '10k/items1_a_7', file) for file in touse]
-    
-    # Sort the files by creation date
-    files = sorted(files, key=os.path.getctime)
-    
-    name = re.search(r'items1_a_7/(.*)',files[idx]).group(1)
-    raw = pd.read_parquet(os.path.join(directory, name))
+def n_workers():
+    '''
+    One worker process per GPU; a single worker using all CPUs on CPU-only nodes or with the ONNX backend.
+    '''
+    if backend != 'torch':
+        return 1
+    import torch
+    return max(torch.cuda.device_count(), 1)
 
-    # since we embed 'text' and 'item1', 
-    # require that each item have length > 0.
-    raw = raw[raw['text'].apply(len) > 0]
-    raw = raw[raw['item1'].apply(len) > 0]
-    
-    mp.set_start_method('spawn', force=True)
+def include_items(table, out_col):
+    '''
+    Items that make up 'text' in each row, following clean_10ks: when item 1 is present,
+    items 1A and 7 are left out if they are flagged missing.
+    '''
+    if out_col != 'embfull':
+        return {}
+    na = {item: table.column(item + '_na').to_numpy() == 1 for item in ('item1', 'item1a', 'item7')}
+    return {'item1a': na['item1'] | ~na['item1a'], 'item7': na['item1'] | ~na['item7']}
 
-    # I have to define these functions inside the __name__ guard
-    # so that, as the file goes through SLURM,
-    # we only spawn a multiprocessing pool right before we need
-    # to use it (we don't want to trigger cascading processes)
+def make_handler(rank):
+    '''
+    Load the model once for this worker (onto GPU number rank, if there are GPUs) and return the function that
+    embeds one queued file.
+    '''
+    processed_data = su.get_data_path('processed_data')
+    # model loading and every file this worker embeds, kept up to date while the worker runs
+    worker = su.Telemetry(f'1_embed_items worker {rank}',
+                          manifest=processed_data / f'embedded/queue/workers/{su.worker_name(rank)}.json')
+    worker.begin('load model')
+    mpath = su.get_data_path('model_dir')
+    cpus = max(mp.cpu_count() // n_workers(), 1)
+    if backend == 'torch':
+        import torch
+        model = su.load_encoder(mpath, backend, device=f'cuda:{rank}' if torch.cuda.is_available() else 'cpu')
+    else:
+        model = su.load_encoder(mpath, backend, threads=cpus)
+    # vectors of the backends differ slightly (int8 most), so each backend has its own cache entries
+    cache = su.EmbeddingCache(processed_data / 'embedding_cache', f'{mpath.name}-{backend}',
+                              model.get_sentence_embedding_dimension())
+    # chunks follow the model's token limit (minus [CLS] and [SEP]), counted with its own tokenizer
+    chunker = su.Chunker(max_tokens=int(model.max_seq_length) - 2, tokenizer=mpath, processes=cpus)
+    worker.end()
 
-    def process_series(series, max):
+    def embed_file(job):
         '''
-        Take a Pandas column (string type) and convert each string into a list of the string's constituent
-        paragraphs (or sentences, if the paragraph length exceed the max).
+        Stream one file: rows are read, chunked, embedded, averaged and written a batch at a time,
+        so memory does not grow with the number of rows in the file.
+        Each item is chunked and embedded once; 'embfull' (the full text) is pooled from the chunks of its items,
+        so the per-item vectors come almost for free. Chunks are batched by token length under a padded-token
+        budget. Since we embed 'text' and 'item1', rows where either is empty are dropped.
         '''
-        num_processes = mp.cpu_count()
-        chunk_text_partial = partial(chunk_text, max=max)
-        with mp.Pool(num_processes) as first_pool:
-            return first_pool.map(chunk_text_partial, series)
+        bucketed = su.BucketedEncoder(lambda texts: model.encode(texts, batch_size=len(texts), normalize_embeddings=True),
+                                      chunker.count_tokens, max_length=int(model.max_seq_length))
+        # time, CPU and peak memory of the file go to _<dest>.manifest.json (SCOPE_PROFILE=cprofile to profile)
+        run = su.Telemetry('1_embed_items')
+        with worker.step(job['id']), run.step('embed') as step:
+            rows = su.embed_parquet(job['src'], job['dest'],
+                                    {'embfull': ['item1', 'item1a', 'item7'], 'emb1': 'item1', 'emb1a': 'item1a', 'emb7': 'item7'},
+                                    lambda texts: su.encode_cached(texts, cache, bucketed), model.get_sentence_embedding_dimension(),
+                                    chunker, vector_format='float16', required=['text', 'item1'], include=include_items)
+            step.rows_out = rows
+            step.output(job['dest'])
+        run.close()
+        report = bucketed.report()
+        print(f"{job['id']}: {rows} rows. Padding efficiency {report['padding_efficiency']:.1%} "
+              f"(fixed batches in document order: {report['baseline_padding_efficiency']:.1%}).")
+        return {'rows': rows, 'chunks_encoded': report['texts'], 'padding_efficiency': report['padding_efficiency']}
 
-    def embed_series(series, model):
-        num_processes = mp.cpu_count()
-        maximum = int(model.max_seq_length)
-        maximum = max(maximum, 1024) # I think I added this limit because the cluster runs out of memory
-        chunks = process_series(series, maximum) # cut text into para- or sentence-size chunks
-        chunks = [[item for item in sublist if re.search(r'\S', item)] for sublist in chunks] # cut out non-sentences
-        
-        # embed the chunks
-        tokens_list = [item for sublist in chunks for item in sublist]
-        pool = model.start_multi_process_pool()
-        embdescs = model.encode_multi_process(tokens_list, pool, normalize_embeddings=True).tolist() #, batch_size=8, precision='int8').tolist()
-        model.stop_multi_process_pool(pool)
-    
-        # reconstitute list of lists
-        nchunks = [len(list) for list in chunks]
-            
-        embdescs_list = []
-        start = 0
-        for n in nchunks:
-            embdescs_list.append(embdescs[start:start+n])
-            start += n
-                    
-        # calculate weighted average embeddings 
-        chunk_lens = [[len(piece) for piece in lst] for lst in chunks]
-                    
-        args = list(zip(embdescs_list, chunk_lens))
-    
-        with mp.Pool(num_processes) as last_pool:
-            embs =  last_pool.starmap(avg_embed_vecs, args)
-        return embs
-    
-    mpath = su.get_data_path('model_dir')
-    model = SentenceTransformer(mpath) 
+    return embed_file
+
+if __name__ == "__main__": 
+    # Specify the directory
+    raw_data = su.get_data_path('raw_data_dir') # load paths
+    processed_data = su.get_data_path('processed_data')
+
+    # one job per input file, with its estimated tokens; files that are already queued (or done) are not
+    # added again, unless they were rewritten since or are now embedded with another backend
+    queue = su.JobQueue(processed_data / 'embedded/queue')
+    with open(raw_data / '10k/items1_a_7/units.json') as f:
+        units = json.load(f)
+    for name, unit in units.items():
+        src = raw_data / '10k/items1_a_7' / f'{name}.parquet'
+        queue.add(name, src=str(src), dest=str(processed_data / 'embedded/items1_a_7' / f'{name}.parquet'),
+                  tokens=unit['tokens'], source=su.file_fingerprint(src), backend=backend)
+    # a re-split into fewer files leaves jobs and outputs without a source; their firm-years are in the new
+    # files, so the old outputs would duplicate them for every reader of the folder
+    queue.prune(units)
+    for output in (processed_data / 'embedded/items1_a_7').glob('*chunk*.parquet*'): # shards and their manifests
+        if output.name.lstrip('_').split('.')[0] not in units:
+            output.unlink()
 
-    raw['embfull'] = embed_series(raw['text'], model)
-    raw['emb1'] = embed_series(raw['item1'], model)
-    raw.reset_index(drop=True)
-    
-    raw.to_parquet(processed_data / f'embedded/items1_a_7/{name}.parquet', compression='zstd')
\ No newline at end of file
+    # long-lived workers keep the model warm and pull files until the queue is empty
+    su.serve(queue, make_handler, processes=n_workers(), task=int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)),
+             tasks=int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1)))
+    print(queue.status())
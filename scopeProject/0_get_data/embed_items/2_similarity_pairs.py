@@ -0,0 +1,26 @@
+'''
+This file computes, for every fiscal year, the cosine similarity between the 10K vectors of every pair of firms,
+and keeps each firm's closest peers, for the scope and competitor measures.
+
+Input: 'scopeProject/data/processed/embedded/items1_a_7/'; the embedded shards from 1_embed_items.py, with
+    gvkey, fiscal year and the document vectors (embfull, emb1, emb1a, emb7).
+
+Output: 'scopeProject/data/processed/similarity/embfull_top100/'; Parquet edge list partitioned by fiscal year
+    (fyear=1994/part-0.parquet, ...), with columns gvkey, peer_gvkey, similarity and rank (1 = closest peer).
+    Each firm's 100 most similar firms in the same year.
+
+The similarity matrix of a year (about 5,000 x 5,000) is never held in memory: it is computed in tiles, each one
+matrix product, and only the running top 100 per firm is kept. Years run in parallel, one BLAS thread per
+process by default. Years that are already written are skipped, so the file can be rerun after an interruption.
+'''
+import scopeutils as su
+import os
+
+if __name__ == "__main__":
+    processed_data = su.get_data_path('processed_data') # load paths
+    cpus = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
+
+    for column in ['embfull', 'emb1']:
+        written = su.similarity_pairs(processed_data / 'embedded/items1_a_7', processed_data / f'similarity/{column}_top100',
+                                      column=column, k=100, processes=cpus, threads=1)
+        print(f"{column}: {len(written)} years, {sum(written.values()):,} pairs written.")
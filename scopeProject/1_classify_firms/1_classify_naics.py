@@ -0,0 +1,53 @@
+'''
+This file classifies every firm-year into NAICS industries from its 10K text, by comparing the embedded 10K
+with embedded descriptions of each industry.
+
+Input: 'scopeProject/data/raw/naics/2022_NAICS_Descriptions.xlsx'; not included here. The Census Bureau's
+    NAICS titles and descriptions (columns Code, Title, Description).
+    Download here: https://www.census.gov/naics/?48967
+    'scopeProject/data/processed/embedded/items1_a_7/'; the embedded shards from 0_get_data/embed_items.
+
+Output: 'scopeProject/data/processed/naics_anchors/naics3.parquet'; the embedded industry descriptions (the
+    "anchors"), computed once with the same model (UAE-Large-V1) and backend (EMBED_BACKEND) as the 10Ks, and
+    reused until the descriptions, model or backend change.
+    'scopeProject/data/processed/classified/naics3/chunk0.parquet', ...; one file per embedded shard with
+    gvkey, fyear, the 5 closest 3-digit NAICS industries (industry1-industry5) and their cosine scores
+    (score1-score5), and scope, the number of industries within 0.02 of the best score.
+
+Firms are classified on their business description (item 1, emb1), which is what NAICS describes. Each shard is
+scored against all anchors in one matrix product, so the whole panel takes minutes on CPU; only the anchors
+(about 100 texts) need the model.
+'''
+import scopeutils as su
+import pandas as pd
+import os
+
+level = 3 # digits of the NAICS codes, as naics3 in 1_cik_gvkey_link.py
+k = 5
+
+if __name__ == "__main__":
+    raw_data = su.get_data_path('raw_data_dir') # load paths
+    processed_data = su.get_data_path('processed_data')
+    mpath = su.get_data_path('model_dir')
+
+    naics = pd.read_excel(raw_data / 'naics/2022_NAICS_Descriptions.xlsx', dtype={'Code': str})
+    naics = naics[naics['Code'].str.fullmatch(rf'\d{{{level}}}')] # sectors such as 31-33 only exist at 2 digits
+    # titles carry a trailing 'T' (trilateral US/Canada/Mexico code) in the Census file
+    titles = naics['Title'].str.strip().str.removesuffix('T').str.strip()
+    texts = (titles + '. ' + naics['Description'].fillna('').str.strip()).tolist()
+
+    backend = os.environ.get('EMBED_BACKEND', 'torch') # as in 1_embed_items.py
+    model = su.load_encoder(mpath, backend)
+    codes, anchors = su.industry_anchors(naics['Code'], texts,
+                                         lambda texts: model.encode(texts, batch_size=32, normalize_embeddings=True),
+                                         processed_data / f'naics_anchors/naics{level}.parquet', f'{mpath.name}-{backend}')
+
+    shards = sorted((processed_data / 'embedded/items1_a_7').glob('*.parquet'))
+    for stale in set((processed_data / f'classified/naics{level}').glob('*.parquet')) - \
+            {processed_data / f'classified/naics{level}' / shard.name for shard in shards}:
+        stale.unlink() # shards removed by a re-split of the 10Ks
+    rows = 0
+    for shard in shards:
+        rows += su.classify_parquet(shard, processed_data / f'classified/naics{level}' / shard.name, 'emb1',
+                                    codes, anchors, k=k)
+    print(f"Classified {rows} firm-years from {len(shards)} shards into {len(codes)} industries.")
@@ -10,5 +10,16 @@ from pathlib import Path # for importing file paths
 # Import your own modules
 from .config import get_config_path, load_config, get_data_path
 from .embed import *
+from .intangibles import *
+from .io import *
+from .returns import *
+from .link import *
+from .sec import *
+from .backend import *
+from .jobs import *
+from .index import *
+from .similarity import *
+from .classify import *
+from .telemetry import *
 
 # print("scopeUtils loaded with all dependencies!")
\ No newline at end of file
@@ -0,0 +1,132 @@
+import numpy as np
+import json
+import os
+from pathlib import Path
+
+def _cpu_threads():
+    '''
+    CPUs allotted to this job: SLURM_CPUS_PER_TASK on the cluster, otherwise all of the machine's CPUs.
+    '''
+    return int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))
+
+def export_onnx(model_path, quantize=True, opset=17):
+    '''
+    Export the transformer of a local sentence-transformers model (e.g. scopeProject/UAE-Large-V1) to ONNX, in
+    model_path/onnx/model.onnx, and, with quantize, also a copy with dynamic int8 quantization of the MatMul
+    weights (per channel), model_path/onnx/model_int8.onnx. Files that already exist are reused.
+    Needs torch and transformers to export and onnxruntime to quantize; only onnxruntime is needed afterwards.
+    Returns the path of the model to run.
+    '''
+    model_path = Path(model_path)
+    out = model_path / 'onnx'
+    out.mkdir(exist_ok=True)
+    fp32 = out / 'model.onnx'
+    int8 = out / 'model_int8.onnx'
+
+    if not fp32.exists():
+        import torch
+        from transformers import AutoModel
+        model = AutoModel.from_pretrained(model_path).eval()
+        dummy = torch.ones((1, 8), dtype=torch.long)
+        names = ['input_ids', 'attention_mask', 'token_type_ids']
+        axes = {name: {0: 'batch', 1: 'sequence'} for name in names + ['last_hidden_state']}
+        tmp = out / 'model.onnx.tmp'
+        with torch.no_grad():
+            torch.onnx.export(model, (dummy, dummy, torch.zeros_like(dummy)), tmp, input_names=names,
+                              output_names=['last_hidden_state'], dynamic_axes=axes, opset_version=opset,
+                              do_constant_folding=True)
+        os.replace(tmp, fp32)
+
+    if not quantize:
+        return fp32
+    if not int8.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp = out / 'model_int8.onnx.tmp'
+        quantize_dynamic(fp32, tmp, weight_type=QuantType.QInt8, per_channel=True, op_types_to_quantize=['MatMul'])
+        os.replace(tmp, int8)
+    return int8
+
+class OnnxEncoder:
+    '''
+    CPU encoder running an exported model (export_onnx) with ONNX Runtime. It mirrors the parts of
+    SentenceTransformer the pipeline uses (encode, max_seq_length, get_sentence_embedding_dimension), so it can
+    replace it: the same tokenizer (tokenizer.json), truncation at max_seq_length, and the pooling of
+    1_Pooling/config.json (CLS token for UAE-Large-V1, or mean).
+
+    threads sets ONNX Runtime's intra-op threads (by default the CPUs of the SLURM task); inter-op parallelism is
+    off, since one batch runs at a time.
+    '''
+    def __init__(self, model_path, quantized=True, threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        model_path = Path(model_path)
+        with open(model_path / 'sentence_bert_config.json') as f:
+            self.max_seq_length = json.load(f)['max_seq_length']
+        with open(model_path / '1_Pooling/config.json') as f:
+            pooling = json.load(f)
+        self.dim = pooling['word_embedding_dimension']
+        self.pooling = 'cls' if pooling.get('pooling_mode_cls_token') else 'mean'
+
+        self.tokenizer = Tokenizer.from_file(str(model_path / 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token='[PAD]')
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or _cpu_threads()
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(export_onnx(model_path, quantize=quantized)), options,
+                                            providers=['CPUExecutionProvider'])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        '''
+        Embed a list of texts in batches of batch_size; returns a float32 (n, dim) array.
+        '''
+        sentences = list(sentences)
+        out = np.empty((len(sentences), self.dim), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            encodings = self.tokenizer.encode_batch(sentences[start:start + batch_size])
+            feed = {'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                    'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                    'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64)}
+            hidden = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+            if self.pooling == 'cls':
+                vectors = hidden[:, 0]
+            else:
+                mask = feed['attention_mask'][:, :, None]
+                vectors = (hidden * mask).sum(axis=1) / mask.sum(axis=1)
+            out[start:start + len(encodings)] = vectors
+        if normalize_embeddings:
+            out /= np.linalg.norm(out, axis=1, keepdims=True)
+        return out
+
+def load_encoder(model_path, backend='torch', **kwargs):
+    '''
+    The embedding model for a backend:
+    - 'torch': SentenceTransformer (GPU when available)
+    - 'onnx': OnnxEncoder on the int8-quantized export, for CPU-only nodes
+    - 'onnx-fp32': OnnxEncoder without quantization
+    Extra keyword arguments go to SentenceTransformer (e.g. device) or OnnxEncoder (e.g. threads).
+    '''
+    if backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(str(model_path), **kwargs)
+    if backend in ('onnx', 'onnx-fp32'):
+        return OnnxEncoder(model_path, quantized=backend == 'onnx', **kwargs)
+    raise ValueError("backend must be 'torch', 'onnx' or 'onnx-fp32'")
+
+def parity_check(reference, candidate, texts, threshold=0.999):
+    '''
+    Cosine similarity between the embeddings of two encoders (e.g. SentenceTransformer and OnnxEncoder) for the
+    same texts. Returns the minimum and mean cosine and whether the minimum reaches threshold.
+    '''
+    a = np.asarray(reference.encode(list(texts), normalize_embeddings=True), dtype=np.float64)
+    b = np.asarray(candidate.encode(list(texts), normalize_embeddings=True), dtype=np.float64)
+    cosine = np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {'texts': len(cosine), 'min_cosine': float(cosine.min()), 'mean_cosine': float(cosine.mean()),
+            'passed': bool(cosine.min() >= threshold)}
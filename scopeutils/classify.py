@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .embed import vector_columns, load_vectors
+from .index import normalize_rows
+
+def industry_anchors(codes, texts, encode, path, model_id):
+    '''
+    Embedding of each industry description (e.g. NAICS titles and descriptions), computed once per model and
+    set of descriptions and cached in path (a Parquet file with code, text and vector columns). The cache is
+    rebuilt when the model_id, codes or texts change.
+
+    Parameters:
+    - codes, texts: industry codes and the text describing each
+    - encode: function mapping a list of texts to an (n, dim) array, e.g. the model's encode
+    - path: cache file
+
+    Returns:
+    - array of codes (as strings) and the (n, dim) float32 matrix of unit anchor vectors, in the same order
+    '''
+    codes = [str(code) for code in codes]
+    texts = list(texts)
+    h = hashlib.blake2b(str(model_id).encode(), digest_size=16)
+    for code, text in zip(codes, texts):
+        h.update(f'{code}\0{text}\0'.encode())
+    fingerprint = h.hexdigest().encode()
+
+    path = Path(path)
+    if path.exists():
+        table = pq.read_table(path)
+        if (table.schema.metadata or {}).get(b'fingerprint') == fingerprint:
+            return np.array(table.column('code').to_pylist(), dtype=str), normalize_rows(load_vectors(table, 'vector'))
+
+    vectors = normalize_rows(encode(texts))
+    table = pa.table({'code': pa.array(codes, pa.string()), 'text': pa.array(texts, pa.string()),
+                      **dict(vector_columns('vector', vectors, 'float32'))})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    pq.write_table(table.replace_schema_metadata({'fingerprint': fingerprint, 'model': str(model_id)}), tmp)
+    os.replace(tmp, path)
+    return np.array(codes, dtype=str), vectors
+
+def top_industries(vectors, anchors, k=5):
+    '''
+    Score every vector (documents or chunks) against every anchor in one matrix product and keep the k best.
+    Rows of vectors that are missing (NaN) get index -1 and NaN scores.
+    Returns the (n, k) anchor indices and cosine scores, best first, and the full (n, n_anchors) score matrix.
+    '''
+    vectors = normalize_rows(vectors)
+    missing = np.isnan(vectors).any(axis=1)
+    scores = np.nan_to_num(vectors) @ anchors.T
+    k = min(k, anchors.shape[0])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable'), axis=1)
+    best = np.take_along_axis(scores, top, axis=1)
+    top[missing] = -1
+    best[missing] = np.nan
+    scores[missing] = np.nan
+    return top, best, scores
+
+def industry_scope(scores, offsets=None, margin=0.02, min_share=0.1):
+    '''
+    Number of industries a firm operates in, from the scores of top_industries.
+
+    Document level (offsets=None): industries scoring within margin of the document's best industry.
+    Chunk level (scores of chunks, documents i made of chunks offsets[i]:offsets[i+1], as from chunk_arrow):
+    industries that are the best match of at least min_share of the document's chunks.
+    Documents without vectors (or chunks) get 0.
+    '''
+    if offsets is None:
+        return (scores >= scores.max(axis=1, keepdims=True) - margin).sum(axis=1)
+
+    offsets = np.asarray(offsets)
+    n_docs, n_anchors = len(offsets) - 1, scores.shape[1]
+    doc = np.repeat(np.arange(n_docs), np.diff(offsets))
+    counts = np.bincount(doc * n_anchors + scores.argmax(axis=1), minlength=n_docs * n_anchors).reshape(n_docs, n_anchors)
+    chunks = np.maximum(np.diff(offsets), 1)[:, None]
+    return (counts / chunks >= min_share).sum(axis=1) * (np.diff(offsets) > 0)
+
+def classify_parquet(src, dest, column, codes, anchors, k=5, margin=0.02, keys=('gvkey', 'fyear')):
+    '''
+    Classify the documents of one embedded shard (embed_parquet output): the vectors in column are scored
+    against all anchors in one matrix product. Writes dest (Parquet) with the keys, industry1..k and
+    score1..k (best first) and scope (see industry_scope). Returns the number of rows written.
+    '''
+    table = pq.read_table(src, columns=list(keys) + [name for name in pq.read_schema(src).names
+                                                     if name in (column, column + '_scale')])
+    top, best, scores = top_industries(load_vectors(table, column), anchors, k)
+    out = table.select(list(keys)).to_pandas()
+    labels = np.append(np.asarray(codes, dtype=object), None) # index -1 (no vector) maps to None
+    for j in range(top.shape[1]):
+        out[f'industry{j + 1}'] = labels[top[:, j]]
+        out[f'score{j + 1}'] = best[:, j]
+    out['scope'] = industry_scope(scores, margin=margin)
+
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_suffix('.tmp')
+    out.to_parquet(tmp, index=False, compression='zstd')
+    os.replace(tmp, dest)
+    return len(out)
@@ -3,6 +3,21 @@ import numpy as np
 import re
 import nltk
 import sys
+import fcntl
+import hashlib
+import os
+import time
+import unicodedata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import scipy.sparse as sparse
+from .io import parquet_dataset
 
 def chunk_text(text, max):
     '''
@@ -31,3 +46,645 @@ def avg_embed_vecs(chunk_embeddings, chunk_lens):
     chunk_embeddings = chunk_embeddings.tolist()
     return chunk_embeddings
 
+
+def normalize_chunk(text):
+    '''
+    Normalized form of a chunk used for cache keys: Unicode NFC, whitespace runs collapsed to one space,
+    leading/trailing whitespace removed.
+    '''
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+def chunk_hashes(texts):
+    '''
+    16-byte blake2b digests of the normalized chunks, as a NumPy 'S16' array.
+    '''
+    return np.array([hashlib.blake2b(normalize_chunk(t).encode('utf-8'), digest_size=16).digest() for t in texts],
+                    dtype='S16')
+
+class EmbeddingCache:
+    '''
+    Persistent content-addressed cache of chunk embeddings for one model: identical (normalized) chunks are
+    encoded once, across fields, filings, years and runs.
+
+    On disk, under path/model_id/, vectors.bin holds the embeddings as a raw (n, dim) float16 or float32 matrix,
+    read through a memory map, and keys.bin holds the 16-byte chunk hash of each row. Both files are append-only;
+    appends take an exclusive lock on the directory, so several jobs can share one cache. Rows written after the
+    last complete key (an interrupted append) are ignored.
+
+    Lookups go through a few sorted runs of the keys (sorted key, row): the keys of each append form a new run,
+    and runs are merged while the newer one is at least half the size of the one before, so appending n keys
+    costs O(n log n) in all, rather than a sort of the whole cache per append.
+    '''
+    def __init__(self, path, model_id, dim, dtype='float32'):
+        self.path = Path(path) / re.sub(r'[^\w.-]+', '_', str(model_id))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.vectors_file = self.path / 'vectors.bin'
+        self.keys_file = self.path / 'keys.bin'
+        self.lock_file = self.path / '.lock'
+        self.rows = 0
+        self.runs = [] # (sorted keys, their rows), largest first
+        self._refresh()
+
+    def __len__(self):
+        return self.rows
+
+    def _complete_rows(self):
+        keys = self.keys_file.stat().st_size // 16 if self.keys_file.exists() else 0
+        vectors = self.vectors_file.stat().st_size // (self.dim * self.dtype.itemsize) \
+            if self.vectors_file.exists() else 0
+        return min(keys, vectors)
+
+    def _refresh(self):
+        '''
+        Pick up rows appended since the index was built (by this or another process).
+        '''
+        n = self._complete_rows()
+        if n > self.rows:
+            with open(self.keys_file, 'rb') as f:
+                f.seek(16 * self.rows)
+                new = np.frombuffer(f.read(16 * (n - self.rows)), dtype='S16')
+            order = np.argsort(new, kind='stable')
+            self.runs.append((new[order], self.rows + order))
+            self.rows = n
+            while len(self.runs) > 1 and 2 * len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+                self.runs.append(_merge_runs(self.runs.pop(-2), self.runs.pop()))
+        self.vectors = np.memmap(self.vectors_file, dtype=self.dtype, mode='r', shape=(n, self.dim)) if n else \
+            np.zeros((0, self.dim), dtype=self.dtype)
+
+    def lookup(self, hashes):
+        '''
+        Row of each hash in the cache, -1 for misses.
+        '''
+        found = np.full(len(hashes), -1, dtype=np.int64)
+        for keys, rows in self.runs:
+            pos = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+            hit = keys[pos] == hashes
+            found[hit] = rows[pos[hit]]
+        return found
+
+    def add(self, hashes, vectors):
+        '''
+        Append embeddings for new hashes (hashes already cached, e.g. added by another job meanwhile, are skipped).
+        '''
+        vectors = np.asarray(vectors).astype(self.dtype, copy=False).reshape(-1, self.dim)
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._refresh()
+            n = self._complete_rows()
+            new = self.lookup(hashes) < 0
+            _, first = np.unique(hashes, return_index=True)
+            new &= np.isin(np.arange(len(hashes)), first)
+            if new.any():
+                # drop the tail of an interrupted append, then write vectors before keys
+                with open(self.vectors_file, 'ab') as f:
+                    f.truncate(n * self.dim * self.dtype.itemsize)
+                    f.write(np.ascontiguousarray(vectors[new]).tobytes())
+                with open(self.keys_file, 'ab') as f:
+                    f.truncate(16 * n)
+                    f.write(hashes[new].tobytes())
+            self._refresh()
+
+    def get(self, rows):
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+def _merge_runs(a, b):
+    '''
+    Merge two sorted runs (keys, rows) in linear time: each key of b goes before the keys of a not smaller than it.
+    '''
+    at = np.searchsorted(a[0], b[0]) + np.arange(len(b[0]))
+    from_b = np.zeros(len(a[0]) + len(b[0]), dtype=bool)
+    from_b[at] = True
+    keys = np.empty(len(from_b), dtype=a[0].dtype)
+    rows = np.empty(len(from_b), dtype=np.int64)
+    keys[from_b], keys[~from_b] = b[0], a[0]
+    rows[from_b], rows[~from_b] = b[1], a[1]
+    return keys, rows
+
+def encode_cached(texts, cache, encode):
+    '''
+    Embed texts through an EmbeddingCache. Duplicate chunks within texts and chunks already in the cache are not
+    encoded again; only the remaining unique misses are passed to encode (a function list of str -> (n, dim)
+    array, e.g. lambda t: model.encode(t, normalize_embeddings=True)), and their embeddings are added to the cache.
+    Returns a float32 array of shape (len(texts), dim) in the order of texts.
+    '''
+    texts = list(texts)
+    hashes = chunk_hashes(texts)
+    unique, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    rows = cache.lookup(unique)
+    miss = np.flatnonzero(rows < 0)
+    if len(miss):
+        cache.add(unique[miss], encode([texts[i] for i in first[miss]]))
+        rows = cache.lookup(unique)
+    return cache.get(rows)[inverse.reshape(-1)]
+
+def encode_batches(texts, encode, batch_size, dim):
+    '''
+    Encode texts in fixed-size batches straight into a preallocated float32 (len(texts), dim) array, so the
+    embeddings are never held as Python lists.
+    '''
+    out = np.empty((len(texts), dim), dtype=np.float32)
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        out[start:start + len(batch)] = encode(batch)
+    return out
+
+def length_batches(lengths, tokens_per_batch, max_batch_size=None):
+    '''
+    Group items into batches of similar length: sort by length, then close a batch when adding the next item
+    would make the padded batch (batch size x longest item) exceed tokens_per_batch. Short chunks thus go in
+    large batches and long ones in small batches, instead of a fixed count per batch.
+    Returns a list of index arrays into lengths.
+    '''
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    start = 0
+    for i, length in enumerate(lengths[order]):
+        size = i - start + 1
+        if size > 1 and (size * length > tokens_per_batch or (max_batch_size and size > max_batch_size)):
+            batches.append(order[start:i])
+            start = i
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+def padded_tokens(lengths, batches):
+    '''
+    Tokens the model processes for the given batches, padding included.
+    '''
+    return int(sum(len(b) * lengths[b].max() for b in batches if len(b)))
+
+class BucketedEncoder:
+    '''
+    Length-aware batching for an encoder: the texts of each call are tokenized (count_tokens, e.g. a
+    TokenCounter), sorted into batches under a padded tokens-per-batch budget with length_batches, encoded one
+    batch per call of encode_batch, and scattered back into the original order.
+
+    It also keeps the padding statistics of all calls: report() compares the share of real (non-padding) tokens
+    with that of fixed batches of baseline_batch_size texts in their original order.
+
+    Parameters:
+    - encode_batch: function list of str -> (n, dim) array that encodes its input as one batch, e.g.
+      lambda t: model.encode(t, batch_size=len(t), normalize_embeddings=True)
+    - max_length: the model's maximum sequence length; longer texts are truncated by the model, so they count
+      as max_length tokens
+    '''
+    def __init__(self, encode_batch, count_tokens, max_length=512, tokens_per_batch=16384, max_batch_size=512,
+                 baseline_batch_size=32):
+        self.encode_batch = encode_batch
+        self.count_tokens = count_tokens
+        self.max_length = max_length
+        self.tokens_per_batch = tokens_per_batch
+        self.max_batch_size = max_batch_size
+        self.baseline_batch_size = baseline_batch_size
+        self.stats = {'texts': 0, 'batches': 0, 'tokens': 0, 'padded_tokens': 0, 'baseline_padded_tokens': 0,
+                      'seconds': 0.0}
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        start = time.perf_counter()
+        # + [CLS] and [SEP]
+        lengths = np.minimum(self.count_tokens(texts) + 2, self.max_length)
+        batches = length_batches(lengths, self.tokens_per_batch, self.max_batch_size)
+
+        out = None
+        for batch in batches:
+            embeddings = np.asarray(self.encode_batch([texts[i] for i in batch]))
+            if out is None:
+                out = np.empty((len(texts), embeddings.shape[1]), dtype=np.float32)
+            out[batch] = embeddings
+
+        baseline = [np.arange(i, min(i + self.baseline_batch_size, len(texts)))
+                    for i in range(0, len(texts), self.baseline_batch_size)]
+        self.stats['texts'] += len(texts)
+        self.stats['batches'] += len(batches)
+        self.stats['tokens'] += int(lengths.sum())
+        self.stats['padded_tokens'] += padded_tokens(lengths, batches)
+        self.stats['baseline_padded_tokens'] += padded_tokens(lengths, baseline)
+        self.stats['seconds'] += time.perf_counter() - start
+        return out
+
+    def report(self):
+        '''
+        Padding efficiency (real tokens / processed tokens) of the bucketed batches and of the fixed-size
+        baseline, and the resulting reduction in processed tokens, an estimate of the throughput gain.
+        '''
+        stats = dict(self.stats)
+        stats['padding_efficiency'] = stats['tokens'] / stats['padded_tokens'] if stats['padded_tokens'] else 1.0
+        stats['baseline_padding_efficiency'] = stats['tokens'] / stats['baseline_padded_tokens'] \
+            if stats['baseline_padded_tokens'] else 1.0
+        stats['token_reduction'] = stats['baseline_padded_tokens'] / stats['padded_tokens'] \
+            if stats['padded_tokens'] else 1.0
+        stats['texts_per_second'] = stats['texts'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+def pool_embeddings(embeddings, offsets, weights=None, mode='weighted', normalize=True):
+    '''
+    Pool chunk embeddings into document vectors for a whole batch of documents in one call, on the flat chunk
+    array, instead of one avg_embed_vecs call per document in a process pool: weighted sums are one sparse
+    product, S @ embeddings with S the (n_docs, n_chunks) CSR matrix holding each chunk's weight in the row of
+    its document (a single pass over the rows; np.add.reduceat over axis 0 is several times slower), divided by
+    the total weight of each document. Max pooling uses np.maximum.reduceat.
+
+    Parameters:
+    - embeddings: (n_chunks, dim) array, the chunks of each document in consecutive rows
+    - offsets: n_docs + 1 row offsets; document i owns rows offsets[i]:offsets[i+1]
+    - weights: per-chunk weights for mode='weighted', e.g. chunk lengths in characters (as in avg_embed_vecs)
+      or token counts
+    - mode: 'weighted' (weighted average), 'mean' (plain average) or 'max' (elementwise maximum)
+    - normalize: scale each document vector to length 1
+
+    Returns a float64 (n_docs, dim) array; documents without chunks get a row of NaN.
+    '''
+    embeddings = np.asarray(embeddings)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    out = np.full((len(counts), embeddings.shape[1]), np.nan)
+    if not nonempty.any():
+        return out
+
+    if mode == 'max':
+        # empty documents have no rows, so the segments of the others are delimited by their starts alone;
+        # rows after offsets[-1] belong to no document and are cut off, so the last segment ends there
+        pooled = np.maximum.reduceat(embeddings[:offsets[-1]], offsets[:-1][nonempty], axis=0).astype(np.float64)
+    elif mode in ('weighted', 'mean'):
+        if mode == 'mean':
+            weights = np.ones(len(embeddings))
+        elif weights is None:
+            raise ValueError("weights are required for mode='weighted'")
+        weights = np.asarray(weights, dtype=np.float64)[offsets[0]:offsets[-1]]
+        # row i of segments holds the weights of document i's chunks; empty documents are empty rows
+        segments = sparse.csr_matrix((weights, np.arange(offsets[0], offsets[-1]), offsets - offsets[0]),
+                                     shape=(len(counts), len(embeddings)))
+        pooled = (segments @ embeddings)[nonempty] / (segments @ np.ones(len(embeddings)))[nonempty, None]
+    else:
+        raise ValueError("mode must be 'weighted', 'mean' or 'max'")
+
+    if normalize:
+        pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+    out[nonempty] = pooled
+    return out
+
+VECTOR_FORMATS = ('float64', 'float32', 'float16', 'int8')
+
+def quantize_int8(vectors):
+    '''
+    Symmetric scalar quantization per vector: int8 codes and a float32 scale with vector ~ codes * scale.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scale = np.abs(vectors).max(axis=1) / 127
+    scale[~(scale > 0)] = 1 # zero or missing vectors
+    codes = np.clip(np.rint(vectors / scale[:, None]), -127, 127)
+    return np.nan_to_num(codes).astype(np.int8), scale.astype(np.float32)
+
+def vector_columns(name, vectors, format='float64'):
+    '''
+    (n, dim) array -> Arrow columns for a Parquet file, built without Python lists; NaN rows become nulls.
+    - 'float64': list<double> column name (as the vectors used to be stored)
+    - 'float32', 'float16': fixed_size_list<float>[dim] column name
+    - 'int8': fixed_size_list<int8>[dim] column name plus a float32 column name_scale (see quantize_int8)
+    Returns a list of (column name, array).
+    '''
+    vectors = np.asarray(vectors)
+    n, dim = vectors.shape
+    missing = np.isnan(vectors).any(axis=1)
+    mask = pa.array(missing)
+    clean = np.where(missing[:, None], 0, vectors)
+    if format == 'float64':
+        offsets = pa.array(np.arange(0, (n + 1) * dim, dim, dtype=np.int32))
+        return [(name, pa.ListArray.from_arrays(offsets, pa.array(clean.astype(np.float64).ravel()), mask=mask))]
+    if format in ('float32', 'float16'):
+        values = pa.array(clean.astype(format).ravel())
+        return [(name, pa.FixedSizeListArray.from_arrays(values, dim, mask=mask))]
+    if format == 'int8':
+        codes, scale = quantize_int8(clean)
+        return [(name, pa.FixedSizeListArray.from_arrays(pa.array(codes.ravel()), dim, mask=mask)),
+                (name + '_scale', pa.array(scale, mask=missing))]
+    raise ValueError(f"format must be one of {VECTOR_FORMATS}")
+
+def _column_to_numpy(column, dtype):
+    '''
+    Vector column (list or fixed_size_list) -> contiguous (n, dim) array; null rows are NaN.
+    '''
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    n = len(column)
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+    if pa.types.is_fixed_size_list(column.type):
+        dim = column.type.list_size
+        values = column.values.slice(column.offset * dim, n * dim)
+        out = pc.fill_null(values, 0).to_numpy().reshape(n, dim).astype(dtype, copy=False)
+    else:
+        flat = pc.list_flatten(column).to_numpy()
+        dim = len(flat) // max(valid.sum(), 1)
+        out = np.zeros((n, dim), dtype=dtype)
+        out[valid] = flat.reshape(-1, dim)
+    if not valid.all():
+        out = out.astype(np.result_type(dtype, np.float32)) # a writable copy
+        out[~valid] = np.nan
+    return out
+
+def load_vectors(source, column, dtype=np.float32, filters=None):
+    '''
+    Read a vector column written by vector_columns (any format) from a Parquet file/dataset or an Arrow table
+    into one contiguous (n, dim) NumPy array of dtype, without Python objects. int8 columns are multiplied by
+    their scales. Missing vectors are NaN rows.
+    '''
+    if isinstance(source, pa.Table):
+        table = source
+    else:
+        dataset = parquet_dataset(source)
+        scale = column + '_scale'
+        columns = [column] + ([scale] if scale in dataset.schema.names else [])
+        if filters is not None and not isinstance(filters, ds.Expression):
+            filters = pq.filters_to_expression(filters)
+        table = dataset.to_table(columns=columns, filter=filters)
+    vectors = _column_to_numpy(table.column(column), dtype)
+    if column + '_scale' in table.column_names:
+        scale = table.column(column + '_scale').to_numpy(zero_copy_only=False).astype(dtype)
+        vectors = vectors * scale[:, None]
+    return vectors
+
+def quantization_report(vectors, formats=('float32', 'float16', 'int8'), sample=1000, seed=0):
+    '''
+    Error each storage format introduces, for (normalized) vectors: bytes per vector and size relative to
+    float64, 1 - cosine between each vector and its stored version (mean and max), and the largest change in
+    the cosine similarity between pairs of vectors, on a random sample of up to sample vectors.
+    Returns a dict of format -> statistics.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float64)
+    vectors = vectors[~np.isnan(vectors).any(axis=1)]
+    rng = np.random.default_rng(seed)
+    pick = rng.choice(len(vectors), min(sample, len(vectors)), replace=False)
+    unit = lambda x: x / np.linalg.norm(x, axis=1, keepdims=True)
+    exact = unit(vectors[pick]) @ unit(vectors[pick]).T
+
+    report = {}
+    dim = vectors.shape[1]
+    for format in formats:
+        table = pa.table(dict(vector_columns('v', vectors, format)))
+        stored = load_vectors(table, 'v', dtype=np.float64)
+        cosine = np.sum(unit(vectors) * unit(stored), axis=1)
+        approx = unit(stored[pick]) @ unit(stored[pick]).T
+        size = dim * np.dtype(format).itemsize + (4 if format == 'int8' else 0)
+        report[format] = {'bytes_per_vector': size, 'size_vs_float64': size / (8 * dim),
+                          'mean_cosine_error': float(np.mean(1 - cosine)),
+                          'max_cosine_error': float(np.max(1 - cosine)),
+                          'max_pairwise_similarity_error': float(np.abs(approx - exact).max())}
+    return report
+
+# Python's \s (str.isspace) in RE2 syntax, which pyarrow.compute uses; RE2's own \s is ASCII only
+_SPACE = r'\s\x{0b}\x{1c}-\x{1f}\x{85}\p{Z}'
+
+# sentence ends as Punkt finds them: . ! or ? (plus closing quotes/brackets) followed by whitespace
+SENTENCE_END = re.compile(r'''[.!?]['"’”)\]]*\s+(?=\S)''')
+ABBREVIATIONS = frozenset('''inc corp co ltd llc plc no nos mr mrs ms dr jr sr st vs etc al approx dept est fig
+    jan feb mar apr jun jul aug sep sept oct nov dec'''.split())
+
+def split_sentences(text):
+    '''
+    Rule-based stand-in for nltk.sent_tokenize (Punkt) on 10-K text: split after . ! ? followed by whitespace,
+    except after common abbreviations (Inc., Corp., No., ...), single initials, and dotted acronyms such as
+    U.S. or e.g.
+    '''
+    sentences = []
+    start = 0
+    for m in SENTENCE_END.finditer(text):
+        space = text.rfind(' ', start, m.start())
+        word = text[space + 1 if space >= 0 else start:m.start()].lstrip('(\'"‘“').lower()
+        if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()) or ('.' in word and len(word) <= 5):
+            continue
+        sentences.append(text[start:m.end()].rstrip())
+        start = m.end()
+    if text[start:].strip():
+        sentences.append(text[start:].rstrip())
+    return sentences
+
+_TOKENIZERS = {}
+
+class TokenCounter:
+    '''
+    Counts tokenizer tokens (without special tokens) for a batch of texts with the fast tokenizer saved with the
+    model (tokenizer.json). It pickles as its path, and the tokenizer is loaded once per process.
+    '''
+    def __init__(self, model_path):
+        self.path = str(Path(model_path) / 'tokenizer.json')
+
+    def __call__(self, texts):
+        if self.path not in _TOKENIZERS:
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(self.path)
+            tokenizer.no_truncation()
+            tokenizer.no_padding()
+            _TOKENIZERS[self.path] = tokenizer
+        encodings = _TOKENIZERS[self.path].encode_batch(list(texts), add_special_tokens=False)
+        return np.array([len(e.ids) for e in encodings], dtype=np.int64)
+
+def _string_array(docs):
+    '''
+    Documents (Arrow array, pandas Series or list of str) as one Arrow large_string array.
+    '''
+    if isinstance(docs, pa.ChunkedArray):
+        docs = docs.combine_chunks()
+    if not isinstance(docs, pa.Array):
+        docs = pa.array(docs, type=pa.large_string(), from_pandas=True)
+    return docs.cast(pa.large_string())
+
+def chunk_arrow(docs, max_tokens=None, count_tokens=None, max_chars=None):
+    '''
+    chunk_text for a whole Arrow string array of documents at once, with blank chunks dropped.
+    Splitting into lines, collapsing whitespace and dropping blank chunks run as Arrow compute kernels over all
+    documents; only the lines over budget are split into sentences (split_sentences) in Python.
+
+    A line is over budget when count_tokens (e.g. a TokenCounter) gives it more than max_tokens tokens, so chunks
+    follow the model's token limit; without a tokenizer, when it is longer than max_chars characters (chunk_text
+    uses max*2). Lines with at most max_tokens characters are never counted, since a token covers at least one
+    character. Missing documents have no chunks.
+
+    Returns the chunks as an Arrow string array and n_docs + 1 offsets: document i owns chunks offsets[i]:offsets[i+1].
+    '''
+    docs = pc.fill_null(_string_array(docs), '')
+    lines = pc.split_pattern(docs, '\n')
+    seg_doc = np.repeat(np.arange(len(docs)), np.diff(lines.offsets.to_numpy()))
+    segments = pc.replace_substring_regex(lines.flatten(), f'[{_SPACE}]{{2,}}', ' ')
+
+    length = pc.utf8_length(segments).to_numpy()
+    if count_tokens is not None:
+        candidates = np.flatnonzero(length > max_tokens)
+        long = candidates[count_tokens(segments.take(pa.array(candidates)).to_pylist()) > max_tokens] \
+            if len(candidates) else candidates
+    else:
+        long = np.flatnonzero(length > max_chars)
+
+    if len(long):
+        # long lines are replaced by their sentences: take from [segments, sentences] in output order
+        pieces = [split_sentences(text) for text in segments.take(pa.array(long)).to_pylist()]
+        n_pieces = np.ones(len(segments), dtype=np.int64)
+        n_pieces[long] = [len(p) for p in pieces]
+        take = np.repeat(np.arange(len(segments)), n_pieces)
+        out_start = np.cumsum(n_pieces) - n_pieces
+        first_piece = np.cumsum([0] + [len(p) for p in pieces[:-1]])
+        for i, start, n in zip(long, first_piece, n_pieces[long]):
+            take[out_start[i]:out_start[i] + n] = len(segments) + start + np.arange(n)
+        sentences = pa.array([s for p in pieces for s in p], type=pa.large_string())
+        segments = pa.concat_arrays([segments, sentences]).take(pa.array(take))
+        seg_doc = np.repeat(seg_doc, n_pieces)
+
+    keep = pc.match_substring_regex(segments, f'[^{_SPACE}]')
+    chunks = segments.filter(keep)
+    seg_doc = seg_doc[keep.to_numpy(zero_copy_only=False)]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(seg_doc, minlength=len(docs)))])
+    return chunks, offsets
+
+class Chunker:
+    '''
+    Chunking settings plus an optional persistent process pool: create it once and call it on every column of
+    every shard (documents as an Arrow string array, a pandas Series or a list). With processes > 1 the documents
+    are split into one slice per process, so the pool and each worker's tokenizer are started only once.
+    Use as a context manager, or call close(), to shut the pool down.
+
+    Parameters:
+    - max_tokens, tokenizer: token budget per chunk and the model directory holding tokenizer.json
+    - max_chars: character budget, used when no tokenizer is given (chunk_text's max*2)
+    '''
+    def __init__(self, max_tokens=None, tokenizer=None, max_chars=None, processes=1):
+        if tokenizer is None and max_chars is None:
+            raise ValueError("Either a tokenizer or max_chars is required")
+        self.max_tokens = max_tokens
+        self.count_tokens = TokenCounter(tokenizer) if tokenizer is not None else None
+        self.max_chars = max_chars
+        self.processes = processes
+        self.executor = None
+
+    def chunk(self, docs):
+        return chunk_arrow(docs, self.max_tokens, self.count_tokens, self.max_chars)
+
+    def __call__(self, docs):
+        docs = _string_array(docs)
+        if self.processes <= 1 or len(docs) < 2 * self.processes:
+            return self.chunk(docs)
+
+        if self.executor is None:
+            # spawned, not forked: the caller may hold a GPU context
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        bounds = np.linspace(0, len(docs), self.processes + 1).astype(int)
+        # take() copies each slice, so only that slice is pickled
+        slices = [docs.take(pa.array(np.arange(a, b))) for a, b in zip(bounds[:-1], bounds[1:])]
+        results = list(self.executor.map(chunk_arrow, slices, repeat(self.max_tokens), repeat(self.count_tokens),
+                                         repeat(self.max_chars)))
+        chunks = pa.concat_arrays([c for c, _ in results])
+        counts = np.concatenate([np.diff(o) for _, o in results])
+        return chunks, np.concatenate([[0], np.cumsum(counts)])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def field_rows(item_offsets, item_bases, included):
+    '''
+    Rows of a combined field in the flat array of all chunks: for each document, the chunks of each of its items
+    in order (items[k] of document d owns rows item_bases[k] + item_offsets[k][d] onwards), skipping items that
+    are not included for that document.
+    Returns the rows and the field's n_docs + 1 document offsets into them.
+    '''
+    starts = np.stack([base + offsets[:-1] for base, offsets in zip(item_bases, item_offsets)], axis=1).ravel()
+    lengths = np.stack([np.diff(offsets) * inc for offsets, inc in zip(item_offsets, included)], axis=1)
+    doc_offsets = np.concatenate([[0], np.cumsum(lengths.sum(axis=1))])
+    lengths = lengths.ravel()
+    rows = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return rows, doc_offsets
+
+def embed_parquet(src, dest, fields, encode, dim, chunker, rows_per_batch=64, encode_batch=4096,
+                  pooling='weighted', weight=len, vector_format='float64', required=None, include=None):
+    '''
+    Embed text columns of a Parquet file as a stream: read rows_per_batch rows at a time -> chunk -> encode in
+    batches of encode_batch chunks into a preallocated array -> pool per document (pool_embeddings) -> append
+    the rows, with their vectors, to dest as one Parquet row group. Peak memory depends on rows_per_batch and
+    encode_batch, not on the size of the file.
+
+    Each text column is chunked once and the union of all chunks is encoded once per batch; every output vector
+    is then pooled from its subset of chunks. A field made of several items (e.g. the full text, item1 + item1a
+    + item7) is pooled over the chunks of those items, so it costs no extra encoding, and neither do per-item
+    fields next to it. (Chunks are cut per item, so where the concatenated text would run the last line of one
+    item into the first line of the next, the combined field has two chunks instead of one.)
+
+    Parameters:
+    - fields: dict of output column -> text column or list of text columns, e.g.
+      {'embfull': ['item1', 'item1a', 'item7'], 'emb1': 'item1'}
+    - encode: function list of str -> (n, dim) array of normalized embeddings (e.g. wrapping encode_cached)
+    - chunker: a Chunker (or any function docs -> (chunks, offsets) like chunk_arrow), reused across batches
+    - pooling, weight: pool_embeddings mode, and the function giving each chunk's weight for 'weighted' pooling
+      (len: characters, as in avg_embed_vecs; or a token count)
+    - vector_format: storage of the vectors, see vector_columns ('float16' or 'int8' for 4x or 8x smaller files);
+      read them back with load_vectors
+    - required: text columns that must be non-empty; other rows are dropped (default: all text columns of fields)
+    - include: optional function (table, output column) -> dict of text column -> boolean array, for fields whose
+      items depend on the row (e.g. the rules clean_10ks uses to build 'text'); items not in the dict are included
+
+    dest is written to a temporary file and renamed when complete. Returns the number of rows written.
+    '''
+    fields = {out_col: [cols] if isinstance(cols, str) else list(cols) for out_col, cols in fields.items()}
+    items = list(dict.fromkeys(col for cols in fields.values() for col in cols))
+    required = items if required is None else required
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_suffix('.tmp')
+    writer = None
+    rows = 0
+    try:
+        for batch in pq.ParquetFile(src).iter_batches(batch_size=rows_per_batch):
+            table = pa.Table.from_batches([batch])
+            keep = np.ones(len(table), dtype=bool)
+            for col in required:
+                keep &= pc.fill_null(pc.utf8_length(table.column(col)), 0).to_numpy() > 0
+            table = table.filter(pa.array(keep))
+
+            # chunk every item once, and encode all chunks together
+            chunked = {col: chunker(table.column(col)) for col in items}
+            chunks = pa.concat_arrays([chunked[col][0] for col in items])
+            bases = dict(zip(items, np.cumsum([0] + [len(chunked[col][0]) for col in items[:-1]])))
+            flat = chunks.to_pylist()
+            embeddings = encode_batches(flat, encode, encode_batch, dim)
+            if pooling != 'weighted':
+                weights = None
+            elif weight is len:
+                weights = pc.utf8_length(chunks).to_numpy().astype(np.float64)
+            else:
+                weights = np.array([weight(item) for item in flat], dtype=np.float64)
+
+            for out_col, cols in fields.items():
+                masks = include(table, out_col) if include is not None else {}
+                included = [np.asarray(masks.get(col, np.ones(len(table), dtype=bool)), dtype=np.int64) for col in cols]
+                field, offsets = field_rows([chunked[col][1] for col in cols], [bases[col] for col in cols], included)
+                vectors = pool_embeddings(embeddings[field], offsets, weights[field] if weights is not None else None,
+                                          mode=pooling)
+                for name, array in vector_columns(out_col, vectors, vector_format):
+                    table = table.append_column(name, array)
+
+            if writer is None:
+                writer = pq.ParquetWriter(tmp, table.schema, compression='zstd')
+            writer.write_table(table)
+            rows += len(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None: # empty input
+        schema = pq.read_schema(src)
+        for out_col in fields:
+            for name, array in vector_columns(out_col, np.zeros((0, dim)), vector_format):
+                schema = schema.append(pa.field(name, array.type))
+        pq.write_table(schema.empty_table(), tmp)
+    os.replace(tmp, dest)
+    return rows
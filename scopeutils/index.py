@@ -0,0 +1,234 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import shutil
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from .embed import load_vectors
+from .io import parquet_dataset
+
+def normalize_rows(vectors):
+    '''
+    Rows scaled to unit length (float32), so that inner products are cosine similarities. Zero rows stay zero.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+def _nearest(vectors, centroids, block=65536):
+    '''
+    Index of the most similar centroid for each (unit) vector, in blocks to bound the score matrix.
+    '''
+    return np.concatenate([np.argmax(vectors[s:s + block] @ centroids.T, axis=1)
+                           for s in range(0, len(vectors), block)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+def year_vectors(dataset, value, column='embfull', key='gvkey', year='fyear'):
+    '''
+    Keys (as strings) and unit vectors (float32) of the rows of one year in a Parquet dataset of embedded
+    shards, read with a filter on the year so that only that year is held in memory. Rows without a vector are
+    left out.
+    '''
+    scale = column + '_scale'
+    columns = [key, column] + ([scale] if scale in dataset.schema.names else [])
+    table = dataset.to_table(columns=columns, filter=ds.field(year) == value)
+    vectors = load_vectors(table, column)
+    keep = ~np.isnan(vectors).any(axis=1)
+    keys = np.asarray(table.column(key).to_pandas().astype(str).to_numpy()[keep], dtype=str)
+    return keys, normalize_rows(vectors[keep])
+
+def dataset_years(dataset, year='fyear'):
+    return sorted(pc.unique(dataset.to_table(columns=[year]).column(year)).drop_null().to_pylist())
+
+def spherical_kmeans(vectors, k, iterations=10, sample=50_000, seed=0):
+    '''
+    k unit-length centroids of (unit) vectors by cosine similarity: Lloyd's iterations on a random sample of up
+    to sample vectors, starting from k distinct vectors. An empty cluster is restarted at a random vector.
+    '''
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample, replace=False))]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        empty = np.bincount(labels, minlength=k) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = normalize_rows(sums)
+    return centroids
+
+def build_index(source, dest, column='embfull', key='gvkey', year='fyear', lists=None, method='ivf',
+                iterations=10, sample=50_000, hnsw_m=16, ef_construction=200, seed=0):
+    '''
+    Build a persistent approximate nearest-neighbor index over the document vectors in source (a Parquet file,
+    directory or list of files, e.g. the embedded shards in processed/embedded/items1_a_7/), one partition per
+    fiscal year, for peer queries with AnnIndex. Rows without a vector are left out.
+
+    Each year is an IVF-flat index: the year's vectors are clustered (spherical k-means, lists clusters; by
+    default the square root of the number of vectors), and stored as float32 unit vectors grouped by cluster,
+    so that a query reads only the clusters closest to it, each a contiguous slice of a memory-mapped file.
+    With method='hnsw', an hnswlib graph is built per year as well (hnswlib must be installed).
+
+    Layout of dest (written to a temporary directory, then renamed, so a half-built index is never used):
+    - index.json: column, key, year, method, dimension, and the number of vectors per year
+    - <year>=<value>/vectors.npy: unit vectors, grouped by cluster; keys.npy: their keys (as strings)
+    - <year>=<value>/centroids.npy, offsets.npy: cluster centroids, and the rows of cluster i,
+      offsets[i]:offsets[i+1]
+    - <year>=<value>/sorted_keys.npy, key_rows.npy: keys in sorted order and their rows, for lookups by key
+    - <year>=<value>/hnsw.bin: the hnswlib graph (method='hnsw')
+
+    Returns the path of the index.
+    '''
+    if method not in ('ivf', 'hnsw'):
+        raise ValueError("method must be 'ivf' or 'hnsw'")
+    dest = Path(dest)
+    tmp = dest.with_name(dest.name + '.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    dataset = parquet_dataset(source) # only *.parquet: shards still being written are .tmp
+    counts = {}
+    dim = None
+    for value in dataset_years(dataset, year):
+        keys, vectors = year_vectors(dataset, value, column, key, year)
+        if len(vectors) == 0:
+            continue
+        dim = vectors.shape[1]
+
+        k = min(lists or max(int(np.sqrt(len(vectors))), 1), len(vectors))
+        centroids = spherical_kmeans(vectors, k, iterations, sample, seed)
+        labels = _nearest(vectors, centroids)
+        order = np.argsort(labels, kind='stable')
+        vectors, keys = vectors[order], keys[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=k))])
+
+        part = tmp / f'{year}={value}'
+        part.mkdir()
+        np.save(part / 'vectors.npy', vectors)
+        np.save(part / 'keys.npy', keys)
+        np.save(part / 'centroids.npy', centroids)
+        np.save(part / 'offsets.npy', offsets)
+        key_rows = np.argsort(keys, kind='stable')
+        np.save(part / 'sorted_keys.npy', keys[key_rows])
+        np.save(part / 'key_rows.npy', key_rows)
+        if method == 'hnsw':
+            import hnswlib
+            graph = hnswlib.Index(space='ip', dim=dim)
+            graph.init_index(max_elements=len(vectors), M=hnsw_m, ef_construction=ef_construction, random_seed=seed)
+            graph.add_items(vectors, np.arange(len(vectors)))
+            graph.save_index(str(part / 'hnsw.bin'))
+        counts[value] = len(vectors)
+
+    with open(tmp / 'index.json', 'w') as f:
+        json.dump({'column': column, 'key': key, 'year': year, 'method': method, 'dimension': dim,
+                   'counts': {str(value): n for value, n in counts.items()}}, f, indent=1)
+    if dest.exists():
+        shutil.rmtree(dest)
+    os.replace(tmp, dest)
+    return dest
+
+class AnnIndex:
+    '''
+    Read side of an index written by build_index. Partitions are opened on first use and memory-mapped, so
+    opening the index is instant and a query touches only the clusters it probes.
+
+    Keys are compared as strings (as stored by build_index), e.g. gvkey '001690'. Similarities are cosines.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'index.json') as f:
+            self.meta = json.load(f)
+        self.key = self.meta['key']
+        self.year = self.meta['year']
+        self.years = sorted(int(y) if y.lstrip('-').isdigit() else y for y in self.meta['counts'])
+        self._parts = {}
+
+    def _part(self, fyear):
+        if fyear not in self._parts:
+            folder = self.path / f'{self.year}={fyear}'
+            if not folder.exists():
+                raise ValueError(f'no vectors for {self.year} {fyear}')
+            part = {name: np.load(folder / f'{name}.npy', mmap_mode='r')
+                    for name in ('vectors', 'keys', 'centroids', 'offsets', 'sorted_keys', 'key_rows')}
+            part['graph'] = None
+            if self.meta['method'] == 'hnsw':
+                import hnswlib
+                part['graph'] = hnswlib.Index(space='ip', dim=self.meta['dimension'])
+                part['graph'].load_index(str(folder / 'hnsw.bin'))
+            self._parts[fyear] = part
+        return self._parts[fyear]
+
+    def row(self, key, fyear):
+        '''
+        Row of key in the year's partition, or None if it has no vector.
+        '''
+        part = self._part(fyear)
+        i = np.searchsorted(part['sorted_keys'], str(key))
+        if i < len(part['sorted_keys']) and part['sorted_keys'][i] == str(key):
+            return int(part['key_rows'][i])
+        return None
+
+    def vector(self, key, fyear):
+        row = self.row(key, fyear)
+        if row is None:
+            raise ValueError(f'no vector for {self.key} {key} in {self.year} {fyear}')
+        return np.array(self._part(fyear)['vectors'][row])
+
+    def search(self, queries, fyear, k=10, nprobe=8, exact=False):
+        '''
+        k most similar vectors in the year's partition for each query vector.
+        IVF probes the nprobe clusters with the closest centroids (all clusters with exact=True, which is a
+        brute-force search); with an hnswlib index, nprobe is the search breadth ef (at least k).
+        Returns (rows, similarities), both (len(queries), k), most similar first; when fewer than k vectors are
+        found, the remaining rows are -1 and the similarities NaN.
+        '''
+        part = self._part(fyear)
+        queries = normalize_rows(np.atleast_2d(queries))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), np.nan, dtype=np.float32)
+        vectors, offsets = part['vectors'], part['offsets']
+
+        if part['graph'] is not None and not exact:
+            n = min(k, len(vectors))
+            part['graph'].set_ef(max(nprobe, n))
+            labels, distances = part['graph'].knn_query(queries, k=n)
+            rows[:, :n] = labels
+            sims[:, :n] = 1 - distances # hnswlib's 'ip' distance is 1 - inner product
+            return rows, sims
+
+        lists = len(offsets) - 1
+        if exact or nprobe >= lists:
+            probes = np.broadcast_to(np.arange(lists), (len(queries), lists))
+        else:
+            probes = np.argpartition(-(queries @ np.asarray(part['centroids']).T), nprobe - 1, axis=1)[:, :nprobe]
+        for i, query in enumerate(queries):
+            probed = np.sort(probes[i])
+            candidates = np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in probed])
+            scores = np.concatenate([vectors[offsets[c]:offsets[c + 1]] @ query for c in probed])
+            n = min(k, len(scores))
+            top = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind='stable')]
+            rows[i, :n] = candidates[top]
+            sims[i, :n] = scores[top]
+        return rows, sims
+
+    def neighbors(self, key, fyear, k=10, years=None, nprobe=8, exact=False):
+        '''
+        Peers of a firm-year: the k firms whose vectors are most similar to that of key in fyear, within the
+        same year by default, or pooled over years (a list). The firm itself is left out of its own year.
+        Returns a DataFrame with the key, year and similarity of the neighbors, most similar first.
+        '''
+        query = self.vector(key, fyear)
+        frames = []
+        for y in ([fyear] if years is None else years):
+            rows, sims = self.search(query, y, k + 1, nprobe, exact)
+            found = rows[0] >= 0
+            keys = self._part(y)['keys'][rows[0][found]]
+            frames.append(pd.DataFrame({self.key: keys, self.year: y, 'similarity': sims[0][found]}))
+        out = pd.concat(frames, ignore_index=True)
+        out = out[~((out[self.key] == str(key)) & (out[self.year] == fyear))]
+        return out.sort_values('similarity', ascending=False, kind='stable').head(k).reset_index(drop=True)
@@ -0,0 +1,317 @@
+import pandas as pd
+import numpy as np
+import hashlib
+from pathlib import Path
+from itertools import repeat
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+def segment_bounds(keys):
+    '''
+    Takes an array of group keys in which each group is contiguous (e.g. funda sorted by gvkey) and returns
+    the start and end offsets of every group, in order of appearance.
+    '''
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    breaks = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate([[0], breaks]).astype(np.int64)
+    ends = np.concatenate([breaks, [len(keys)]]).astype(np.int64)
+    return starts, ends
+
+def interpolate_nearest(values, groups, fillable):
+    '''
+    Fill missing values with the nearest non-missing value of the same group (e.g. gvkey), measured in rows.
+    Only rows flagged in fillable are filled; every non-missing value of the group can be used as a neighbour,
+    whether or not its row is fillable. Neighbours come from the original values, so fills never cascade.
+    When the previous and next non-missing values are equally far apart (distb<=distc) the previous one wins;
+    when only one side exists, that side is used.
+    Rows of a group must be contiguous and in order (e.g. funda sorted by gvkey and datadate).
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    fillable = np.asarray(fillable, dtype=bool)
+    n = len(values)
+    starts, ends = segment_bounds(groups)
+    row_start = np.repeat(starts, ends - starts)
+    row_end = np.repeat(ends, ends - starts)
+
+    pos = np.arange(n)
+    valid = ~np.isnan(values)
+    # position of the last valid row at or before each row, and of the first valid row after it
+    prev_pos = np.maximum.accumulate(np.where(valid, pos, -1))
+    next_pos = np.minimum.accumulate(np.where(valid, pos, n)[::-1])[::-1]
+    has_prev = prev_pos >= row_start
+    has_next = next_pos < row_end
+
+    distb = pos - prev_pos
+    distc = next_pos - pos
+    use_prev = has_prev & (~has_next | (distb <= distc))
+    use_next = has_next & ~use_prev
+
+    filled = values.copy()
+    target = fillable & ~valid
+    filled[target & use_prev] = values[prev_pos[target & use_prev]]
+    filled[target & use_next] = values[next_pos[target & use_next]]
+    return filled
+
+def linear_recurrence(init, decay, flow, starts, ends):
+    '''
+    Solves s[i] = s[i-1] * decay[i] + flow[i] inside each segment [start, end), leaving the first row of every
+    segment at its initial value.
+    All segments advance together: step t updates row t of every segment that is at least t+1 rows long. Each
+    row still sees exactly the same floating point operations as a row-by-row loop, so the output is identical.
+    '''
+    out = np.array(init, dtype=np.float64)
+    decay = np.asarray(decay, dtype=np.float64)
+    flow = np.asarray(flow, dtype=np.float64)
+    lens = ends - starts
+    if len(lens) == 0:
+        return out
+
+    # longest segments first, so the segments still active at step t are a prefix
+    order = np.argsort(-lens, kind='stable')
+    starts_sorted = starts[order]
+    lens_sorted = lens[order]
+    for t in range(1, int(lens_sorted[0])):
+        n_active = np.searchsorted(-lens_sorted, -t, side='left')
+        rows = starts_sorted[:n_active] + t
+        out[rows] = out[rows - 1] * decay[rows] + flow[rows]
+    return out
+
+def backfill_log_growth(logx, growth, groups):
+    '''
+    Backfill missing log values (e.g. logxrd, logxsga) from the next non-missing value of the same group,
+    walking backwards one row at a time: logx[j] = logx[j+1] - growth[j+1]. Missing growth rates count as zero.
+    Rows with no later non-missing value in their group stay missing.
+    Every run of missing rows is solved as a reverse linear recurrence, so the cost is linear in the number of rows.
+    Rows of a group must be contiguous and sorted by fyear.
+    '''
+    logx = np.asarray(logx, dtype=np.float64)
+    growth = np.nan_to_num(np.asarray(growth, dtype=np.float64), nan=0.0)
+    n = len(logx)
+    starts, ends = segment_bounds(groups)
+    row_end = np.repeat(ends, ends - starts)
+
+    pos = np.arange(n)
+    valid = ~np.isnan(logx)
+    next_pos = np.minimum.accumulate(np.where(valid, pos, n)[::-1])[::-1]
+    fillable = ~valid & (next_pos < row_end)
+
+    # read backwards, every non-missing row starts a run that covers the missing rows before it
+    flow = -np.append(growth[1:], 0.0)
+    run_starts, run_ends = segment_bounds(next_pos[::-1])
+    filled = linear_recurrence(logx[::-1], np.ones(n), flow[::-1], run_starts, run_ends)[::-1]
+    return np.where(fillable, filled, logx)
+
+def genkcap(kcap, theta, xrd, starts, ends):
+    '''
+    Knowledge capital: cumulate R&D with the industry-specific depreciation rate theta.
+    kcap[i] = kcap[i-1] * (1 - theta[i]) + xrd[i]
+    '''
+    return linear_recurrence(kcap, 1 - np.asarray(theta, dtype=np.float64), xrd, starts, ends)
+
+def genocap(ocap, gamma, xsga, starts, ends):
+    '''
+    Organizational capital: depreciate at 20% a year and add the share gamma of SG&A treated as investment.
+    ocap[i] = ocap[i-1] * 0.8 + xsga[i] * gamma[i]
+    '''
+    decay = np.full(len(ocap), 0.8)
+    flow = np.asarray(xsga, dtype=np.float64) * np.asarray(gamma, dtype=np.float64)
+    return linear_recurrence(ocap, decay, flow, starts, ends)
+
+# rows of the column block shared with worker processes: inputs first, then the two outputs
+CAPITAL_COLUMNS = ['kcap_v2', 'ocap_v2', 'theta_g2', 'gamma_o2', 'xrd', 'xsga']
+
+def _cumulate_block(block, starts, ends):
+    '''
+    Cumulate kcap/ocap for the firms [starts, ends) of a column block laid out as CAPITAL_COLUMNS plus two output
+    rows, writing only the rows those firms cover.
+    '''
+    lo, hi = starts[0], ends[-1]
+    kcap0, ocap0, theta, gamma, xrd, xsga = block[:6, lo:hi]
+    block[6, lo:hi] = genkcap(kcap0, theta, xrd, starts - lo, ends - lo)
+    block[7, lo:hi] = genocap(ocap0, gamma, xsga, starts - lo, ends - lo)
+
+def _cumulate_shared(shm_name, n, starts, ends):
+    '''
+    Worker: attach to the shared column block by name and cumulate one contiguous range of firms in place.
+    Only the offsets are pickled; the columns themselves are never copied.
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        block = np.ndarray((len(CAPITAL_COLUMNS) + 2, n), dtype=np.float64, buffer=shm.buf)
+        _cumulate_block(block, starts, ends)
+        del block # release the buffer before closing
+    finally:
+        shm.close()
+
+def calculate_intangible_capital(funda, batch_size=500, max_workers=1):
+    '''
+    Calculate knowledge capital (kcap_v2) and organizational capital (ocap_v2) for every gvkey in funda.
+    Rows of a firm are cumulated in the order they appear in funda; the first row of each firm keeps the
+    starting value already in kcap_v2/ocap_v2.
+
+    With max_workers > 1, the columns are sorted by gvkey once and copied into a shared memory block. A process pool
+    then cumulates contiguous ranges of batch_size firms in place. Every firm writes only its own rows, so the result
+    is the same for any number of workers.
+
+    Parameters:
+    - funda: DataFrame with columns gvkey, kcap_v2, ocap_v2, theta_g2, gamma_o2, xrd, xsga
+    - batch_size: Number of companies handled by each task
+    - max_workers: Number of worker processes (1 runs everything in this process)
+
+    Returns:
+    - Copy of funda with kcap_v2 and ocap_v2 filled in
+    '''
+    if not all(col in funda.columns for col in ['gvkey'] + CAPITAL_COLUMNS):
+        raise ValueError("Missing required columns in the input DataFrame")
+
+    # one stable sort makes every firm contiguous without changing the order within a firm
+    order = np.argsort(funda['gvkey'].to_numpy(), kind='stable')
+    starts, ends = segment_bounds(funda['gvkey'].to_numpy()[order])
+    n = len(funda)
+    shape = (len(CAPITAL_COLUMNS) + 2, n)
+    batches = [(starts[i:i + batch_size], ends[i:i + batch_size]) for i in range(0, len(starts), batch_size)]
+
+    if max_workers <= 1 or len(batches) <= 1:
+        block = np.empty(shape)
+        for i, col in enumerate(CAPITAL_COLUMNS):
+            block[i] = funda[col].to_numpy(dtype=np.float64)[order]
+        for batch_starts, batch_ends in batches:
+            _cumulate_block(block, batch_starts, batch_ends)
+        kcap, ocap = block[6], block[7]
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=8 * shape[0] * shape[1])
+        try:
+            block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            for i, col in enumerate(CAPITAL_COLUMNS):
+                block[i] = funda[col].to_numpy(dtype=np.float64)[order]
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                # consume the iterator so worker errors are raised here
+                list(pool.map(_cumulate_shared, repeat(shm.name), repeat(n),
+                              [b[0] for b in batches], [b[1] for b in batches]))
+            kcap, ocap = block[6].copy(), block[7].copy()
+            del block
+        finally:
+            shm.close()
+            shm.unlink()
+
+    kcap_v2 = np.empty(n)
+    ocap_v2 = np.empty(n)
+    kcap_v2[order] = kcap
+    ocap_v2[order] = ocap
+
+    result = funda.copy()
+    result['kcap_v2'] = kcap_v2
+    result['ocap_v2'] = ocap_v2
+    return result
+
+# inputs that determine a firm's stocks; a change in any of them means the firm is recomputed from scratch
+HISTORY_COLUMNS = ['fyear', 'theta_g2', 'gamma_o2', 'xrd', 'xsga']
+
+def firm_hashes(funda):
+    '''
+    Content hash of each firm's history: one sha256 per gvkey over HISTORY_COLUMNS of its rows, in order.
+    Returns a Series of hex digests indexed by gvkey.
+    '''
+    order = np.argsort(funda['gvkey'].to_numpy(), kind='stable')
+    keys = funda['gvkey'].to_numpy()[order]
+    rows = pd.util.hash_pandas_object(funda[HISTORY_COLUMNS].astype('float64'), index=False).to_numpy()[order]
+    starts, ends = segment_bounds(keys)
+    digests = [hashlib.sha256(rows[s:e].tobytes()).hexdigest() for s, e in zip(starts, ends)]
+    return pd.Series(digests, index=pd.Index(keys[starts], name='gvkey'), name='history_hash', dtype=object)
+
+def save_intangible_state(path, funda, growth):
+    '''
+    Persist what an incremental run needs to continue from this one, in the directory path:
+    - firms.parquet: for every gvkey, the last fyear, the stocks in that year, and the content hash of its history
+    - growth.parquet: the growth rate tables (name -> Series of grate indexed by ageipo) used to impute flows
+
+    funda is the output of calculate_intangible_capital or update_intangible_capital, before any rows are dropped.
+    '''
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    last = funda.sort_values(['gvkey', 'fyear'], kind='stable').drop_duplicates(subset=['gvkey'], keep='last')
+    firms = last[['gvkey', 'fyear', 'kcap_v2', 'ocap_v2']].rename(columns={'fyear': 'last_fyear'})
+    firms = firms.merge(firm_hashes(funda).reset_index(), on='gvkey', how='left')
+    firms.to_parquet(path / 'firms.parquet', index=False)
+
+    tables = [pd.DataFrame({'table': name, 'ageipo': pd.Series(rates.index, dtype='float64'),
+                            'grate': pd.Series(rates.values, dtype='float64')})
+              for name, rates in growth.items()]
+    pd.concat(tables, ignore_index=True).to_parquet(path / 'growth.parquet', index=False)
+
+def load_intangible_state(path):
+    '''
+    Read the state written by save_intangible_state.
+    Returns the firms table and a dict of growth rate tables (name -> Series of grate indexed by ageipo).
+    '''
+    path = Path(path)
+    firms = pd.read_parquet(path / 'firms.parquet')
+    tables = pd.read_parquet(path / 'growth.parquet')
+    growth = {name: t.set_index('ageipo')['grate'].rename_axis(None) for name, t in tables.groupby('table', sort=False)}
+    return firms, growth
+
+def update_intangible_capital(funda, previous, firms, batch_size=500, max_workers=1):
+    '''
+    Incremental version of calculate_intangible_capital for a refreshed funda.
+    A firm whose history up to its last saved fyear hashes the same as in firms keeps its previous stocks, and only
+    its new fiscal years are cumulated, starting from the saved stocks. Every other firm (new, or with restated
+    history) is recomputed in full. The stocks are the same as those of calculate_intangible_capital on this funda.
+
+    This is not the same as a full rebuild of the refreshed data: the flows imputed in funda (backfilled xrd and
+    xsga) come from the growth rate tables frozen in the saved state, which the new years never update. A full run
+    (calculate_intangible_capital) re-estimates the growth rates.
+
+    Parameters:
+    - funda: DataFrame with the columns required by calculate_intangible_capital, sorted by gvkey and fyear
+    - previous: output of the last run (gvkey, fyear, kcap_v2, ocap_v2)
+    - firms: firms table from load_intangible_state
+    - batch_size, max_workers: passed on to calculate_intangible_capital
+
+    Returns:
+    - Copy of funda with kcap_v2 and ocap_v2 filled in
+    '''
+    saved = firms.set_index('gvkey')
+    last_fyear = funda['gvkey'].map(saved['last_fyear'])
+    in_history = (funda['fyear'] <= last_fyear).to_numpy()
+
+    # only firms whose saved history is unchanged (same rows, same flows) can be continued
+    hashes = firm_hashes(funda[in_history])
+    unchanged = hashes.index[hashes.to_numpy() == saved['history_hash'].reindex(hashes.index).to_numpy()]
+    keep = funda['gvkey'].isin(unchanged).to_numpy()
+    old_rows = keep & in_history
+    new_rows = keep & ~in_history
+
+    kcap_v2 = np.full(len(funda), np.nan)
+    ocap_v2 = np.full(len(funda), np.nan)
+
+    # firms that are new or restated
+    if (~keep).any():
+        full = calculate_intangible_capital(funda[~keep], batch_size=batch_size, max_workers=max_workers)
+        kcap_v2[~keep] = full['kcap_v2'].to_numpy()
+        ocap_v2[~keep] = full['ocap_v2'].to_numpy()
+
+    # unchanged years: previous output, with the saved stocks for the last year
+    old = funda.loc[old_rows, ['gvkey', 'fyear']].merge(previous[['gvkey', 'fyear', 'kcap_v2', 'ocap_v2']],
+                                                       on=['gvkey', 'fyear'], how='left', validate='many_to_one')
+    is_last = (funda.loc[old_rows, 'fyear'] == last_fyear[old_rows]).to_numpy()
+    old_gvkeys = funda.loc[old_rows, 'gvkey']
+    kcap_v2[old_rows] = np.where(is_last, old_gvkeys.map(saved['kcap_v2']), old['kcap_v2'])
+    ocap_v2[old_rows] = np.where(is_last, old_gvkeys.map(saved['ocap_v2']), old['ocap_v2'])
+
+    # new years: each firm's saved last year is prepended as the starting row of the recurrence
+    if new_rows.any():
+        new = funda.loc[new_rows, ['gvkey'] + CAPITAL_COLUMNS]
+        seeds = saved.loc[new['gvkey'].unique(), ['kcap_v2', 'ocap_v2']].reset_index()
+        continued = calculate_intangible_capital(pd.concat([seeds, new], ignore_index=True),
+                                                 batch_size=batch_size, max_workers=max_workers)
+        continued = continued.iloc[len(seeds):]
+        kcap_v2[new_rows] = continued['kcap_v2'].to_numpy()
+        ocap_v2[new_rows] = continued['ocap_v2'].to_numpy()
+
+    result = funda.copy()
+    result['kcap_v2'] = kcap_v2
+    result['ocap_v2'] = ocap_v2
+    return result
@@ -0,0 +1,359 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+def file_hash(path, chunk_size=1 << 24):
+    '''
+    sha256 of a file's contents, read in chunks so that multi-GB downloads are never held in memory.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def file_fingerprint(path):
+    '''
+    Size and modification time of a file, to store with a job (or a converted CSV) so that a rewritten input is
+    run again.
+    '''
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def parquet_path(src):
+    '''
+    Location of the Parquet dataset converted from a raw CSV: a directory next to it, e.g. funda.csv -> funda.parquet/
+    '''
+    return Path(src).with_suffix('.parquet')
+
+def _widen(a, b):
+    '''
+    Narrowest type holding values of types a and b: a null (empty) column takes the other type, integers widen to
+    int64 and then to float64 next to floats, anything else mixed becomes a string.
+    '''
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    if pa.types.is_integer(a) and pa.types.is_integer(b):
+        return pa.int64()
+    if (pa.types.is_integer(a) or pa.types.is_floating(a)) and (pa.types.is_integer(b) or pa.types.is_floating(b)):
+        return pa.float64()
+    return pa.string()
+
+def sample_schema(src, samples=16, sample_size=1 << 22):
+    '''
+    Column types of a CSV inferred from samples spread over the whole file (the first sample_size bytes and
+    samples - 1 more windows at evenly spaced offsets), rather than from the first block only: a column that is
+    empty or all-integer at the top of the file but holds floats or text further down gets float64 or string.
+    Windows that cannot be parsed on their own (e.g. starting inside a quoted field with line breaks) are skipped.
+    '''
+    options = pv.ConvertOptions(strings_can_be_null=True)
+    schema = pv.open_csv(src, read_options=pv.ReadOptions(block_size=sample_size), convert_options=options).schema
+    types = {field.name: field.type for field in schema}
+    size = os.path.getsize(src)
+    with open(src, 'rb') as f:
+        for offset in np.linspace(0, size, samples, endpoint=False)[1:].astype(np.int64):
+            f.seek(offset)
+            f.readline() # skip to the start of the next row
+            window = f.read(sample_size)
+            window = window[:window.rfind(b'\n') + 1]
+            if not window:
+                continue
+            try:
+                sample = pv.read_csv(pa.py_buffer(window), read_options=pv.ReadOptions(column_names=schema.names),
+                                     convert_options=options)
+            except pa.ArrowInvalid:
+                continue
+            for field in sample.schema:
+                types[field.name] = _widen(types[field.name], field.type)
+    return pa.schema([(name, t) for name, t in types.items()])
+
+def csv_to_parquet(src, dest=None, partition_cols=('fyear',), column_types=None, block_size=1 << 26):
+    '''
+    Convert a raw CSV into a typed Parquet dataset, once. The CSV is streamed in blocks, so peak memory does not
+    depend on the file size. Columns listed in partition_cols that exist in the file become hive partitions
+    (e.g. fyear=1999/), which lets readers skip whole years. Partitioning groups the rows by partition, so the
+    dataset does not keep the row order of the CSV: readers that depend on it must sort explicitly (e.g.
+    sort_values(['gvkey', 'datadate'])).
+
+    The size and modification time of the source are stored with the dataset, with its sha256 and the options
+    of the conversion; while they are unchanged nothing is done, and the file is only hashed again when its size
+    or modification time changed (if its contents are the same, e.g. after a copy, it is not converted again).
+
+    Column types are inferred from samples spread over the whole file (sample_schema). If a value further down
+    still does not fit its column (e.g. the only non-empty values of a column are in a part that was not
+    sampled), the column is widened (null or integer -> float64 -> string) and the conversion restarted.
+    column_types (column -> pyarrow type) overrides inference, e.g. to keep cusip as a string when its values
+    look numeric. Types may be given as pyarrow types or as aliases such as 'string' or 'float64'.
+    Returns the path of the dataset.
+    '''
+    src = Path(src)
+    dest = parquet_path(src) if dest is None else Path(dest)
+    marker = dest / '_source.json'
+    column_types = {col: pa.type_for_alias(t) if isinstance(t, str) else t for col, t in (column_types or {}).items()}
+    options = {'partition_cols': list(partition_cols or []), 'column_types': {col: str(t) for col, t in column_types.items()}}
+    fingerprint = file_fingerprint(src)
+
+    if marker.exists():
+        with open(marker) as f:
+            previous = json.load(f)
+        if previous.get('options') == options:
+            if previous.get('fingerprint') == fingerprint:
+                return dest
+            digest = file_hash(src)
+            if previous.get('sha256') == digest:
+                with open(marker, 'w') as f:
+                    json.dump({**previous, 'fingerprint': fingerprint}, f)
+                return dest
+    digest = file_hash(src)
+
+    sampled = sample_schema(src)
+    types = {field.name: field.type for field in sampled}
+    types.update(column_types)
+    for _ in range(2 * len(types) + 1): # each retry widens a column; a column widens at most twice
+        if dest.exists():
+            shutil.rmtree(dest)
+        try:
+            reader = pv.open_csv(src, read_options=pv.ReadOptions(block_size=block_size),
+                                 convert_options=pv.ConvertOptions(column_types=types, strings_can_be_null=True))
+            schema = reader.schema
+            partition_cols = [col for col in options['partition_cols'] if col in schema.names]
+            partitioning = ds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor='hive') \
+                if partition_cols else None
+            ds.write_dataset(reader, dest, format='parquet', partitioning=partitioning, preserve_order=True,
+                             existing_data_behavior='overwrite_or_ignore',
+                             file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+            break
+        except pa.ArrowInvalid as e:
+            bad = re.match(r'In CSV column #(\d+): .*invalid value \'(.*)\'', str(e), re.DOTALL)
+            if bad is None:
+                raise
+            col = sampled.names[int(bad.group(1))]
+            if col in column_types:
+                raise ValueError(f"{src}: column {col} has values that are not {column_types[col]} "
+                                 f"(e.g. '{bad.group(2)}'); change its entry in column_types") from e
+            try:
+                float(bad.group(2))
+                widened = _widen(types[col], pa.float64())
+            except ValueError:
+                widened = pa.string()
+            if widened == types[col]:
+                raise
+            types[col] = widened
+
+    # the schema is kept so that partition columns come back with their original type
+    with open(dest / '_schema.arrow', 'wb') as f:
+        f.write(schema.serialize())
+    with open(marker, 'w') as f:
+        json.dump({'source': str(src), 'sha256': digest, 'fingerprint': fingerprint, 'options': options,
+                   'partition_cols': partition_cols}, f)
+    return dest
+
+def parquet_dataset(source):
+    '''
+    A Parquet file, or a folder of Parquet files (optionally hive-partitioned, e.g. fyear=1999/), as a pyarrow
+    dataset. Only the folder's *.parquet files are read, so a folder that is still being written (temporary
+    files such as chunk3.tmp of embed_parquet, or left by a crashed worker) or holds sidecar files (JSON
+    manifests, units.json) can be read; files and folders starting with _ or . are skipped as well.
+    A list of files is read as it is.
+    '''
+    if isinstance(source, (list, tuple)):
+        return ds.dataset([str(path) for path in source], format='parquet')
+    source = Path(source)
+    if not source.is_dir():
+        return ds.dataset(source, format='parquet')
+    files = [str(path) for path in sorted(source.rglob('*.parquet'))
+             if not any(part.startswith(('_', '.')) for part in path.relative_to(source).parts)]
+    return ds.dataset(files, format='parquet', partitioning='hive', partition_base_dir=str(source))
+
+def read_table(src, columns=None, filters=None, **convert_kwargs):
+    '''
+    Read a table with column pruning and predicate pushdown.
+    src is either a raw CSV, which is converted with csv_to_parquet on first use (extra keyword arguments are
+    passed on), or a Parquet file/dataset. columns selects columns; filters is a pyarrow filter expression or a
+    list of (column, op, value) tuples as in pd.read_parquet, e.g. [('fyear', '>=', 1977), ('indfmt', '==', 'INDL')].
+    Filters on partition columns skip whole files; other filters use the Parquet row-group statistics.
+    Rows of a partitioned dataset come grouped by partition, not in the order of the CSV; sort them if it matters.
+    Returns a pandas DataFrame.
+    '''
+    src = Path(src)
+    if src.suffix == '.csv':
+        src = csv_to_parquet(src, **convert_kwargs)
+
+    schema_file = src / '_schema.arrow' if src.is_dir() else None
+    if schema_file is not None and schema_file.exists():
+        schema = pa.ipc.read_schema(pa.py_buffer(schema_file.read_bytes()))
+        with open(src / '_source.json') as f:
+            partition_cols = json.load(f)['partition_cols']
+        partitioning = ds.partitioning(pa.schema([schema.field(col) for col in partition_cols]), flavor='hive') \
+            if partition_cols else None
+        dataset = ds.dataset(src, schema=schema, format='parquet', partitioning=partitioning)
+    else:
+        dataset = parquet_dataset(src)
+
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+def write_table(df, path, partition_cols=None):
+    '''
+    Write an intermediate output as Parquet (zstd) instead of CSV, optionally partitioned (e.g. by fyear).
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(path, index=False, compression='zstd', partition_cols=partition_cols)
+
+class ShardedStore:
+    '''
+    Append-only checkpoint store for records keyed by one column (e.g. a filing URL), kept in a directory of
+    immutable Parquet shards. Records are buffered and written as a new shard every shard_size records; until
+    then they are also appended to a small JSONL journal, so a crash loses at most the records in flight. The
+    journal is turned into a shard when the store is reopened.
+
+    Memory stays flat: only the current buffer is held, and keys() reads only the key column of the shards.
+    A key written twice (e.g. a retried filing) resolves to its latest record in read() and compact().
+    '''
+    def __init__(self, path, key, schema=None, shard_size=500):
+        self.path = Path(path)
+        self.key = key
+        self.schema = schema
+        self.shard_size = shard_size
+        self.journal = self.path / '_journal.jsonl'
+        self.buffer = []
+        self.file = None
+
+    def shards(self):
+        return sorted(self.path.glob('part-*.parquet'))
+
+    def _journal_records(self):
+        if not self.journal.exists():
+            return []
+        records = []
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # interrupted write
+        return records
+
+    def keys(self):
+        '''
+        Set of keys already stored, for resuming by set difference.
+        '''
+        keys = set()
+        for shard in self.shards():
+            keys.update(pq.read_table(shard, columns=[self.key]).column(0).to_pylist())
+        keys.update(record[self.key] for record in self._journal_records())
+        return keys
+
+    def open(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.buffer = self._journal_records()
+        self._write_shard()
+        self.file = open(self.journal, 'w')
+
+    def put(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.buffer.append(record)
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered records as a new shard and empty the journal.
+        '''
+        if self._write_shard() and self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+
+    def _write_shard(self):
+        if not self.buffer:
+            return False
+        shards = self.shards()
+        number = int(shards[-1].stem.split('-')[1]) + 1 if shards else 0
+        shard = self.path / f'part-{number:06d}.parquet'
+        tmp = shard.with_suffix('.tmp')
+        pq.write_table(pa.Table.from_pylist(self.buffer, schema=self.schema), tmp, compression='zstd')
+        os.replace(tmp, shard) # a shard is either complete or absent
+        self.buffer = []
+        return True
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.journal.exists() and self.journal.stat().st_size == 0:
+            self.journal.unlink()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _latest(self, keys=None):
+        '''
+        For each shard, a boolean mask of the rows holding the latest record of their key (restricted to keys).
+        '''
+        shards = self.shards()
+        last = {}
+        for i, shard in enumerate(shards):
+            for j, k in enumerate(pq.read_table(shard, columns=[self.key]).column(0).to_pylist()):
+                last[k] = (i, j)
+        masks = [np.zeros(pq.ParquetFile(shard).metadata.num_rows, dtype=bool) for shard in shards]
+        for k, (i, j) in last.items():
+            if keys is None or k in keys:
+                masks[i][j] = True
+        return list(zip(shards, masks))
+
+    def read(self, columns=None, keys=None):
+        '''
+        Latest record per key as a DataFrame. Pass columns to load only part of the records (e.g. the key and
+        an error flag) when the full store would not fit in memory.
+        '''
+        if columns is not None and self.key not in columns:
+            columns = [self.key] + list(columns)
+        tables = [pq.read_table(shard, columns=columns).filter(pa.array(mask))
+                  for shard, mask in self._latest(keys)]
+        if not tables:
+            return pd.DataFrame(columns=columns if columns is not None else
+                                (self.schema.names if self.schema is not None else [self.key]))
+        return pa.concat_tables(tables).to_pandas()
+
+    def compact(self, dest, keys=None, columns=None):
+        '''
+        Stream the latest record per key (optionally restricted to keys) into a single Parquet file, one shard
+        at a time. Rows follow the order in which they were stored.
+        Returns the path of the file.
+        '''
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_suffix('.tmp')
+        writer = None
+        try:
+            for shard, mask in self._latest(keys):
+                table = pq.read_table(shard, columns=columns).filter(pa.array(mask))
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp, table.schema, compression='zstd')
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pq.write_table(pa.Table.from_pylist([], schema=self.schema), tmp)
+        os.replace(tmp, dest)
+        return dest
@@ -0,0 +1,295 @@
+import numpy as np
+import heapq
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+import multiprocessing as mp
+from pathlib import Path
+from .io import file_fingerprint
+
+def _write_json(path, record):
+    '''
+    Write a JSON file atomically (temporary file, then rename), so readers never see a partial record.
+    '''
+    tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+    with open(tmp, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def split_by_tokens(tokens, per_unit):
+    '''
+    Split consecutive rows into work units of about per_unit estimated tokens each (rather than a fixed number of
+    rows), as evenly as the row sizes allow. Returns the unit boundaries: unit i holds rows bounds[i]:bounds[i+1].
+    '''
+    cumulative = np.cumsum(np.asarray(tokens, dtype=np.float64))
+    if len(cumulative) == 0:
+        return np.array([0])
+    units = max(int(np.ceil(cumulative[-1] / per_unit)), 1)
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, units) / units) + 1
+    return np.unique(np.concatenate([[0], cuts, [len(cumulative)]]))
+
+def assign_shares(estimates, workers):
+    '''
+    Deal jobs to workers so that their estimated loads are balanced: largest job first, each to the least
+    loaded worker. Deterministic, so every worker computes the same shares. Returns the owner of each job.
+    '''
+    estimates = np.asarray(estimates, dtype=np.float64)
+    owners = np.zeros(len(estimates), dtype=np.int64)
+    loads = [(0.0, w) for w in range(workers)]
+    for i in np.argsort(-estimates, kind='stable'):
+        load, w = heapq.heappop(loads)
+        owners[i] = w
+        heapq.heappush(loads, (load + estimates[i], w))
+    return owners
+
+class JobQueue:
+    '''
+    File-based job queue shared by any number of workers, on any nodes that see the directory. Workers can join
+    or leave at any time.
+
+    Layout of path:
+    - jobs/<id>.json: the job (any JSON fields, e.g. input and output paths)
+    - claims/<id>.lock: created atomically (O_EXCL) by the worker that runs the job, and touched as a heartbeat;
+      a claim whose heartbeat is older than stale_after seconds (a worker that died) can be taken over
+    - done/<id>.json: completion record (worker, timing, anything the handler returns)
+    - failed/<id>.json: errors of failed attempts; a job is retried until it has failed max_attempts times
+
+    Jobs may carry a 'tokens' estimate of their size. Workers that pass a share (rank, workers) to next() work
+    through their own balanced share of the jobs first (assign_shares), largest first, and then steal pending
+    jobs from the share with the most work left.
+    '''
+    def __init__(self, path, stale_after=600, max_attempts=3):
+        self.path = Path(path)
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        for sub in ('jobs', 'claims', 'done', 'failed'):
+            (self.path / sub).mkdir(parents=True, exist_ok=True)
+
+    def _file(self, sub, job_id, suffix='.json'):
+        return self.path / sub / f'{job_id}{suffix}'
+
+    def add(self, job_id, **job):
+        '''
+        Add a job. A job that is already queued with the same fields is left alone (with its completion record),
+        so reruns only do what is missing; if its fields changed (e.g. the input file was rewritten, see
+        file_fingerprint), it is replaced and will run again. Returns whether the job was added or replaced.
+        '''
+        path = self._file('jobs', job_id)
+        job = {'id': job_id, **job}
+        if _read_json(path) == job:
+            return False
+        _write_json(path, job)
+        for sub in ('done', 'failed'):
+            try:
+                os.unlink(self._file(sub, job_id))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def prune(self, keep):
+        '''
+        Remove the jobs whose id is not in keep (e.g. files that a re-split of the inputs no longer produces),
+        with their claims and completion records. Run it while no worker is busy with those jobs.
+        Returns the removed jobs, so that the caller can delete their outputs.
+        '''
+        keep = set(keep)
+        removed = [job for job in self.jobs() if job['id'] not in keep]
+        for job in removed:
+            for sub, suffix in (('jobs', '.json'), ('claims', '.lock'), ('done', '.json'), ('failed', '.json')):
+                try:
+                    os.unlink(self._file(sub, job['id'], suffix))
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def jobs(self):
+        return [job for job in (_read_json(p) for p in sorted((self.path / 'jobs').glob('*.json'))) if job]
+
+    def done(self, job_id):
+        return _read_json(self._file('done', job_id))
+
+    def attempts(self, job_id):
+        return len(_read_json(self._file('failed', job_id)) or [])
+
+    def pending(self):
+        '''
+        Jobs that are neither done, nor failed too often, nor held by a live claim.
+        '''
+        return [job for job in self.jobs() if not self._file('done', job['id']).exists()
+                and self.attempts(job['id']) < self.max_attempts and not self._claimed(job['id'])]
+
+    def _claimed(self, job_id):
+        try:
+            return time.time() - self._file('claims', job_id, '.lock').stat().st_mtime < self.stale_after
+        except FileNotFoundError:
+            return False
+
+    def claim(self, job_id, worker):
+        '''
+        Try to take a job for worker. Only one worker can succeed; a stale claim is broken first.
+        '''
+        lock = self._file('claims', job_id, '.lock')
+        if self._file('done', job_id).exists():
+            return False
+        if lock.exists() and not self._claimed(job_id):
+            # rename is atomic: only one of the workers breaking the same stale claim succeeds
+            stale = lock.with_name(f'.{lock.name}.{uuid.uuid4().hex}')
+            try:
+                os.rename(lock, stale)
+                os.unlink(stale)
+            except FileNotFoundError:
+                return False
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': worker, 'claimed': time.time()}, f)
+        return True
+
+    def next(self, worker, share=None):
+        '''
+        Claim the next pending job for worker; returns the job, or None when there is nothing left to claim.
+        With share=(rank, workers), the worker's own jobs come first, then jobs stolen from other shares: the one
+        the owner of the most remaining work would reach last. The returned job has 'owner' set.
+        '''
+        candidates = self.pending()
+        if share is not None:
+            rank, workers = share
+            # shares are dealt over all jobs (done or not), so they do not move as jobs finish
+            jobs = self.jobs()
+            owners = assign_shares([job.get('tokens', 1) for job in jobs], workers)
+            owners = {job['id']: int(owner) for job, owner in zip(jobs, owners)}
+            by_size = sorted(({**job, 'owner': owners[job['id']]} for job in candidates),
+                             key=lambda job: -job.get('tokens', 1))
+            remaining = {}
+            for job in by_size:
+                remaining[job['owner']] = remaining.get(job['owner'], 0) + job.get('tokens', 1)
+            candidates = [job for job in by_size if job['owner'] == rank]
+            for victim in sorted(remaining, key=lambda w: -remaining[w]):
+                if victim != rank:
+                    candidates += [job for job in reversed(by_size) if job['owner'] == victim]
+        for job in candidates:
+            if self.claim(job['id'], worker):
+                return job
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self._file('claims', job_id, '.lock'))
+        except FileNotFoundError:
+            pass
+
+    def release(self, job_id):
+        try:
+            os.unlink(self._file('claims', job_id, '.lock'))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, job_id, **record):
+        _write_json(self._file('done', job_id), {'id': job_id, **record})
+        self.release(job_id)
+
+    def fail(self, job_id, **record):
+        failures = _read_json(self._file('failed', job_id)) or []
+        _write_json(self._file('failed', job_id), failures + [record])
+        self.release(job_id)
+
+    def records(self):
+        '''
+        Completion records of all finished jobs (worker, timing, throughput, ...).
+        '''
+        return [r for r in (_read_json(p) for p in sorted((self.path / 'done').glob('*.json'))) if r]
+
+    def status(self):
+        jobs = self.jobs()
+        done = sum(self._file('done', job['id']).exists() for job in jobs)
+        running = sum(self._claimed(job['id']) for job in jobs)
+        failed = sum(self.attempts(job['id']) >= self.max_attempts for job in jobs)
+        return {'jobs': len(jobs), 'done': done, 'running': running, 'failed': failed,
+                'pending': len(jobs) - done - running - failed}
+
+def worker_name(rank=0):
+    return f'{socket.gethostname()}-{os.getpid()}-{rank}'
+
+def run_worker(queue, handler, worker=None, heartbeat=60, wait=False, poll=30, share=None):
+    '''
+    Claim jobs from queue and run handler(job) on each until no job is left (with wait, keep polling every poll
+    seconds for new jobs instead); share=(rank, workers) makes the worker start with its own share of the jobs
+    and steal from the others afterwards (see JobQueue.next). The claim is touched every heartbeat seconds while
+    the handler runs. What the handler returns (a dict) is stored in the job's completion record, with the
+    worker, the run time and the throughput in estimated tokens per second; an exception is recorded as a failed
+    attempt and the worker moves on. On interruption the claim is released, so another worker picks the job up.
+    Handlers should write their output atomically (e.g. embed_parquet writes a temporary file and renames it).
+    Returns the number of jobs completed.
+    '''
+    worker = worker or worker_name()
+    completed = 0
+    while True:
+        job = queue.next(worker, share)
+        if job is None:
+            if not wait:
+                return completed
+            time.sleep(poll)
+            continue
+
+        stop = threading.Event()
+        def beat(job_id=job['id']):
+            while not stop.wait(heartbeat):
+                queue.heartbeat(job_id)
+        beat = threading.Thread(target=beat, daemon=True)
+        beat.start()
+        start = time.time()
+        try:
+            record = handler(job) or {}
+        except KeyboardInterrupt:
+            queue.release(job['id'])
+            raise
+        except Exception:
+            queue.fail(job['id'], worker=worker, error=traceback.format_exc(), seconds=time.time() - start)
+            continue
+        finally:
+            stop.set()
+            beat.join()
+        seconds = time.time() - start
+        throughput = {'tokens': job['tokens'], 'tokens_per_second': job['tokens'] / seconds} if 'tokens' in job else {}
+        stolen = {'stolen': job['owner'] != share[0]} if share is not None else {}
+        queue.complete(job['id'], worker=worker, started=start, seconds=seconds, **throughput, **stolen, **record)
+        completed += 1
+
+def _serve(path, make_handler, rank, share, kwargs):
+    queue = JobQueue(path, **kwargs.pop('queue_options', {}))
+    handler = make_handler(rank) # loaded once per worker process, e.g. the model
+    run_worker(queue, handler, worker=worker_name(rank), share=share, **kwargs)
+
+def serve(queue, make_handler, processes=1, task=0, tasks=1, **kwargs):
+    '''
+    Run processes long-lived worker processes on this node. Each builds its handler once with
+    make_handler(rank), e.g. loading the model onto GPU number rank, keeps it warm, and pulls jobs from queue
+    (a JobQueue) with run_worker. make_handler must be a module-level function (workers are spawned).
+    task and tasks (e.g. SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT) give each of the tasks * processes
+    workers its own share of the jobs to start with; workers that finish early steal from the others.
+    Blocks until all workers exit.
+    '''
+    kwargs['queue_options'] = {'stale_after': queue.stale_after, 'max_attempts': queue.max_attempts}
+    shares = [(task * processes + rank, tasks * processes) for rank in range(processes)]
+    if processes == 1:
+        return _serve(str(queue.path), make_handler, 0, shares[0], kwargs)
+    ctx = mp.get_context('spawn')
+    workers = [ctx.Process(target=_serve, args=(str(queue.path), make_handler, rank, shares[rank], dict(kwargs)))
+               for rank in range(processes)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
@@ -0,0 +1,107 @@
+import pandas as pd
+import numpy as np
+
+def to_link_date(values):
+    '''
+    Parse WRDS dates given as YYYYMMDD numbers/strings or ISO strings. Codes that are not dates, such as the
+    'B' (earliest) and 'E' (latest) link bounds or 0, become NaT, which interval_join treats as open-ended.
+    '''
+    s = pd.Series(values).astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+    return pd.to_datetime(s, format='mixed', errors='coerce')
+
+def _ordinal(series):
+    '''
+    Comparable numeric values for dates or numbers: int64 nanoseconds for dates, float64 otherwise.
+    Returns the values and a mask of missing entries.
+    '''
+    missing = series.isna().to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy(dtype='datetime64[ns]').view(np.int64), missing
+    return series.to_numpy(dtype=np.float64), missing
+
+def interval_join(left, right, on, date, start, end, how='inner', suffixes=('_x', '_y'), chunk_size=5_000_000):
+    '''
+    Join each row of left to the rows of right with the same key (on) whose interval [start, end] contains the
+    left row's date, e.g. 10-K filings to date-bounded CIK-gvkey links, or Compustat firm-years to CCM links.
+    Both bounds are inclusive. A missing start or end in right means the link is open on that side; a missing date
+    or key in left never matches.
+
+    Right is sorted once by (key, start); for every left row a searchsorted gives the links of its key that started
+    on or before its date, and only those are checked against end, chunk by chunk. Memory therefore depends on the
+    output (plus chunk_size candidates), not on the product of left and right rows per key.
+
+    Parameters:
+    - on: key column name or list of names present in both frames
+    - date: date column of left; start, end: interval columns of right (same kind of values as date)
+    - how: 'inner', or 'left' to keep left rows without a valid link (right columns missing)
+
+    Returns:
+    - DataFrame with the columns of left followed by those of right except on. Rows follow left's order, and
+      the matches of a row follow right's order, as in pd.merge.
+    '''
+    on = [on] if isinstance(on, str) else list(on)
+    if how not in ('inner', 'left'):
+        raise ValueError("how must be 'inner' or 'left'")
+
+    # integer codes for the keys, shared by both sides (-1 for missing keys)
+    keys = pd.concat([left[on], right[on]], ignore_index=True)
+    codes = keys.groupby(on, sort=True, dropna=True).ngroup().to_numpy()
+    lcode, rcode = codes[:len(left)], codes[len(left):]
+
+    ldate, lmissing = _ordinal(left[date])
+    rstart, smissing = _ordinal(right[start])
+    rend, emissing = _ordinal(right[end])
+    if ldate.dtype == np.int64:
+        rstart = np.where(smissing, np.iinfo(np.int64).min, rstart)
+        rend = np.where(emissing, np.iinfo(np.int64).max, rend)
+    else:
+        rstart = np.where(smissing, -np.inf, rstart)
+        rend = np.where(emissing, np.inf, rend)
+
+    # right sorted by key, then start; rows without a key are left out
+    rrows = np.flatnonzero(rcode >= 0)
+    rrows = rrows[np.lexsort((rstart[rrows], rcode[rrows]))]
+    rcode_s, rstart_s, rend_s = rcode[rrows], rstart[rrows], rend[rrows]
+
+    # (key, value) pairs become one sortable integer through dense ranks of the values
+    valid = (lcode >= 0) & ~lmissing
+    values = np.unique(np.concatenate([rstart_s, ldate[valid]]))
+    width = len(values) + 1
+    rcomposite = rcode_s * width + np.searchsorted(values, rstart_s)
+    lcomposite = lcode * width + np.searchsorted(values, ldate)
+    lo = np.searchsorted(rcode_s, lcode, side='left')
+    hi = np.where(valid, np.searchsorted(rcomposite, lcomposite, side='right'), lo)
+    counts = hi - lo
+
+    # expand candidates in chunks and keep those whose link has not ended
+    lidx, ridx = [], []
+    cumulative = np.cumsum(counts)
+    first = 0
+    while first < len(left):
+        # at least one left row per chunk, then as many as fit in chunk_size candidates
+        last = max(first + 1, np.searchsorted(cumulative, cumulative[first] - counts[first] + chunk_size, side='right'))
+        rows = np.arange(first, last)
+        n = counts[rows]
+        li = np.repeat(rows, n)
+        pos = np.repeat(lo[rows] - (np.cumsum(n) - n), n) + np.arange(n.sum())
+        hit = rend_s[pos] >= ldate[li]
+        lidx.append(li[hit])
+        ridx.append(rrows[pos[hit]])
+        first = last
+    lidx = np.concatenate(lidx) if lidx else np.zeros(0, dtype=np.int64)
+    ridx = np.concatenate(ridx) if ridx else np.zeros(0, dtype=np.int64)
+
+    if how == 'left':
+        unmatched = np.setdiff1d(np.arange(len(left)), lidx)
+        lidx = np.concatenate([lidx, unmatched])
+        ridx = np.concatenate([ridx, np.full(len(unmatched), -1)])
+    order = np.lexsort((np.where(ridx < 0, len(right), ridx), lidx))
+    lidx, ridx = lidx[order], ridx[order]
+
+    right_cols = [col for col in right.columns if col not in on]
+    overlap = set(right_cols) & set(left.columns)
+    lpart = left.iloc[lidx].reset_index(drop=True)
+    lpart = lpart.rename(columns={col: col + suffixes[0] for col in overlap})
+    rpart = right[right_cols].reset_index(drop=True).reindex(ridx).reset_index(drop=True)
+    rpart = rpart.rename(columns={col: col + suffixes[1] for col in overlap})
+    return pd.concat([lpart, rpart], axis=1)
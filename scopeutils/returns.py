@@ -0,0 +1,63 @@
+import pandas as pd
+import numpy as np
+from .intangibles import segment_bounds
+
+def compound_returns(df, by, ret_col='ret', date_col='date'):
+    '''
+    Compound periodic returns within groups: prod(1 + ret) - 1, in date order. A group with any missing return
+    gets a missing compounded return (NaN propagates through the product).
+    Groups come from one groupby pass (ngroup); the returns are then sorted into contiguous segments and reduced
+    with np.multiply.reduceat, so no Python function is called per group. Groups with a missing key are dropped,
+    as in groupby.
+    Returns a DataFrame with the columns in by plus ret_col, one row per group, sorted by the group keys.
+    '''
+    by = list(by)
+    codes = df.groupby(by, sort=True, dropna=True).ngroup().to_numpy()
+    keep = codes >= 0
+    codes = codes[keep]
+    dates = df[date_col].to_numpy()[keep]
+    gross = 1 + df[ret_col].to_numpy(dtype=np.float64)[keep]
+
+    # by group, then by date; ties keep their original order
+    order = np.lexsort((dates, codes))
+    starts, _ = segment_bounds(codes[order])
+
+    out = df[by].iloc[np.flatnonzero(keep)[order[starts]]].reset_index(drop=True)
+    out[ret_col] = np.multiply.reduceat(gross[order], starts) - 1 if len(starts) else np.zeros(0)
+    return out
+
+def annual_returns(crsp, keys=('PERMNO',), fiscal_ends=None, ret_col='ret', date_col='date', months=12):
+    '''
+    Compound monthly CRSP returns into annual returns.
+
+    Calendar years (fiscal_ends=None): groups are the first key, 'year' (the calendar year of date_col, added to
+    crsp if missing), then the remaining keys, e.g. PERMNO, year, crsp_first_date.
+    Fiscal years: fiscal_ends is a table with the columns in keys plus 'datadate' (e.g. Compustat fiscal year ends
+    linked to PERMNO), and any other columns to carry along, such as gvkey or fyear. Each month is assigned to the
+    first fiscal year end on or after it and kept if it falls within the months months ending at that datadate's
+    month; returns are then compounded per fiscal year end.
+
+    Returns a DataFrame with the group keys (or the fiscal_ends columns) and ret_col.
+    '''
+    keys = list(keys)
+    if fiscal_ends is None:
+        if 'year' not in crsp.columns:
+            crsp = crsp.assign(year=pd.to_datetime(crsp[date_col]).dt.year)
+        return compound_returns(crsp, keys[:1] + ['year'] + keys[1:], ret_col=ret_col, date_col=date_col)
+
+    monthly = crsp[keys + [date_col, ret_col]].copy()
+    monthly[date_col] = pd.to_datetime(monthly[date_col])
+    ends = fiscal_ends.copy()
+    ends['datadate'] = pd.to_datetime(ends['datadate'])
+    ends = ends.dropna(subset=keys + ['datadate'])
+
+    # merge_asof needs both sides sorted by the date it matches on
+    monthly = monthly.dropna(subset=[date_col]).sort_values(date_col, kind='stable')
+    linked = pd.merge_asof(monthly, ends[keys + ['datadate']].sort_values('datadate', kind='stable'),
+                           left_on=date_col, right_on='datadate', by=keys, direction='forward')
+    month_gap = (linked['datadate'].dt.year - linked[date_col].dt.year) * 12 \
+        + (linked['datadate'].dt.month - linked[date_col].dt.month)
+    linked = linked[(month_gap >= 0) & (month_gap < months)]
+
+    compounded = compound_returns(linked, keys + ['datadate'], ret_col=ret_col, date_col=date_col)
+    return ends.merge(compounded, on=keys + ['datadate'], how='left')
@@ -0,0 +1,124 @@
+import pandas as pd
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+from .io import ShardedStore
+
+SEC_ARCHIVE = 'https://www.sec.gov/Archives/'
+ITEMS = {'1': 'item1', '1A': 'item1a', '7': 'item7'}
+SCHEMA = pa.schema([('link', pa.string())] + [(col, pa.string()) for col in ITEMS.values()] + [('error', pa.bool_())])
+
+class TokenBucket:
+    '''
+    Asyncio token bucket: at most `rate` requests per second on average, with bursts of up to `capacity`
+    (by default 1, i.e. requests are spaced evenly).
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else 1
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def _fetch_with_retry(fetch, bucket, url, item, retries, backoff):
+    '''
+    Fetch one section through the rate limiter, retrying failures with exponential backoff and jitter.
+    '''
+    for attempt in range(retries + 1):
+        await bucket.acquire()
+        try:
+            return await asyncio.to_thread(fetch, url, item)
+        except Exception:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+async def _extract_all(links, fetch, store, concurrency, rate, retries, backoff, report_every):
+    bucket = TokenBucket(rate)
+    slots = asyncio.Semaphore(concurrency)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    done = 0
+
+    async def one(link):
+        nonlocal done
+        url = SEC_ARCHIVE + link
+        async with slots:
+            results = await asyncio.gather(*[_fetch_with_retry(fetch, bucket, url, item, retries, backoff)
+                                             for item in ITEMS], return_exceptions=True)
+        if any(isinstance(r, BaseException) for r in results):
+            record = {'link': link, **{col: 'error' for col in ITEMS.values()}, 'error': True}
+        else:
+            record = {'link': link, **dict(zip(ITEMS.values(), results)), 'error': False}
+        store.put(record)
+        done += 1
+        if done % report_every == 0:
+            print(f"Extracted {done} of {len(links)} filings.")
+
+    # bounded number of pending tasks, so memory does not grow with the number of links
+    pending = set()
+    for link in links:
+        if len(pending) >= 4 * concurrency:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                task.result() # raise checkpoint errors instead of dropping them
+        pending.add(asyncio.create_task(one(link)))
+    for task in asyncio.as_completed(pending):
+        await task
+
+def extract_sections(links, key=None, checkpoint_path='extracted_text_shards', output_path='extracted_text.parquet',
+                     concurrency=16, rate=10, retries=5, backoff=1.0, fetch=None, report_every=1000, shard_size=500,
+                     retry_errors=True):
+    '''
+    Use ExtractorApi (from SEC-API) to get items 1, 1a, and 7 for many 10K filings at once.
+
+    Up to `concurrency` filings are in flight at a time, and all section requests share a token bucket of `rate`
+    requests per second. A failed request is retried up to `retries` times with exponential backoff; a filing that
+    still fails is recorded as an error (its items set to 'error'). Finished filings go to an append-only
+    ShardedStore keyed by link (checkpoint_path), and links already extracted are skipped, so a crashed run
+    resumes where it stopped whatever the order of links. Filings recorded as errors are tried again on the
+    next run (unless retry_errors=False); their new record replaces the error. At the end the store is compacted into output_path,
+    shard by shard, so the extracted text is never held in memory as a whole.
+
+    Parameters:
+    - links: iterable of filing paths relative to https://www.sec.gov/Archives/ (the 'fname' column)
+    - key: SEC-API key (not needed when fetch is given)
+    - fetch: optional function (url, item) -> text replacing ExtractorApi.get_section, e.g. for a local server
+    - retry_errors: whether links recorded as errors in checkpoint_path are fetched again
+
+    Returns:
+    - DataFrame listing the links that threw an error
+    The extracted text (columns link, item1, item1a, item7) is written to output_path.
+    '''
+    links = list(dict.fromkeys(links)) # unique, in order
+    if fetch is None:
+        from sec_api import ExtractorApi
+        extractor = ExtractorApi(key)
+        fetch = lambda url, item: extractor.get_section(url, item, 'text')
+
+    store = ShardedStore(checkpoint_path, 'link', schema=SCHEMA, shard_size=shard_size)
+    with store: # opening turns the journal of a crashed run into a shard, so read() sees all records
+        status = store.read(columns=['error'])
+        if retry_errors:
+            status = status.loc[~status['error'].astype(bool)]
+        finished = set(status['link'])
+        todo = [link for link in links if link not in finished]
+        print(f"{len(links) - len(todo)} filings already extracted, {len(todo)} to go.")
+        asyncio.run(_extract_all(todo, fetch, store, concurrency, rate, retries, backoff, report_every))
+
+    wanted = set(links)
+    store.compact(output_path, keys=wanted, columns=['link'] + list(ITEMS.values()))
+    status = store.read(columns=['error'], keys=wanted)
+    return status.loc[status['error'].astype(bool), ['link']].reset_index(drop=True)
@@ -0,0 +1,148 @@
+import numpy as np
+import os
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .index import year_vectors, dataset_years
+from .io import parquet_dataset
+
+# environment variables read by the BLAS/OpenMP libraries numpy may be linked against, when they load
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS')
+
+@contextlib.contextmanager
+def blas_threads(threads):
+    '''
+    Set the BLAS thread count for processes started inside the block (it cannot be changed for numpy once it is
+    loaded), e.g. one thread per worker when a pool already keeps every core busy. The environment is restored
+    on exit.
+    '''
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def _merge_top(best_idx, best_sim, rows, cols, scores, k):
+    '''
+    Merge a block of scores (rows x cols) into the running top k of each row.
+    '''
+    sims = np.concatenate([best_sim[rows], scores], axis=1)
+    idx = np.concatenate([best_idx[rows], np.broadcast_to(cols, scores.shape)], axis=1)
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    best_sim[rows] = np.take_along_axis(sims, top, axis=1)
+    best_idx[rows] = np.take_along_axis(idx, top, axis=1)
+
+def top_pairs(vectors, k=None, threshold=None, block=2048):
+    '''
+    Most similar pairs among unit vectors, without ever holding the n x n similarity matrix: the similarities
+    are computed in block x block tiles (one matrix product each), and only the upper triangle of tiles is
+    computed, since the matrix is symmetric. Each tile is merged into a running top k per row (or filtered by
+    threshold) and dropped.
+
+    Parameters:
+    - k: keep, for every row, its k most similar other rows (pairs (i, j) and (j, i) both appear if each is in
+      the other's top k); combined with threshold, only those of the k at or above threshold
+    - threshold: without k, keep every pair at or above threshold, once (i < j)
+    - block: rows per tile; memory is about 3 * block * (block + k) * 4 bytes besides the inputs
+
+    Returns:
+    - rows i, rows j and their similarities, as arrays; with k, pairs follow i, most similar first
+    '''
+    if k is None and threshold is None:
+        raise ValueError('k or threshold must be given')
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n = len(vectors)
+    floor = -np.inf if threshold is None else np.float32(threshold)
+    if k is not None:
+        k = min(k, n - 1)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        best_sim = np.full((n, k), -np.inf, dtype=np.float32)
+        best_idx = np.full((n, k), -1, dtype=np.int64)
+    pairs = []
+
+    for s in range(0, n, block):
+        a = slice(s, min(s + block, n))
+        for t in range(s, n, block):
+            b = slice(t, min(t + block, n))
+            scores = vectors[a] @ vectors[b].T
+            if s == t:
+                np.fill_diagonal(scores, -np.inf)
+            if k is None:
+                i, j = np.nonzero(scores >= floor)
+                once = i + s < j + t
+                pairs.append((i[once] + s, j[once] + t, scores[i[once], j[once]]))
+                continue
+            scores[scores < floor] = -np.inf
+            _merge_top(best_idx, best_sim, a, np.arange(b.start, b.stop), scores, k)
+            if s != t:
+                _merge_top(best_idx, best_sim, b, np.arange(a.start, a.stop), scores.T, k)
+
+    if k is None:
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return tuple(np.concatenate(part) for part in zip(*pairs))
+    order = np.argsort(-best_sim, axis=1, kind='stable')
+    best_sim = np.take_along_axis(best_sim, order, axis=1).ravel()
+    best_idx = np.take_along_axis(best_idx, order, axis=1).ravel()
+    found = np.isfinite(best_sim)
+    return np.repeat(np.arange(n), k)[found], best_idx[found], best_sim[found]
+
+def _year_pairs(source, dest, value, column, key, year, k, threshold, block):
+    '''
+    Edge list of one year, written to dest/<year>=<value>/part-0.parquet (temporary file, then renamed).
+    '''
+    dataset = parquet_dataset(source)
+    keys, vectors = year_vectors(dataset, value, column, key, year)
+    i, j, sim = top_pairs(vectors, k, threshold, block)
+    columns = {key: pa.array(keys[i], pa.string()), 'peer_' + key: pa.array(keys[j], pa.string()),
+               'similarity': pa.array(sim, pa.float32())}
+    if k is not None:
+        # position of each pair among the peers of its firm, 1 = most similar
+        starts = np.searchsorted(i, i, side='left')
+        columns['rank'] = pa.array(np.arange(len(i)) - starts + 1, pa.int32())
+    part = Path(dest) / f'{year}={value}'
+    part.mkdir(parents=True, exist_ok=True)
+    tmp = part / 'part-0.tmp'
+    pq.write_table(pa.table(columns), tmp, compression='zstd')
+    os.replace(tmp, part / 'part-0.parquet')
+    return len(i)
+
+def similarity_pairs(source, dest, column='embfull', key='gvkey', year='fyear', k=50, threshold=None, block=2048,
+                     years=None, processes=1, threads=None, overwrite=False):
+    '''
+    Cosine similarity between every pair of firms within each fiscal year, kept as a sparse edge list: for every
+    firm its k most similar peers (and/or all pairs above threshold, see top_pairs). Vectors are read year by
+    year straight from the embedded Parquet shards in source (any storage format, see load_vectors).
+
+    The edge list is a Parquet dataset partitioned by year, dest/<year>=<value>/part-0.parquet, with columns key,
+    'peer_' + key, similarity (float32) and, with k, rank. A year whose file exists is skipped unless
+    overwrite, so an interrupted run resumes.
+
+    With processes > 1, years run in a pool of spawned processes, each limited to threads BLAS threads (by
+    default the CPUs divided among the processes), so the pool does not oversubscribe the cores.
+
+    Returns:
+    - dict of year -> number of pairs written (years that were skipped are left out)
+    '''
+    dataset = parquet_dataset(source)
+    years = dataset_years(dataset, year) if years is None else list(years)
+    todo = [value for value in years if overwrite or not (Path(dest) / f'{year}={value}' / 'part-0.parquet').exists()]
+    args = (repeat(source), repeat(dest), todo, repeat(column), repeat(key), repeat(year), repeat(k),
+            repeat(threshold), repeat(block))
+    if processes <= 1 or len(todo) <= 1:
+        return dict(zip(todo, map(_year_pairs, *args)))
+    threads = threads or max(multiprocessing.cpu_count() // processes, 1)
+    with blas_threads(threads), \
+            ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return dict(zip(todo, pool.map(_year_pairs, *args)))
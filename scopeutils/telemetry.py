@@ -0,0 +1,315 @@
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+import functools
+from pathlib import Path
+
+# SCOPE_PROFILE=cprofile, tracemalloc or cprofile,tracemalloc turns on profiling of every step, without editing code;
+# profiles (.prof, for snakeviz or pstats) go to SCOPE_PROFILE_DIR (default: profiles/)
+PROFILE_ENV = 'SCOPE_PROFILE'
+PROFILE_DIR_ENV = 'SCOPE_PROFILE_DIR'
+_profiled_step = None # cProfile cannot nest: only the outermost step of any run is profiled
+
+def _cpu_seconds():
+    '''
+    User and system CPU time of this process and of its finished child processes (e.g. a process pool that
+    has shut down).
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def _io_bytes():
+    '''
+    Bytes this process has read and written so far (Linux /proc/self/io: rchar, wchar), or None elsewhere.
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _rss_mb(field):
+    '''
+    VmRSS (current) or VmHWM (peak since the last reset) of this process in MB, from /proc/self/status; falls
+    back to the peak of the whole run (ru_maxrss) where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2)
+
+def _reset_peak_rss():
+    '''
+    Reset the kernel's peak RSS of this process (Linux 4.0+), so that each step reports its own peak.
+    Returns False where this is not possible; peaks are then those of the run so far.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _rows(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+class Step:
+    '''
+    One named step of a Telemetry run; use it as a context manager (with run.step('read funda') as step) or as
+    a decorator (@run.step('embed'), recorded once per call, with rows_out taken from the result's length).
+    Set step.rows_in / step.rows_out, and register files the step writes with step.output(path).
+    '''
+    def __init__(self, run, name, rows_in=None):
+        self.run = run
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.outputs = []
+        self.record = None
+
+    def output(self, path):
+        self.outputs.append(Path(path))
+        self.run.outputs.append(Path(path))
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Step(self.run, self.name, self.rows_in) as step:
+                result = function(*args, **kwargs)
+                step.rows_out = _rows(result)
+                return result
+        return wrapper
+
+    def __enter__(self):
+        # the peak RSS is about to be reset: fold the peak so far into the steps that are still open
+        for step in self.run._open:
+            step._peak = max(step._peak, _rss_mb('VmHWM'))
+        self.run._open.append(self)
+        self._peak = 0.0
+        self._reset = _reset_peak_rss()
+        self._profiles = self.run._start_profiling(self)
+        self._io = _io_bytes()
+        self._cpu = _cpu_seconds()
+        self._started = time.time()
+        self._wall = time.perf_counter()
+        self.run._checkpoint()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = _cpu_seconds() - self._cpu
+        io = _io_bytes()
+        self.run._open.remove(self)
+        self.record = {
+            'step': self.name, 'started': self._started, 'wall_seconds': wall, 'cpu_seconds': cpu,
+            'cpu_utilization': cpu / wall if wall > 0 else None,
+            'peak_rss_mb': max(self._peak, _rss_mb('VmHWM')), 'peak_rss_of_step': self._reset,
+            'rss_mb': _rss_mb('VmRSS'), 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+            'bytes_read': io[0] - self._io[0] if io and self._io else None,
+            'bytes_written': io[1] - self._io[1] if io and self._io else None,
+            'outputs': [str(path) for path in self.outputs],
+        }
+        if kind is not None:
+            self.record['error'] = f'{kind.__name__}: {error}'
+        self.record.update(self.run._stop_profiling(self, self._profiles))
+        self.run.steps.append(self.record)
+        self.run._checkpoint()
+        if self.run.verbose:
+            rows = f", {self.rows_out:,} rows" if self.rows_out is not None else ''
+            print(f"[{self.run.name}] {self.name}: {wall:.1f}s wall, {cpu:.1f}s CPU, "
+                  f"peak RSS {self.record['peak_rss_mb']:,.0f} MB{rows}", flush=True)
+        return False
+
+class Telemetry:
+    '''
+    Resource telemetry of a pipeline run, step by step: wall time, CPU time (including finished child
+    processes), peak RSS, rows in/out, and bytes read/written by the process (all I/O, not only files). At the
+    end of the run a JSON manifest of all steps is written next to every output file (_<output>.manifest.json;
+    the leading underscore makes pyarrow skip it when the folder is read as a Parquet dataset),
+    so a slow run shows which step dominates. The manifest given as manifest is also rewritten whenever a step
+    starts or ends, with the steps still running, so a run killed for running out of memory leaves a record of
+    the step it died in.
+
+    Steps are either blocks (with run.step(name)), decorated functions (@run.step(name)), or, in long linear
+    scripts, consecutive sections: run.begin(name) ends the current section and starts the next one.
+
+    With the environment variable SCOPE_PROFILE set to cprofile and/or tracemalloc (comma-separated), each
+    step is also profiled: cProfile statistics are saved to SCOPE_PROFILE_DIR and the slowest functions listed in
+    the manifest; tracemalloc adds the peak memory allocated through Python and the largest allocation sites.
+
+    Usage:
+        run = su.Telemetry('4_construct_intanStocks', manifest=path.with_suffix('.run.json'))
+        run.begin('read funda')
+        funda = su.read_table(...)
+        run.begin('write', rows_in=len(t))
+        su.write_table(t, path)
+        run.output(path)
+        run.close() # or use the run as a context manager
+    '''
+    def __init__(self, name, manifest=None, verbose=True, info=None):
+        self.name = name
+        self.info = dict(info or {}) # settings of the run recorded in the manifests (e.g. its mode)
+        self.manifest = Path(manifest) if manifest is not None else None
+        self.verbose = verbose
+        self.steps = []
+        self.outputs = []
+        self.current = None
+        self.profile = {flag.strip() for flag in os.environ.get(PROFILE_ENV, '').lower().split(',') if flag.strip()}
+        self.started = time.time()
+        self._open = []
+
+    def step(self, name, rows_in=None):
+        return Step(self, name, rows_in)
+
+    def begin(self, name, rows_in=None):
+        '''
+        End the current section (if any) and start the next one. Returns its Step.
+        '''
+        self.end()
+        self.current = Step(self, name, rows_in).__enter__()
+        return self.current
+
+    def end(self, rows_out=None):
+        if self.current is not None:
+            if rows_out is not None:
+                self.current.rows_out = rows_out
+            self.current.__exit__(None, None, None)
+            self.current = None
+
+    def close(self):
+        '''
+        End the current section and write the manifests (what leaving a with block does).
+        '''
+        self.__exit__(None, None, None)
+
+    def output(self, path):
+        '''
+        Register a file written by the current section (or by the run, outside of sections).
+        '''
+        if self.current is not None:
+            self.current.output(path)
+        else:
+            self.outputs.append(Path(path))
+
+    def _start_profiling(self, step):
+        global _profiled_step
+        started = {}
+        if 'cprofile' in self.profile and _profiled_step is None:
+            import cProfile
+            started['cprofile'] = cProfile.Profile()
+            started['cprofile'].enable()
+            _profiled_step = step
+        if 'tracemalloc' in self.profile:
+            import tracemalloc
+            started['tracemalloc'] = not tracemalloc.is_tracing()
+            if started['tracemalloc']:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+        return started
+
+    def _stop_profiling(self, step, started):
+        global _profiled_step
+        record = {}
+        if 'cprofile' in started:
+            import io
+            import pstats
+            profiler = started['cprofile']
+            profiler.disable()
+            _profiled_step = None
+            folder = Path(os.environ.get(PROFILE_DIR_ENV, 'profiles'))
+            folder.mkdir(parents=True, exist_ok=True)
+            path = folder / f"{self.name}.{len(self.steps)}.{''.join(c if c.isalnum() else '_' for c in step.name)}.prof"
+            profiler.dump_stats(path)
+            stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats('cumulative')
+            record['cprofile'] = str(path)
+            record['slowest_functions'] = [
+                {'function': f'{file}:{line}({function})', 'cumulative_seconds': cumulative, 'calls': calls}
+                for (file, line, function), (_, calls, _, cumulative, _) in
+                sorted(stats.stats.items(), key=lambda item: -item[1][3])[:15]]
+        if 'tracemalloc' in started:
+            import tracemalloc
+            record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            record['largest_allocations'] = [
+                {'site': str(stat.traceback), 'mb': stat.size / 2 ** 20}
+                for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]]
+            if started['tracemalloc']:
+                tracemalloc.stop()
+        return record
+
+    def summary(self):
+        return {
+            'run': self.name, 'argv': sys.argv, 'host': socket.gethostname(), 'pid': os.getpid(),
+            'slurm_job': os.environ.get('SLURM_JOB_ID'), 'slurm_array_task': os.environ.get('SLURM_ARRAY_TASK_ID'),
+            'python': platform.python_version(), 'cpus': os.cpu_count(), 'profile': sorted(self.profile),
+            'started': self.started, 'finished': time.time(), 'wall_seconds': time.time() - self.started,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2),
+            'info': self.info, 'running': [step.name for step in self._open], 'steps': self.steps,
+        }
+
+    def _checkpoint(self):
+        if self.manifest is not None:
+            _write_json(self.manifest, self.summary())
+
+    def write(self):
+        '''
+        Write the manifest next to every registered output (and to manifest). Returns the paths written.
+        '''
+        summary = self.summary()
+        paths = []
+        targets = [(manifest_path(path), path) for path in dict.fromkeys(self.outputs)]
+        if self.manifest is not None:
+            targets.append((self.manifest, None))
+        for path, output in targets:
+            record = dict(summary)
+            if output is not None:
+                record['output'] = {'path': str(output), 'bytes': _size(output)}
+            _write_json(path, record)
+            paths.append(path)
+        return paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if self.current is not None:
+            self.current.__exit__(kind, error, traceback)
+            self.current = None
+        self.write()
+        return False
+
+def manifest_path(output):
+    '''
+    Where the manifest of an output goes: _<output>.manifest.json in the same folder.
+    '''
+    output = Path(output)
+    return output.with_name(f'_{output.name}.manifest.json')
+
+def _write_json(path, record):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent=1, default=str)
+    os.replace(tmp, path)
+
+def _size(path):
+    '''
+    Size of a file, or of all files under a directory (e.g. a partitioned Parquet dataset), in bytes.
+    '''
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size if path.exists() else None
@@ -0,0 +1,40 @@
+'''
+Tests of the pooling in scopeutils.embed against a reference loop over documents.
+'''
+import numpy as np
+import pytest
+import scopeutils as su
+
+def reference_pool(embeddings, offsets, weights, mode, normalize):
+    out = np.full((len(offsets) - 1, embeddings.shape[1]), np.nan)
+    for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if end == start:
+            continue
+        chunks = embeddings[start:end].astype(np.float64)
+        if mode == 'max':
+            v = chunks.max(axis=0)
+        else:
+            w = np.ones(end - start) if mode == 'mean' else weights[start:end]
+            v = (w[:, None] * chunks).sum(axis=0) / w.sum()
+        out[i] = v / np.linalg.norm(v) if normalize else v
+    return out
+
+@pytest.mark.parametrize('mode', ['weighted', 'mean', 'max'])
+@pytest.mark.parametrize('normalize', [True, False])
+def test_pool_embeddings_matches_loop(mode, normalize):
+    rng = np.random.default_rng(0)
+    # empty documents first, in the middle, in a run and last; single-chunk documents
+    counts = np.array([0, 3, 1, 0, 0, 7, 1, 2, 0, 25, 1, 0])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    embeddings = rng.normal(size=(offsets[-1] + 4, 16)).astype(np.float32) # rows after offsets[-1]: no document
+    weights = rng.integers(1, 3000, len(embeddings)).astype(np.float64)
+    pooled = su.pool_embeddings(embeddings, offsets, weights, mode=mode, normalize=normalize)
+    expected = reference_pool(embeddings, offsets, weights, mode, normalize)
+    assert pooled.shape == expected.shape and pooled.dtype == np.float64
+    np.testing.assert_allclose(pooled, expected, rtol=1e-6, atol=1e-7)
+    assert np.isnan(pooled[counts == 0]).all() and not np.isnan(pooled[counts > 0]).any()
+
+def test_pool_embeddings_without_chunks():
+    assert np.isnan(su.pool_embeddings(np.zeros((0, 4)), [0, 0, 0], np.zeros(0))).all()
+    with pytest.raises(ValueError):
+        su.pool_embeddings(np.ones((2, 4)), [0, 2])
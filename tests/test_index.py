@@ -0,0 +1,59 @@
+'''
+Tests of scopeutils.index and scopeutils.similarity on a folder of embedded shards, as written by embed_parquet
+and 1_embed_items.py while the queue may still be running.
+'''
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scopeutils as su
+
+def embedded_folder(path, firms=60, years=(2000, 2001), dim=16, seed=0):
+    '''
+    Three embedded shards of unit vectors, plus what else lives in a shard folder: a manifest, the temporary file
+    of a shard still being written, and one left by a crashed worker. Returns the folder and the vectors by year.
+    '''
+    rng = np.random.default_rng(seed)
+    path.mkdir()
+    vectors = {}
+    rows = []
+    for fyear in years:
+        vectors[fyear] = su.normalize_rows(rng.normal(size=(firms, dim)))
+        rows += [(f'{i:06d}', fyear, vectors[fyear][i]) for i in range(firms)]
+    for n, part in enumerate(np.array_split(np.arange(len(rows)), 3)):
+        gvkey, fyear, vector = zip(*[rows[i] for i in part])
+        pq.write_table(pa.table({'gvkey': list(gvkey), 'fyear': list(fyear),
+                                 **dict(su.vector_columns('embfull', np.array(vector), 'float16'))}),
+                       path / f'chunk{n}.parquet')
+    (path / '_chunk0.parquet.manifest.json').write_text('{}')
+    (path / 'chunk3.tmp').write_bytes(b'PAR1 half-written shard')
+    (path / 'chunk4.tmp').write_bytes(b'')
+    return path, vectors
+
+def test_parquet_dataset_skips_temporary_and_sidecar_files(tmp_path):
+    folder, _ = embedded_folder(tmp_path / 'embedded')
+    dataset = su.parquet_dataset(folder)
+    assert dataset.count_rows() == 120
+    assert sorted(dataset.files) == [str(folder / f'chunk{n}.parquet') for n in range(3)]
+    assert su.load_vectors(folder, 'embfull', filters=[('fyear', '==', 2001)]).shape == (60, 16)
+
+def test_build_index_while_shards_are_written(tmp_path):
+    folder, vectors = embedded_folder(tmp_path / 'embedded')
+    index = su.AnnIndex(su.build_index(folder, tmp_path / 'index', lists=4))
+    rows, sims = index.search(vectors[2001][:5], 2001, k=1, exact=True)
+    assert np.allclose(sims[:, 0], 1, atol=1e-2)
+    peers = index.neighbors('000003', 2000, k=3, exact=True)
+    sims = vectors[2000] @ vectors[2000][3]
+    sims[3] = -np.inf
+    assert peers['gvkey'].tolist() == [f'{i:06d}' for i in np.argsort(-sims)[:3]]
+
+def test_similarity_pairs_while_shards_are_written(tmp_path):
+    folder, vectors = embedded_folder(tmp_path / 'embedded')
+    written = su.similarity_pairs(folder, tmp_path / 'pairs', k=5, processes=2, threads=1)
+    assert written == {2000: 300, 2001: 300}
+    pairs = pq.read_table(tmp_path / 'pairs').to_pandas()
+    for fyear, pairs_year in pairs.groupby('fyear', observed=True):
+        sims = vectors[fyear] @ vectors[fyear].T
+        np.fill_diagonal(sims, -np.inf)
+        first = pairs_year[pairs_year['gvkey'] == '000007'].sort_values('rank')
+        assert first['peer_gvkey'].tolist() == [f'{i:06d}' for i in np.argsort(-sims[7])[:5]]
+        assert np.allclose(first['similarity'], np.sort(sims[7])[::-1][:5], atol=1e-2)
@@ -0,0 +1,152 @@
+'''
+Tests of the scopeutils.intangibles kernels against the row-by-row loops of the original
+4_construct_intanStocks.py, which they replace. Results must be identical, not just close.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import scopeutils as su
+
+def reference_capital(funda):
+    '''
+    genkcap_single/genocap_single of the original script, run per gvkey over its rows in order.
+    '''
+    kcap = funda['kcap_v2'].to_numpy(dtype=np.float64).copy()
+    ocap = funda['ocap_v2'].to_numpy(dtype=np.float64).copy()
+    theta, gamma = funda['theta_g2'].to_numpy(dtype=np.float64), funda['gamma_o2'].to_numpy(dtype=np.float64)
+    xrd, xsga = funda['xrd'].to_numpy(dtype=np.float64), funda['xsga'].to_numpy(dtype=np.float64)
+    for gvkey in funda['gvkey'].unique():
+        rows = np.flatnonzero(funda['gvkey'].to_numpy() == gvkey)
+        for prev, i in zip(rows[:-1], rows[1:]):
+            kcap[i] = kcap[prev] * (1 - theta[i]) + xrd[i]
+            ocap[i] = ocap[prev] * 0.8 + xsga[i] * gamma[i]
+    return kcap, ocap
+
+def random_funda(n_firms, seed):
+    '''
+    Firms of 1 to 30 years, sorted by gvkey and fyear, with missing flows (including firms whose flows are all
+    missing) and a starting stock in the first year of every firm.
+    '''
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1, 31, n_firms)
+    years[:3] = 1 # single-row firms
+    gvkey = np.repeat(np.arange(n_firms) * 7 + 1000, years)
+    n = len(gvkey)
+    fyear = np.concatenate([np.arange(y) + 1980 for y in years])
+    xrd = rng.lognormal(2, 1, n)
+    xsga = rng.lognormal(3, 1, n)
+    xrd[rng.random(n) < 0.05] = np.nan
+    xsga[rng.random(n) < 0.05] = np.nan
+    xrd[gvkey == gvkey[-1]] = np.nan # all-missing segment
+    first = np.r_[True, gvkey[1:] != gvkey[:-1]]
+    return pd.DataFrame({'gvkey': gvkey, 'fyear': fyear,
+                         'kcap_v2': np.where(first, rng.lognormal(3, 1, n), 0.0),
+                         'ocap_v2': np.where(first, rng.lognormal(4, 1, n), 0.0),
+                         'theta_g2': rng.choice([0.15, 0.2, 0.33, 0.4], n),
+                         'gamma_o2': rng.choice([0.3, 0.45, 0.55], n),
+                         'xrd': xrd, 'xsga': xsga})
+
+def test_linear_recurrence_matches_loop():
+    rng = np.random.default_rng(0)
+    lens = np.array([1, 5, 1, 12, 3, 0, 7, 1])
+    ends = np.cumsum(lens)
+    starts = ends - lens
+    n = ends[-1]
+    init, decay, flow = rng.normal(size=n), rng.uniform(0.5, 1, n), rng.normal(size=n)
+    flow[starts[6]:ends[6]] = np.nan
+
+    expected = init.copy()
+    for s, e in zip(starts, ends):
+        for i in range(s + 1, e):
+            expected[i] = expected[i - 1] * decay[i] + flow[i]
+    np.testing.assert_array_equal(su.linear_recurrence(init, decay, flow, starts, ends), expected)
+    assert len(su.linear_recurrence(np.zeros(0), np.zeros(0), np.zeros(0), starts[:0], ends[:0])) == 0
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_intangible_capital_matches_loop(max_workers):
+    funda = random_funda(200, seed=1)
+    kcap, ocap = reference_capital(funda)
+    out = su.calculate_intangible_capital(funda, batch_size=16, max_workers=max_workers)
+    np.testing.assert_array_equal(out['kcap_v2'].to_numpy(), kcap)
+    np.testing.assert_array_equal(out['ocap_v2'].to_numpy(), ocap)
+    pd.testing.assert_frame_equal(out.drop(columns=['kcap_v2', 'ocap_v2']), funda.drop(columns=['kcap_v2', 'ocap_v2']))
+
+def test_intangible_capital_with_firms_interleaved():
+    # rows of a firm keep their relative order but are spread across the frame; the output follows the input rows
+    funda = random_funda(50, seed=2)
+    shuffled = funda.iloc[np.random.default_rng(3).permutation(len(funda))]
+    shuffled = shuffled.sort_values('fyear', kind='stable').set_index(pd.RangeIndex(len(funda)) * 3)
+    kcap, ocap = reference_capital(shuffled)
+    out = su.calculate_intangible_capital(shuffled, batch_size=8, max_workers=2)
+    assert out.index.equals(shuffled.index)
+    np.testing.assert_array_equal(out['kcap_v2'].to_numpy(), kcap)
+    np.testing.assert_array_equal(out['ocap_v2'].to_numpy(), ocap)
+
+def reference_nearest(values, groups, fillable):
+    '''
+    The nearest-value loop of the original script: for each fillable missing row, the last valid value at or
+    before it and the first after it within the firm, the previous one winning ties (distb<=distc).
+    '''
+    filled = values.copy()
+    for i in np.flatnonzero(fillable & np.isnan(values)):
+        firm = np.flatnonzero(groups == groups[i])
+        before = [j for j in firm if j <= i and not np.isnan(values[j])]
+        after = [j for j in firm if j > i and not np.isnan(values[j])]
+        if before and (not after or i - before[-1] <= after[0] - i):
+            filled[i] = values[before[-1]]
+        elif after:
+            filled[i] = values[after[0]]
+    return filled
+
+def test_interpolate_nearest_matches_loop():
+    rng = np.random.default_rng(4)
+    lens = rng.integers(1, 15, 150)
+    groups = np.repeat(np.arange(len(lens)), lens)
+    values = rng.normal(size=len(groups))
+    values[rng.random(len(groups)) < 0.4] = np.nan
+    values[groups == 5] = np.nan # all-missing firm
+    fillable = rng.random(len(groups)) < 0.7
+    np.testing.assert_array_equal(su.interpolate_nearest(values, groups, fillable),
+                                  reference_nearest(values, groups, fillable))
+
+def test_interpolate_nearest_edges():
+    groups = np.array([1, 2, 2, 2, 2, 2, 3, 3, 4])
+    values = np.array([np.nan, 1.0, np.nan, np.nan, np.nan, 5.0, np.nan, np.nan, 9.0])
+    filled = su.interpolate_nearest(values, groups, np.ones(len(values), dtype=bool))
+    # single-row firm and all-missing firm stay missing; a tie takes the previous value; no value crosses firms
+    np.testing.assert_array_equal(filled, [np.nan, 1.0, 1.0, 1.0, 5.0, 5.0, np.nan, np.nan, 9.0])
+    # rows that are not fillable keep their value but still serve as neighbours
+    filled = su.interpolate_nearest(values, groups, np.arange(len(values)) != 3)
+    np.testing.assert_array_equal(filled, [np.nan, 1.0, 1.0, np.nan, 5.0, 5.0, np.nan, np.nan, 9.0])
+
+def reference_backfill(logx, growth, groups):
+    '''
+    The backward loop of the original script: for each missing row, newest first, the next valid value of the
+    firm minus the growth rates of the rows after it up to that value (missing rates count as zero).
+    '''
+    filled = logx.copy()
+    for i in sorted(np.flatnonzero(np.isnan(logx)), reverse=True):
+        later = [j for j in np.flatnonzero(groups == groups[i]) if j > i and not np.isnan(logx[j])]
+        if later:
+            filled[i] = logx[later[0]] - np.nansum(growth[i + 1:later[0] + 1])
+    return filled
+
+def test_backfill_log_growth_matches_loop():
+    rng = np.random.default_rng(5)
+    lens = rng.integers(1, 25, 150)
+    groups = np.repeat(np.arange(len(lens)), lens)
+    logx = rng.normal(3, 1, len(groups))
+    logx[rng.random(len(groups)) < 0.3] = np.nan
+    logx[groups == 7] = np.nan # all-missing firm
+    growth = rng.normal(0.08, 0.05, len(groups))
+    growth[rng.random(len(groups)) < 0.1] = np.nan
+    np.testing.assert_allclose(su.backfill_log_growth(logx, growth, groups), reference_backfill(logx, growth, groups),
+                               rtol=1e-12, atol=1e-12)
+
+def test_backfill_log_growth_edges():
+    groups = np.array([1, 2, 2, 2, 2, 3, 3, 4])
+    logx = np.array([np.nan, np.nan, np.nan, 2.0, np.nan, np.nan, np.nan, 1.0])
+    growth = np.array([0.5, 0.1, np.nan, 0.2, 0.3, 0.1, 0.1, 0.4])
+    filled = su.backfill_log_growth(logx, growth, groups)
+    # single-row, trailing and all-missing rows have no later value; no value crosses firms
+    np.testing.assert_allclose(filled, [np.nan, 1.8, 1.8, 2.0, np.nan, np.nan, np.nan, 1.0])
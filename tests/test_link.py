@@ -0,0 +1,83 @@
+'''
+Tests of scopeutils.link.interval_join against a row-by-row scan of the links.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import scopeutils as su
+
+def reference_join(left, right, on, date, start, end, how='inner'):
+    '''
+    For every left row in order, every right row in order with the same key whose [start, end] contains the
+    date; a missing bound is open, a missing key or date never matches.
+    '''
+    right_cols = [col for col in right.columns if col != on]
+    rows = []
+    for _, l in left.iterrows():
+        matched = False
+        for _, r in right.iterrows():
+            if pd.isna(l[on]) or pd.isna(l[date]) or pd.isna(r[on]) or l[on] != r[on]:
+                continue
+            if (pd.isna(r[start]) or r[start] <= l[date]) and (pd.isna(r[end]) or l[date] <= r[end]):
+                rows.append({**l.to_dict(), **r[right_cols].to_dict()})
+                matched = True
+        if how == 'left' and not matched:
+            rows.append({**l.to_dict(), **{col: np.nan for col in right_cols}})
+    return pd.DataFrame(rows, columns=list(left.columns) + right_cols)
+
+def random_links(seed):
+    '''
+    Filings and date-bounded links of 30 firms: overlapping links, links open on either side (WRDS 'B'/'E'
+    codes), firms with a single link or none, and rows with a missing key or date.
+    '''
+    rng = np.random.default_rng(seed)
+    n_links = 80
+    starts = pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 4000, n_links), unit='D')
+    ends = starts + pd.to_timedelta(rng.integers(0, 2000, n_links), unit='D')
+    right = pd.DataFrame({'cik': rng.integers(0, 25, n_links).astype(np.float64),
+                          'linkdt': starts.strftime('%Y%m%d'), 'linkenddt': ends.strftime('%Y%m%d'),
+                          'gvkey': [f'{i:06d}' for i in range(n_links)]})
+    right.loc[rng.random(n_links) < 0.15, 'linkdt'] = 'B'
+    right.loc[rng.random(n_links) < 0.2, 'linkenddt'] = 'E'
+    right.loc[3, 'cik'] = np.nan
+    right['linkdt'] = su.to_link_date(right['linkdt'])
+    right['linkenddt'] = su.to_link_date(right['linkenddt'])
+
+    n_filings = 300
+    left = pd.DataFrame({'cik': rng.integers(0, 30, n_filings).astype(np.float64),
+                         'filing_date': pd.Timestamp('1999-01-01') + pd.to_timedelta(rng.integers(0, 7000, n_filings), unit='D'),
+                         'link': [f'filing{i}' for i in range(n_filings)]})
+    left.loc[rng.random(n_filings) < 0.05, 'cik'] = np.nan
+    left.loc[rng.random(n_filings) < 0.05, 'filing_date'] = pd.NaT
+    # filings on the first and last day of a link
+    left.loc[:9, 'cik'] = right.loc[10:19, 'cik'].to_numpy()
+    left.loc[:4, 'filing_date'] = right.loc[10:14, 'linkdt'].to_numpy()
+    left.loc[5:9, 'filing_date'] = right.loc[15:19, 'linkenddt'].to_numpy()
+    return left, right
+
+def test_to_link_date_open_codes():
+    parsed = su.to_link_date(['20010131', 20010131.0, 'B', 'E', 0, '2001-01-31', None])
+    assert parsed.isna().tolist() == [False, False, True, True, True, False, True]
+    assert (parsed.dropna() == pd.Timestamp('2001-01-31')).all()
+
+@pytest.mark.parametrize('how', ['inner', 'left'])
+@pytest.mark.parametrize('chunk_size', [1, 7, 5_000_000])
+def test_interval_join_matches_loop(how, chunk_size):
+    left, right = random_links(seed=0)
+    expected = reference_join(left, right, 'cik', 'filing_date', 'linkdt', 'linkenddt', how=how)
+    out = su.interval_join(left, right, on='cik', date='filing_date', start='linkdt', end='linkenddt',
+                           how=how, chunk_size=chunk_size)
+    pd.testing.assert_frame_equal(out, expected, check_dtype=False)
+    assert len(out) > 0 and out['linkdt'].isna().any() and out['linkenddt'].isna().any()
+
+def test_interval_join_bounds_and_suffixes():
+    left = pd.DataFrame({'gvkey': ['a', 'a', 'a', 'b', None], 'year': [1999, 2000, 2005, 2003, 2003], 'name': list('vwxyz')})
+    right = pd.DataFrame({'gvkey': ['a', 'a', 'b', 'c'], 'start': [2000, np.nan, 2004, 2000],
+                          'end': [2005, 1999, np.nan, 2010], 'name': ['first', 'open start', 'open end', 'other']})
+    out = su.interval_join(left, right, on='gvkey', date='year', start='start', end='end', how='left')
+    assert out['name_x'].tolist() == ['v', 'w', 'x', 'y', 'z']
+    assert out['name_y'].fillna('').tolist() == ['open start', 'first', 'first', '', '']
+    inner = su.interval_join(left, right, on='gvkey', date='year', start='start', end='end')
+    assert inner['name_x'].tolist() == ['v', 'w', 'x']
+    with pytest.raises(ValueError):
+        su.interval_join(left, right, on='gvkey', date='year', start='start', end='end', how='outer')
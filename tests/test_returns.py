@@ -0,0 +1,80 @@
+'''
+Tests of scopeutils.returns against the groupby.apply compounding of the original 0_clean_cs_crsp.py and a
+month-by-month loop for fiscal years.
+'''
+import numpy as np
+import pandas as pd
+import scopeutils as su
+
+def calculate_annual_return(group):
+    # If any 'ret' is NaN, return NaN for the entire year
+    if group['ret'].isna().any():
+        return np.nan
+    return np.prod(1 + group['ret']) - 1
+
+def random_crsp(n_permnos, seed):
+    '''
+    Monthly returns of firms listed for 1 to 40 months, rows shuffled, with missing returns, a firm whose
+    returns are all missing, a single-month firm and a few rows without a PERMNO.
+    '''
+    rng = np.random.default_rng(seed)
+    months = rng.integers(1, 41, n_permnos)
+    months[0] = 1
+    permno = np.repeat(np.arange(n_permnos) + 10000, months).astype(np.float64)
+    first = rng.integers(0, 60, n_permnos)
+    date = np.concatenate([pd.date_range('2000-01-31', periods=60 + m, freq='ME')[f:f + m].to_numpy()
+                           for f, m in zip(first, months)])
+    ret = rng.normal(0.01, 0.08, len(permno))
+    ret[rng.random(len(ret)) < 0.03] = np.nan
+    ret[permno == 10001] = np.nan
+    permno[rng.random(len(permno)) < 0.01] = np.nan
+    crsp = pd.DataFrame({'PERMNO': permno, 'date': date, 'ret': ret})
+    crsp['crsp_first_date'] = crsp.groupby('PERMNO')['date'].transform('min')
+    return crsp.iloc[rng.permutation(len(crsp))].reset_index(drop=True)
+
+def test_compound_returns_matches_groupby_apply():
+    crsp = random_crsp(300, seed=0)
+    crsp['year'] = crsp['date'].dt.year
+    expected = (crsp.sort_values(['PERMNO', 'date']).groupby(['PERMNO', 'year', 'crsp_first_date'])
+                .apply(calculate_annual_return, include_groups=False).reset_index(name='ret'))
+
+    out = su.annual_returns(crsp, keys=('PERMNO', 'crsp_first_date'))
+    pd.testing.assert_frame_equal(out[['PERMNO', 'year', 'crsp_first_date']], expected[['PERMNO', 'year', 'crsp_first_date']])
+    np.testing.assert_allclose(out['ret'], expected['ret'], rtol=1e-13, atol=1e-15)
+    assert out.loc[out['PERMNO'] == 10001, 'ret'].isna().all()
+    assert out.loc[out['PERMNO'] == 10000, 'ret'].notna().sum() <= 1
+
+def test_compound_returns_in_date_order():
+    df = pd.DataFrame({'id': [1, 1, 1, 2], 'date': [3, 1, 2, 1], 'ret': [0.5, -0.5, 1.0, 0.1]})
+    out = su.compound_returns(df, ['id'])
+    assert out['id'].tolist() == [1, 2]
+    np.testing.assert_allclose(out['ret'], [(0.5 * 2.0 * 1.5) - 1, 0.1])
+    assert su.compound_returns(df.iloc[:0], ['id']).empty
+
+def test_fiscal_year_returns_match_loop():
+    crsp = random_crsp(100, seed=1)
+    rng = np.random.default_rng(2)
+    # fiscal year ends in a random month of each firm, one a year, and one firm that moves its year end
+    ends = pd.DataFrame([{'PERMNO': p, 'datadate': pd.Timestamp(year, month, 1) + pd.offsets.MonthEnd(0)}
+                         for p, month in zip(crsp['PERMNO'].dropna().unique(), rng.integers(1, 13, 100))
+                         for year in range(2000, 2010)])
+    ends.loc[(ends['PERMNO'] == ends['PERMNO'].iloc[0]) & (ends['datadate'].dt.year >= 2005), 'datadate'] += pd.offsets.MonthEnd(5)
+    ends['fyear'] = ends['datadate'].dt.year
+
+    expected = []
+    for row in ends.itertuples():
+        firm = crsp[crsp['PERMNO'] == row.PERMNO]
+        later = ends.loc[ends['PERMNO'] == row.PERMNO, 'datadate']
+        # months whose first fiscal year end on or after them is this one, within the 12 months ending there
+        months = [r for r in firm.itertuples() if later[later >= r.date].min() == row.datadate
+                  and (row.datadate.year - r.date.year) * 12 + row.datadate.month - r.date.month < 12]
+        if not months:
+            expected.append(np.nan)
+        elif any(np.isnan(r.ret) for r in months):
+            expected.append(np.nan)
+        else:
+            expected.append(np.prod([1 + r.ret for r in sorted(months, key=lambda r: r.date)]) - 1)
+
+    out = su.annual_returns(crsp, keys=('PERMNO',), fiscal_ends=ends)
+    pd.testing.assert_frame_equal(out[['PERMNO', 'datadate', 'fyear']], ends)
+    np.testing.assert_allclose(out['ret'], expected, rtol=1e-13, atol=1e-15)
@@ -0,0 +1,194 @@
+'''
+Tests of scopeutils.sec.extract_sections against a local stub of the SEC-API extractor endpoint
+(GET /extractor?url=...&item=...&type=text), which records every request it serves.
+'''
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import pandas as pd
+import scopeutils as su
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def section_text(url, item):
+    return f'item {item} of {url}'
+
+class StubSEC(ThreadingHTTPServer):
+    '''
+    Extractor endpoint answering each request after delay seconds with section_text(url, item). failures maps
+    (link, item) to a list of HTTP status codes returned (in order) before the request succeeds.
+    '''
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, failures=None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.failures = {key: list(codes) for key, codes in (failures or {}).items()}
+        self.lock = threading.Lock()
+        self.requests = [] # (time, link, item, status)
+        self.in_flight = {} # link -> requests being served
+        self.max_filings_in_flight = 0
+
+    @property
+    def base(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, link, item=None):
+        return sum(1 for _, l, i, _ in self.requests if l == link and (item is None or i == item))
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        url, item = query['url'][0], query['item'][0]
+        link = url.removeprefix(su.SEC_ARCHIVE)
+        with server.lock:
+            server.in_flight[link] = server.in_flight.get(link, 0) + 1
+            server.max_filings_in_flight = max(server.max_filings_in_flight, len(server.in_flight))
+            codes = server.failures.get((link, item))
+            status = codes.pop(0) if codes else 200
+            server.requests.append((time.monotonic(), link, item, status))
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight[link] -= 1
+            if not server.in_flight[link]:
+                del server.in_flight[link]
+        body = (section_text(url, item) if status == 200 else 'error').encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def stub_fetch(base):
+    '''
+    fetch function for extract_sections calling the stub the way ExtractorApi.get_section calls the API;
+    HTTP errors (429, 5xx) raise.
+    '''
+    def fetch(url, item):
+        query = urllib.parse.urlencode({'url': url, 'item': item, 'type': 'text'})
+        with urllib.request.urlopen(f'{base}/extractor?{query}', timeout=10) as response:
+            return response.read().decode()
+    return fetch
+
+def links(n):
+    return [f'edgar/data/{1000 + i}/0000{i:06d}-00-000001.txt' for i in range(n)]
+
+def expected(linklist):
+    return pd.DataFrame([{'link': link, **{col: section_text(su.SEC_ARCHIVE + link, item)
+                                           for item, col in su.ITEMS.items()}} for link in linklist])
+
+def extract(server, linklist, tmp, **kwargs):
+    kwargs = {'concurrency': 4, 'rate': 1000, 'retries': 2, 'backoff': 0.01, 'report_every': 10 ** 6, **kwargs}
+    errors = su.extract_sections(linklist, fetch=stub_fetch(server.base), checkpoint_path=tmp / 'shards',
+                                 output_path=tmp / 'out.parquet', **kwargs)
+    return errors, pd.read_parquet(tmp / 'out.parquet')
+
+def test_concurrency_cap(tmp_path):
+    with StubSEC(delay=0.05) as server:
+        errors, out = extract(server, links(20), tmp_path, concurrency=3)
+    assert errors.empty
+    pd.testing.assert_frame_equal(out.sort_values('link', ignore_index=True), expected(links(20)))
+    assert 2 <= server.max_filings_in_flight <= 3
+
+def test_token_bucket_rate(tmp_path):
+    rate = 20
+    with StubSEC() as server:
+        errors, out = extract(server, links(10), tmp_path, concurrency=8, rate=rate)
+    assert errors.empty and len(out) == 10
+    times = sorted(t for t, *_ in server.requests)
+    assert len(times) == 30
+    window = 10 # any 11 consecutive requests span at least 10 token refills
+    spans = [times[i + window] - times[i] for i in range(len(times) - window)]
+    assert min(spans) >= 0.9 * window / rate
+
+def test_retry_with_backoff(tmp_path):
+    ok, flaky, broken = links(3)
+    failures = {(flaky, '1'): [429, 503], (flaky, '7'): [500], (broken, '1A'): [500] * 3}
+    with StubSEC(failures=failures) as server:
+        errors, out = extract(server, [ok, flaky, broken], tmp_path, retries=2, backoff=0.05)
+        assert server.count(ok) == 3
+        assert server.count(flaky, '1') == 3 and server.count(flaky, '7') == 2
+        assert server.count(broken, '1A') == 3 # the first try and 2 retries
+
+        attempts = [t for t, link, item, _ in server.requests if (link, item) == (flaky, '1')]
+        assert attempts[1] - attempts[0] >= 0.05 # backoff * 2 ** attempt * (1 + jitter)
+        assert attempts[2] - attempts[1] >= 0.1
+
+        assert errors['link'].tolist() == [broken]
+        pd.testing.assert_frame_equal(out[out['link'] != broken].reset_index(drop=True), expected([ok, flaky]))
+        assert (out.loc[out['link'] == broken, list(su.ITEMS.values())] == 'error').all(axis=None)
+
+        # the next run tries only the filing that failed, and its new record replaces the error
+        errors, out = extract(server, [ok, flaky, broken], tmp_path)
+        assert errors.empty
+        assert server.count(ok) == 3 and server.count(flaky) == 6 and server.count(broken) == 8
+        pd.testing.assert_frame_equal(out.sort_values('link', ignore_index=True), expected([ok, flaky, broken]))
+
+        # unless failed filings are to be left alone
+        server.failures = {(ok, '1'): [500] * 3}
+        errors, _ = extract(server, [ok], tmp_path / 'other')
+        assert errors['link'].tolist() == [ok]
+        extract(server, [ok], tmp_path / 'other', retry_errors=False)
+        assert server.count(ok) == 8
+
+CRASHING_RUN = '''
+import sys, urllib.parse, urllib.request
+import scopeutils as su
+base, checkpoint, output, *linklist = sys.argv[1:]
+def fetch(url, item):
+    query = urllib.parse.urlencode({'url': url, 'item': item, 'type': 'text'})
+    with urllib.request.urlopen(f'{base}/extractor?{query}', timeout=10) as response:
+        return response.read().decode()
+su.extract_sections(linklist, fetch=fetch, checkpoint_path=checkpoint, output_path=output,
+                    concurrency=2, rate=1000, shard_size=3)
+'''
+
+def test_resume_after_crash(tmp_path):
+    linklist = links(40)
+    with StubSEC(delay=0.02) as server:
+        # a run killed (SIGKILL, nothing is cleaned up) once about a third of the filings are done
+        child = subprocess.Popen([sys.executable, '-c', CRASHING_RUN, server.base, str(tmp_path / 'shards'),
+                                  str(tmp_path / 'out.parquet'), *linklist],
+                                 env={**os.environ, 'PYTHONPATH': str(ROOT)}, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while sum(server.count(link) == 3 for link in linklist) < 15 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        assert not (tmp_path / 'out.parquet').exists()
+
+        done = su.ShardedStore(tmp_path / 'shards', 'link').keys() # checkpointed, in shards or the journal
+        assert 10 <= len(done) < len(linklist)
+        before = {link: server.count(link) for link in linklist}
+
+        errors, out = extract(server, linklist, tmp_path)
+        assert errors.empty
+        for link in linklist:
+            fetched = server.count(link) - before[link]
+            assert fetched == (0 if link in done else 3), link
+
+    # the same result set as a run that was never interrupted
+    with StubSEC() as server:
+        _, clean = extract(server, linklist, tmp_path / 'clean')
+    assert len(out) == len(linklist)
+    pd.testing.assert_frame_equal(out.sort_values('link', ignore_index=True),
+                                  clean.sort_values('link', ignore_index=True))
+    pd.testing.assert_frame_equal(clean.sort_values('link', ignore_index=True), expected(linklist))
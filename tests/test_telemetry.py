@@ -0,0 +1,50 @@
+'''
+Tests of scopeutils.telemetry: manifests written next to outputs must not break readers of the output folder.
+'''
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import scopeutils as su
+
+def test_manifests_do_not_break_parquet_datasets(tmp_path):
+    folder = tmp_path / 'embedded'
+    folder.mkdir()
+    for i in range(3):
+        run = su.Telemetry('embed', verbose=False)
+        with run.step('embed', rows_in=4) as step:
+            dest = folder / f'chunk{i}.parquet'
+            pq.write_table(pa.table({'gvkey': [f'{i}{j}' for j in range(4)], 'fyear': [2000 + i] * 4,
+                                     **dict(su.vector_columns('emb', np.ones((4, 8)), 'float32'))}), dest)
+            step.rows_out = 4
+            step.output(dest)
+        run.close()
+
+    manifest = su.manifest_path(folder / 'chunk0.parquet')
+    assert manifest.name.startswith('_') and manifest.exists()
+    record = json.load(open(manifest))
+    assert record['output'] == {'path': str(folder / 'chunk0.parquet'), 'bytes': (folder / 'chunk0.parquet').stat().st_size}
+    assert [step['step'] for step in record['steps']] == ['embed'] and record['steps'][0]['rows_out'] == 4
+
+    # the folder is still a valid Parquet dataset, for every way it is read downstream
+    assert ds.dataset(folder, format='parquet', partitioning='hive').count_rows() == 12
+    assert pq.read_table(folder).num_rows == 12
+    assert su.load_vectors(folder, 'emb').shape == (12, 8)
+
+def test_run_manifest_records_steps_as_they_run(tmp_path):
+    path = tmp_path / 'run.json'
+    run = su.Telemetry('script', manifest=path, verbose=False)
+    run.begin('read')
+    assert json.load(open(path))['running'] == ['read']
+    run.begin('write', rows_in=10)
+    run.output(tmp_path / 'out.parquet')
+    pq.write_table(pa.table({'a': range(10)}), tmp_path / 'out.parquet')
+    run.close()
+
+    record = json.load(open(path))
+    assert record['running'] == []
+    assert [step['step'] for step in record['steps']] == ['read', 'write']
+    assert record['steps'][1]['rows_in'] == 10 and record['steps'][1]['outputs'] == [str(tmp_path / 'out.parquet')]
+    assert all(step['wall_seconds'] >= 0 and step['peak_rss_mb'] > 0 for step in record['steps'])
+    assert su.manifest_path(tmp_path / 'out.parquet').exists()